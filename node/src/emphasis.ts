@@ -3,12 +3,12 @@
  * date: 10/16/2024
  * author: Tristan Hilbert (aka TFlexSoom)
  * desc: Highlights emphasis worthy corpus prompts and annotations
- *   as signaled by the backend.
+ *   as signaled by the backend. Keywords are marked up in the instance
+ *   text by the backend from their offsets, so only suggestions are
+ *   handled here.
  * 
  */
 
-import TrieSearch from "trie-search";
-
 // Main
 (function(){
     function getJsonElement<T>(elementId: string): T | undefined {
@@ -26,69 +26,6 @@ import TrieSearch from "trie-search";
         return undefined;
     }
 
-    function emphasize(emphasisList: Array<string>) {
-        const instanceTextElem = document.getElementById("instance-text");
-        if(instanceTextElem === null) {
-            console.warn("cannot find instance text");
-            return;
-        }
-
-        const instanceText = instanceTextElem.textContent;
-        if(!instanceText || instanceText === "") {
-            console.log("text content in instance");
-            return;
-        }
-        
-        const emphasisTrie = new TrieSearch<any>(undefined, {
-            splitOnRegEx: false,
-        });
-
-        emphasisList.map((item) => emphasisTrie.map(item, item));
-        const wordList = instanceText.split(" ");
-        let lastWasValid = false;
-        let last = "";
-        let result = "";
-        for(const word of wordList) {
-            const current = last + word;
-            const search = emphasisTrie.search(current);
-
-            if(search.length === 0 && lastWasValid) {
-                result += `
-                <mark aria-hidden="true" class="emphasis">${last}</mark>
-                `;
-                
-                result += word + ' ';
-                last = "";
-                lastWasValid = false;
-                continue;
-            }
-
-            if(search.length === 0) {
-                // since this is html we don't have to worry about extra spaces
-                result += word + " ";
-                last = "";
-                continue;
-            }
-
-            if(search.length === 1 && search[0] === current) {
-                result += `
-                <mark aria-hidden="true" class="emphasis">${current}</mark>
-                `;
-                last = "";
-                lastWasValid = false;
-                continue;
-            }
-
-            if(search.includes(current)) {
-                lastWasValid = true;
-            }
-            
-            last = current + " ";
-        }
-
-        instanceTextElem.innerHTML = result;
-    }
-
     interface Suggestion {
         name: string
         label: string
@@ -118,11 +55,6 @@ import TrieSearch from "trie-search";
         }
     }
 
-    const emphasis = getJsonElement<Array<string>>("emphasis");
-    if(emphasis !== undefined) {
-        emphasize(emphasis);
-    }
-
     const suggestions = getJsonElement<Array<Suggestion>>("suggestions");
     if(suggestions !== undefined) {
         suggest(suggestions);
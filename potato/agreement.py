@@ -1,52 +1,310 @@
+"""
+Computes Krippendorff's alpha for a JSONL file of annotations, along with the
+reports needed for quality control on large crowd studies:
+
+  * a bootstrap confidence interval for alpha (resampling instances),
+  * leave-one-annotator-out alpha, to find annotators who lower agreement,
+  * pairwise alpha between every two annotators who share instances.
+
+These need thousands of alpha computations, so they are spread over a process
+pool. Each line of the input file is a JSON object with an "annotations" list
+of {"user": ..., "label": ...} entries; a negative label marks a skipped
+instance. The file is streamed line by line and the results are written to a
+JSON report.
+
+Usage: python -m potato.agreement annotations.jsonl report.json --bootstrap 1000
+"""
+
 import argparse
-import simpledorff
-from simpledorff.metrics import *
-import ujson
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-from collections import defaultdict
 import numpy as np
+import ujson
+from scipy import sparse
+
+from potato.server_utils.krippendorff import (
+    LEVELS_OF_MEASUREMENT,
+    alpha_from_counts,
+    encode,
+    value_counts_by_unit,
+)
+
+
+class AnnotationData:
+    """
+    The annotations of a file as parallel arrays of (instance, annotator,
+    value) codes, which is all the workers need to compute alpha.
+    """
+
+    def __init__(self, units, annotators, values, annotator_ids, categories, n_units,
+                 level_of_measurement, n_skipped=0):
+        self.units = units
+        self.annotators = annotators
+        self.values = values
+        self.annotator_ids = annotator_ids
+        self.categories = categories
+        self.n_units = n_units
+        self.level_of_measurement = level_of_measurement
+        self.n_skipped = n_skipped
+
+    def unit_counts(self, mask=None):
+        """
+        Returns the (instances x categories) count matrix of the annotations,
+        optionally only for those selected by mask.
+        """
+        units, values = self.units, self.values
+        if mask is not None:
+            units, values = units[mask], values[mask]
+        return value_counts_by_unit(units, values, self.n_units, len(self.categories))
+
+
+def is_skip(label):
+    try:
+        return int(label) < 0
+    except (TypeError, ValueError):
+        return False
+
+
+def read_annotations(path, level_of_measurement="interval", max_instances=None):
+    """
+    Streams a JSONL annotation file into an AnnotationData object. Skipped
+    annotations (negative labels) are counted but not used for agreement.
+    """
+    units, users, labels = [], [], []
+    n_units = 0
+    n_skipped = 0
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if max_instances is not None and n_units >= max_instances:
+                break
+            for a in ujson.loads(line)["annotations"]:
+                if is_skip(a["label"]):
+                    n_skipped += 1
+                    continue
+                units.append(n_units)
+                users.append(str(a["user"]))
+                labels.append(a["label"])
+            n_units += 1
+
+    # Nominal labels can be anything, but the other levels need numbers
+    if level_of_measurement == "nominal":
+        labels = [str(l) for l in labels]
+    else:
+        labels = [float(l) for l in labels]
+
+    if len(labels) == 0:
+        annotators, annotator_ids = np.zeros(0, dtype=int), np.array([])
+        values, categories = np.zeros(0, dtype=int), np.array([])
+    else:
+        annotators, annotator_ids = encode(users)
+        values, categories = encode(labels)
+
+    return AnnotationData(
+        np.asarray(units, dtype=int),
+        annotators,
+        values,
+        annotator_ids,
+        categories,
+        n_units,
+        level_of_measurement,
+        n_skipped,
+    )
+
+
+# Each worker process keeps its own copy of the data so that tasks only need to
+# send their (small) parameters
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _bootstrap_task(seed, n_samples):
+    data = _worker_data
+    counts = data.unit_counts().tocsr()
+    rng = np.random.default_rng(seed)
+    alphas = []
+    for _ in range(n_samples):
+        sample = rng.integers(0, data.n_units, data.n_units)
+        alphas.append(alpha_from_counts(counts[sample], data.categories, data.level_of_measurement))
+    return alphas
+
+
+def _leave_one_out_task(annotator):
+    data = _worker_data
+    counts = data.unit_counts(data.annotators != annotator)
+    return alpha_from_counts(counts, data.categories, data.level_of_measurement)
+
+
+def _pairwise_task(pairs):
+    data = _worker_data
+    alphas = []
+    for a, b in pairs:
+        counts = data.unit_counts((data.annotators == a) | (data.annotators == b))
+        alphas.append(alpha_from_counts(counts, data.categories, data.level_of_measurement))
+    return alphas
 
 
-def get_nans(shape):
-    ar = np.empty(shape)
-    ar[:] = np.NaN
-    return ar
+def _run(data, fn, tasks, processes):
+    """
+    Runs fn over the tasks, in a process pool if more than one process is
+    requested.
+    """
+    if len(tasks) == 0:
+        return []
 
+    if processes is None or processes > 1:
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(data,)) as pool:
+            return list(pool.map(fn, *zip(*tasks)))
 
-def flatten(annotations):
-    return [{a["user"]: a["label"] for a in ann} for ann in annotations]
+    _init_worker(data)
+    return [fn(*task) for task in tasks]
+
+
+def _chunk(items, n_chunks):
+    n_chunks = max(1, min(n_chunks, len(items)))
+    return [items[i::n_chunks] for i in range(n_chunks)]
+
+
+def _n_workers(processes):
+    return processes if processes is not None else (os.cpu_count() or 1)
+
+
+def alpha(data):
+    return alpha_from_counts(data.unit_counts(), data.categories, data.level_of_measurement)
+
+
+def bootstrap_alpha(data, n_samples=1000, confidence=0.95, processes=None, seed=None):
+    """
+    Estimates a confidence interval for alpha by resampling instances with
+    replacement.
+    """
+    n_tasks = _n_workers(processes) * 4
+    sizes = [len(c) for c in _chunk(list(range(n_samples)), n_tasks)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    alphas = np.array([
+        a for chunk in _run(data, _bootstrap_task, list(zip(seeds, sizes)), processes) for a in chunk
+    ])
+    alphas = alphas[~np.isnan(alphas)]
+    if len(alphas) == 0:
+        return {"samples": n_samples, "confidence": confidence, "lower": None, "upper": None}
+
+    tail = (1 - confidence) / 2 * 100
+    return {
+        "samples": n_samples,
+        "confidence": confidence,
+        "mean": float(alphas.mean()),
+        "lower": float(np.percentile(alphas, tail)),
+        "upper": float(np.percentile(alphas, 100 - tail)),
+    }
+
+
+def leave_one_out_alpha(data, processes=None):
+    """
+    Returns the alpha of the remaining annotators after dropping each annotator
+    in turn, along with how much dropping them changes the overall alpha.
+    """
+    overall = alpha(data)
+    annotators = list(range(len(data.annotator_ids)))
+    alphas = _run(data, _leave_one_out_task, [(a,) for a in annotators], processes)
+    n_annotations = np.bincount(data.annotators, minlength=len(annotators))
+    return {
+        str(data.annotator_ids[a]): {
+            "alpha": _nan_to_none(alphas[a]),
+            "delta": _nan_to_none(alphas[a] - overall),
+            "annotations": int(n_annotations[a]),
+        }
+        for a in annotators
+    }
+
+
+def pairwise_alpha(data, min_overlap=2, processes=None):
+    """
+    Returns alpha between every pair of annotators who labeled at least
+    min_overlap instances in common, as a nested annotator -> annotator dict.
+    """
+    n_annotators = len(data.annotator_ids)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(data.units)), (data.annotators, data.units)),
+        shape=(n_annotators, data.n_units),
+    )
+    incidence.data[:] = 1
+    overlap = sparse.triu(incidence @ incidence.T, k=1).tocoo()
+    keep = overlap.data >= min_overlap
+    pairs = list(zip(overlap.row[keep].tolist(), overlap.col[keep].tolist()))
+    overlaps = overlap.data[keep]
+
+    chunks = _chunk(pairs, _n_workers(processes) * 4)
+    alphas = dict(zip(
+        [p for chunk in chunks for p in chunk],
+        [a for result in _run(data, _pairwise_task, [(c,) for c in chunks], processes) for a in result],
+    ))
+
+    matrix = {}
+    for (a, b), n in zip(pairs, overlaps):
+        a_id, b_id = str(data.annotator_ids[a]), str(data.annotator_ids[b])
+        entry = {"alpha": _nan_to_none(alphas[(a, b)]), "overlap": int(n)}
+        matrix.setdefault(a_id, {})[b_id] = entry
+        matrix.setdefault(b_id, {})[a_id] = entry
+    return matrix
+
+
+def _nan_to_none(value):
+    return None if np.isnan(value) else float(value)
+
+
+def agreement_report(data, bootstrap=0, confidence=0.95, leave_one_out=True, pairwise=True,
+                     min_overlap=2, processes=None, seed=None):
+    """
+    Builds the full agreement report for the data as a JSON-serializable dict.
+    """
+    report = {
+        "level_of_measurement": data.level_of_measurement,
+        "instances": data.n_units,
+        "annotators": len(data.annotator_ids),
+        "annotations": len(data.units),
+        "skipped": data.n_skipped,
+        "alpha": _nan_to_none(alpha(data)),
+    }
+    if bootstrap > 0:
+        report["bootstrap"] = bootstrap_alpha(data, bootstrap, confidence, processes, seed)
+    if leave_one_out:
+        report["leave_one_out"] = leave_one_out_alpha(data, processes)
+    if pairwise:
+        report["pairwise"] = pairwise_alpha(data, min_overlap, processes)
+    return report
 
 
 def main(args):
-    with open(args.file, "r") as f:
-        annotations = [ujson.loads(line)["annotations"] for line in f]
-    users = set([a["user"] for ann in annotations for a in ann])
-    annotations = flatten(annotations)
-    annotations = annotations[:385]
-    data = [
-        [np.nan if user not in a or int(a[user]) == -1 else int(a[user]) for a in annotations]
-        for user in users
-    ]
-    skip_data = [
-        [np.nan if user not in a else int(a[user]) < 0 for a in annotations] for user in users
-    ]
-    labeled = ~np.isnan(data)
-    skipped = [
-        [False if user not in a else int(a[user]) < 0 for a in annotations] for user in users
-    ]
-    print("calculating over:")
-    for user, skip in zip(labeled, skipped):
-        print("labeled:", sum(user))
-        print("skipped:", sum(skip))
-    print(np.all(labeled, axis=0).sum())
-    print("rating agreement:")
-    print(simpledorff.calculate_krippendorffs_alpha(pd.DataFrame(data),metric_fn=interval_metric)) #use interval for rating for now
-    print("skip agreement:")
-    print(simpledorff.calculate_krippendorffs_alpha(pd.DataFrame(data),metric_fn=nominal_metric))
+    data = read_annotations(args.file, args.level, args.max_instances)
+    print("calculating over %d instances, %d annotators, %d annotations (%d skipped)" % (
+        data.n_units, len(data.annotator_ids), len(data.units), data.n_skipped))
+
+    report = agreement_report(
+        data,
+        bootstrap=args.bootstrap,
+        confidence=args.confidence,
+        leave_one_out=not args.no_leave_one_out,
+        pairwise=not args.no_pairwise,
+        min_overlap=args.min_overlap,
+        processes=args.processes,
+        seed=args.seed,
+    )
+    report["file"] = args.file
+
+    print("%s alpha: %s" % (data.level_of_measurement, report["alpha"]))
+    if "bootstrap" in report:
+        print("%d%% CI: [%s, %s]" % (
+            args.confidence * 100, report["bootstrap"]["lower"], report["bootstrap"]["upper"]))
+
     with open(args.outfile, "w") as f:
-        for row in zip(*data):
-            f.write(",".join([str(a) for a in row]) + "\n")
+        ujson.dump(report, f, indent=2)
+    print("report written to %s" % args.outfile)
 
 
 if __name__ == "__main__":
@@ -54,5 +312,30 @@ if __name__ == "__main__":
         description="Calculate Krippendorf's alpha from given JSON file of annotations"
     )
     parser.add_argument("file", help="path to JSON file")
-    parser.add_argument("outfile", help="write path to CSV")
+    parser.add_argument("outfile", help="write path to the JSON report")
+    parser.add_argument(
+        "--level",
+        choices=LEVELS_OF_MEASUREMENT,
+        default="interval",
+        help="level of measurement of the labels",
+    )
+    parser.add_argument(
+        "--max-instances", type=int, default=None, help="only use the first N instances"
+    )
+    parser.add_argument(
+        "--bootstrap", type=int, default=1000, help="number of bootstrap samples (0 to disable)"
+    )
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument(
+        "--min-overlap",
+        type=int,
+        default=2,
+        help="minimum shared instances for a pair of annotators to be compared",
+    )
+    parser.add_argument("--no-leave-one-out", action="store_true")
+    parser.add_argument("--no-pairwise", action="store_true")
+    parser.add_argument(
+        "--processes", type=int, default=None, help="worker processes (defaults to all CPUs)"
+    )
+    parser.add_argument("--seed", type=int, default=None)
     main(parser.parse_args())
@@ -1,6 +1,14 @@
 """
 Driver to run a flask server.
+
+The heavy dependencies (pandas, scikit-learn, BeautifulSoup, ...) are imported
+by the functions that use them, so the CLI commands that don't start the
+server, and servers that don't use a feature, don't pay for importing them.
 """
+import time
+
+IMPORT_START = time.perf_counter()
+
 from dataclasses import dataclass
 import os
 import re
@@ -10,20 +18,14 @@ import random
 import json
 from collections import deque, defaultdict, Counter, OrderedDict
 from itertools import zip_longest
-import string
 import threading
-import yaml
-
-import numpy as np
-import pandas as pd
-from tqdm import tqdm
-from sklearn.pipeline import Pipeline
-import simpledorff
-from simpledorff.metrics import nominal_metric, interval_metric
+import datetime
+import hmac
+import hashlib
 
 import flask
+import jinja2
 from flask import Flask, render_template, request
-from bs4 import BeautifulSoup
 import shutil
 
 cur_working_dir = os.getcwd() #get the current working dir
@@ -34,19 +36,32 @@ base_html_dir = os.path.join(cur_program_dir,'base_htmls') #get the dir where th
 #insert the current program dir into sys path
 sys.path.insert(0, cur_program_dir)
 
-from create_task_cli import create_task_cli, yes_or_no
 from server_utils.arg_utils import arguments
 from server_utils.config_module import init_config, config
-from server_utils.front_end import generate_site, generate_surveyflow_pages
-from server_utils.schemas.span import render_span_annotations
-from server_utils.cli_utlis import get_project_from_hub, show_project_hub
-from server_utils.prolific_apis import ProlificStudy
+from server_utils.front_end import generate_project_site
+from server_utils.schemas.span import (
+    render_span_annotations,
+    parse_html_span_annotation,
+    validate_span_annotations,
+)
 from server_utils.json import easy_json
+from server_utils.keyword_highlights import KeywordHighlighter, render_highlights
+from server_utils.displayed_text import DisplayedTextRenderer
+from server_utils.metrics import MetricsRegistry
+from server_utils.profiling import RequestProfiler
+from server_utils.log_utils import event_extra, setup_logging
+from server_utils.export import AnnotationExporter, make_record, stream_records
+from server_utils.timing import StartupTimer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig()
 
+# How long importing this module and each phase of starting up took, reported
+# with --timing
+startup_timer = StartupTimer()
+startup_timer.add("import potato.flask_server", time.perf_counter() - IMPORT_START)
+
 
 
 random.seed(0)
@@ -72,6 +87,20 @@ instance_id_to_data = {}
 # A global dict to keep tracking of the task assignment status
 task_assignment = {}
 
+# A reverse index of task_assignment["assigned"] from each user to the ids of the
+# instances assigned to them, so that dropping a user only touches their own
+# assignments. Use add_task_assignment() to assign instances to keep it in sync
+user_to_assigned_instance_ids = defaultdict(set)
+
+# The UserAnnotationState of every user who has been dropped, keyed by username
+archived_users = {}
+
+# Guards task_assignment, user_to_assigned_instance_ids and the creation and
+# removal of user states, which are changed both by the requests that assign
+# instances and by the thread that drops prolific users. It is reentrant as
+# assigning instances looks up the user's state
+assignment_lock = threading.RLock()
+
 # path to save user information
 USER_CONFIG_PATH = "user_config.json"
 DEFAULT_LABELS_PER_INSTANCE = 3
@@ -81,6 +110,20 @@ DEFAULT_LABELS_PER_INSTANCE = 3
 # learning, such as which instances were sampled according to each strategy
 active_learning_state = None
 
+# A running total of the finished instances across all users. This is kept up to
+# date by UserAnnotationState so we never need to scan every user to count
+total_annotation_count = 0
+annotation_count_lock = threading.Lock()
+
+# The ProlificStudy of the task, if it is run on prolific. Its status is kept up
+# to date in the background by the ProlificWorkloadController
+prolific_study = None
+prolific_workload_controller = None
+
+# Keeps the coincidence counts of each schema up to date as labels change so
+# that agreement can be reported live. This is set up in run_server()
+agreement_tracker = None
+
 # Hacky nonsense
 schema_label_to_color = {}
 
@@ -95,6 +138,66 @@ class HighlightSchema:
 
 emphasis_corpus_to_schemas = defaultdict(set)
 
+# Finds the keywords of emphasis_corpus_to_schemas in each instance. This is set
+# up by load_all_data() if a keyword_highlights_file is configured
+keyword_highlighter = None
+
+# Renders the displayed text of each instance the first time it is shown
+displayed_text_renderer = None
+
+# Users who loaded a page within this many seconds count as active
+ACTIVE_USER_WINDOW = 300
+
+# The last time each user loaded a page, for the active users gauge
+user_last_seen = {}
+
+# The metrics served at /metrics. The gauges are computed when they are scraped
+metrics = MetricsRegistry()
+request_latency = metrics.histogram(
+    "potato_request_duration_seconds", "Latency of the requests to each route", ["route", "method"]
+)
+request_errors = metrics.counter(
+    "potato_request_errors_total", "Requests to each route that returned an error status", ["route", "status"]
+)
+stage_latency = metrics.histogram(
+    "potato_stage_duration_seconds", "Time spent in each stage of handling annotations", ["stage"]
+)
+metrics.gauge(
+    "potato_active_users",
+    "Users who loaded a page in the last %d seconds" % ACTIVE_USER_WINDOW,
+    lambda: sum(1 for t in list(user_last_seen.values()) if t > time.time() - ACTIVE_USER_WINDOW),
+)
+metrics.gauge("potato_users", "Users with an annotation state", lambda: get_total_user_count())
+metrics.gauge("potato_finished_users", "Users who finished their instances", lambda: get_finished_user_count())
+metrics.gauge("potato_unassigned_labels", "Labels still to be assigned", lambda: get_unassigned_count())
+metrics.gauge("potato_annotations", "Annotations made across all users", lambda: get_total_annotations())
+metrics.gauge(
+    "potato_log_queue_depth",
+    "Log records waiting to be written",
+    lambda: log_listener.queue.qsize() if log_listener is not None else 0,
+)
+metrics.gauge(
+    "potato_export_queue_depth",
+    "Annotation exports running or waiting to run",
+    lambda: annotation_exporter.get_queue_depth() if annotation_exporter is not None else 0,
+)
+metrics.gauge(
+    "potato_export_pending_changes",
+    "Annotations changed since the last export",
+    lambda: annotation_exporter.get_pending_change_count() if annotation_exporter is not None else 0,
+)
+
+# Writes annotated_instances.<format> with everyone's annotations. This is set
+# up by init_server()
+annotation_exporter = None
+
+# Writes the queued log records. This is set up by init_server()
+log_listener = None
+
+# Profiles slow and sampled requests if request_profiling is configured. This
+# is set up by init_server()
+request_profiler = None
+
 # Response Highlight Class
 @dataclass(frozen=True)
 class SuggestedResponse:
@@ -241,6 +344,35 @@ class ActiveLearningState:
         self.id_to_update_round = {}
         self.cur_round = 0
 
+        # The instance ordering published by the most recent round. Users get
+        # their remaining instances re-ordered according to this list
+        self.published_ordering = []
+
+        # The round whose ordering each user's queue currently reflects, so we
+        # only re-order users that are behind
+        self.user_to_round = {}
+
+        # One entry per round with when it ran, how much data it used and how
+        # long each stage took
+        self.round_history = []
+
+        # The last multiple of update_rate for which a round was triggered
+        self.last_update_boundary = 0
+        self.boundary_lock = threading.Lock()
+
+    def claim_update_boundary(self, total_annotations, update_rate):
+        """
+        Returns True the first time the total number of annotations reaches or
+        passes a new multiple of update_rate, so that each boundary triggers at
+        most one round even if the count jumps past it.
+        """
+        boundary = total_annotations // update_rate
+        with self.boundary_lock:
+            if boundary <= self.last_update_boundary:
+                return False
+            self.last_update_boundary = boundary
+            return True
+
     def update_selection_types(self, id_to_selection_type):
         self.cur_round += 1
 
@@ -248,6 +380,54 @@ class ActiveLearningState:
             self.id_to_selection_type[iid] = st
             self.id_to_update_round[iid] = self.cur_round
 
+    def publish_round(self, new_id_order, id_to_selection_type, round_metrics):
+        """
+        Records the outcome of an active learning round as the new ordering
+        that all users should follow.
+        """
+        self.update_selection_types(id_to_selection_type)
+        self.published_ordering = new_id_order
+        round_metrics["round"] = self.cur_round
+        self.round_history.append(round_metrics)
+
+    def is_user_current(self, username):
+        return self.user_to_round.get(username) == self.cur_round
+
+    def mark_user_current(self, username):
+        self.user_to_round[username] = self.cur_round
+
+    def save(self, path):
+        state = {
+            "cur_round": self.cur_round,
+            "id_to_selection_type": self.id_to_selection_type,
+            "id_to_update_round": self.id_to_update_round,
+            "published_ordering": self.published_ordering,
+            "user_to_round": self.user_to_round,
+            "round_history": self.round_history,
+            "last_update_boundary": self.last_update_boundary,
+        }
+        # Write to a temporary file first so a crash mid-write never leaves a
+        # truncated state file behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wt") as outf:
+            json.dump(state, outf)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rt") as f:
+            state = json.load(f)
+
+        al_state = cls()
+        al_state.cur_round = state["cur_round"]
+        al_state.id_to_selection_type = state["id_to_selection_type"]
+        al_state.id_to_update_round = state["id_to_update_round"]
+        al_state.published_ordering = state["published_ordering"]
+        al_state.user_to_round = state["user_to_round"]
+        al_state.round_history = state["round_history"]
+        al_state.last_update_boundary = state.get("last_update_boundary", 0)
+        return al_state
+
 
 class UserAnnotationState:
     """
@@ -275,6 +455,10 @@ class UserAnnotationState:
         # behavioral information (e.g. time, click, ..)
         self.instance_id_to_behavioral_data = {}
 
+        # The time (in seconds since the epoch) each instance's annotations
+        # were last changed
+        self.instance_id_to_update_time = {}
+
         # NOTE: this might be dumb but at the moment, we cache the order in
         # which this user will walk the instances. This might not work if we're
         # annotating a ton of things with a lot of people, but hopefully it's
@@ -299,6 +483,10 @@ class UserAnnotationState:
         # Total annotation instances assigned to a user
         self.real_instance_assigned_count = 0
 
+        # The core annotation instances (not survey pages) this user has
+        # finished, kept in sync with the labels and spans
+        self.finished_instance_ids = set()
+
     def generate_id_order_mapping(self, instance_id_ordering):
         id_order_mapping = {}
         for i in range(len(instance_id_ordering)):
@@ -420,10 +608,18 @@ class UserAnnotationState:
         """
         Check the number of finished instances for a user (only the core annotation parts)
         """
-        finished_instances = [it for it in self.instance_id_to_labeling if it[-4:]!='html']
-        finished_span_instances = [it for it in self.instance_id_to_span_annotations if (it[-4:] != 'html' and len(self.instance_id_to_span_annotations[it])!=0)]
+        return len(self.finished_instance_ids)
 
-        return len(set(finished_instances + finished_span_instances))
+    def is_finished_instance(self, instance_id):
+        """
+        Check if the user has labeled the instance or annotated spans in it
+        (only the core annotation parts)
+        """
+        if instance_id[-4:] == 'html':
+            return False
+        return instance_id in self.instance_id_to_labeling or (
+            len(self.instance_id_to_span_annotations.get(instance_id, [])) != 0
+        )
 
     def set_annotation(
         self, instance_id, schema_to_label_to_value, span_annotations, behavioral_data_dict
@@ -444,6 +640,9 @@ class UserAnnotationState:
         if instance_id in self.instance_id_to_labeling:
             old_annotation = self.instance_id_to_labeling[instance_id]
 
+        if agreement_tracker is not None and old_annotation != schema_to_label_to_value:
+            agreement_tracker.update(instance_id, old_annotation, schema_to_label_to_value)
+
         old_span_annotations = []
         if instance_id in self.instance_id_to_span_annotations:
             old_span_annotations = self.instance_id_to_span_annotations[instance_id]
@@ -464,6 +663,16 @@ class UserAnnotationState:
         elif instance_id in self.instance_id_to_span_annotations:
             del self.instance_id_to_span_annotations[instance_id]
 
+        # Keep the finished instances and the global total up to date
+        was_finished = instance_id in self.finished_instance_ids
+        is_finished = self.is_finished_instance(instance_id)
+        if is_finished != was_finished:
+            if is_finished:
+                self.finished_instance_ids.add(instance_id)
+            else:
+                self.finished_instance_ids.discard(instance_id)
+            update_total_annotations(1 if is_finished else -1)
+
         # TODO: keep track of all the annotation behaviors instead of only
         # keeping the latest one each time when new annotation is updated,
         # we also update the behavioral_data_dict (currently done in the
@@ -499,10 +708,16 @@ class UserAnnotationState:
 
             self.instance_id_to_labeling[inst_id] = label_annotations
             self.instance_id_to_span_annotations[inst_id] = span_annotations
+            if agreement_tracker is not None:
+                agreement_tracker.update(inst_id, None, label_annotations)
 
             behavior_dict = inst.get("behavioral_data", {})
             self.instance_id_to_behavioral_data[inst_id] = behavior_dict
 
+            # states saved before the update times were kept don't have them
+            if "update_time" in inst:
+                self.instance_id_to_update_time[inst_id] = inst["update_time"]
+
             # TODO: move this code somewhere else so consent is organized
             # separately
             if re.search("consent", inst_id):
@@ -514,6 +729,12 @@ class UserAnnotationState:
         self.instance_id_ordering = annotation_order
         self.instance_id_to_order = self.generate_id_order_mapping(self.instance_id_ordering)
 
+        old_finished_count = len(self.finished_instance_ids)
+        self.finished_instance_ids = set(
+            inst["id"] for inst in annotated_instances if self.is_finished_instance(inst["id"])
+        )
+        update_total_annotations(len(self.finished_instance_ids) - old_finished_count)
+
         # Set the current item to be the one after the last thing that was
         # annotated
         # self.instance_cursor = min(len(self.instance_id_to_labeling),
@@ -537,10 +758,24 @@ class UserAnnotationState:
         # to ensure all items get the same number of annotations (otherwise
         # these items might get re-ordered farther away)
         new_order = [iid for iid in self.instance_id_ordering if iid in preserve_order]
+        placed = set(new_order)
 
-        # Now add all the other IDs
+        # Now add all the other IDs that this user has been assigned. The
+        # ordering may be from an earlier round, so skip anything that has
+        # been annotated since it was published
         for iid in new_id_order:
-            if iid not in self.instance_id_to_labeling:
+            if (
+                iid in self.instance_id_to_order
+                and iid not in placed
+                and iid not in self.instance_id_to_labeling
+            ):
+                new_order.append(iid)
+                placed.add(iid)
+
+        # Anything the ordering didn't cover keeps its relative position at
+        # the end of the queue
+        for iid in self.instance_id_ordering:
+            if iid not in placed:
                 new_order.append(iid)
 
         assert len(new_order) == len(self.instance_id_ordering)
@@ -610,6 +845,8 @@ def load_all_data(config):
 
     # Hacky nonsense
     global emphasis_corpus_to_schemas
+    global keyword_highlighter
+    global displayed_text_renderer
 
     # Where to look in the JSON item object for the text to annotate
     text_key = config["item_properties"]["text_key"]
@@ -643,6 +880,8 @@ def load_all_data(config):
                     instance_id_to_data[instance_id] = item
 
         else:
+            import pandas as pd
+
             sep = "," if fmt == "csv" else "\t"
             # Ensure the key is loaded as a string form (prevents weirdness
             # later)
@@ -697,28 +936,35 @@ def load_all_data(config):
         instance_id_to_data.update({page['id']: item})
         instance_id_to_data.move_to_end(page['id'], last=True)
 
-    # Generate the text to display in instance_id_to_data
-    for inst_id in instance_id_to_data:
-        instance_id_to_data[inst_id]["displayed_text"] = get_displayed_text(
-            instance_id_to_data[inst_id][config["item_properties"]["text_key"]]
-        )
+    # The text to display for each instance is rendered lazily by get_displayed_text()
+    displayed_text_renderer = DisplayedTextRenderer(config.get("list_as_text"))
 
     # TODO: make this fully configurable somehow...
     if "keyword_highlights_file" in config:
         kh_file = config["keyword_highlights_file"]
         logger.debug("Loading keyword highlighting from %s" % (kh_file))
 
-        with open(kh_file, "rt") as f:
-            # TODO: make it flexible based on keyword
-            df = pd.read_csv(kh_file, sep="\t")
-            for i, row in df.iterrows():
-                emphasis_corpus_to_schemas[row["Word"]].add(
-                    HighlightSchema(row["Schema"], row["Label"])
-                )
+        # The optional Type column says whether each Word is a "word", a
+        # "phrase" or a "regex", otherwise the type is inferred from the Word
+        import pandas as pd
+
+        df = pd.read_csv(kh_file, sep="\t")
+        pattern_types = {}
+        if "Type" in df:
+            pattern_types = {w: t for w, t in zip(df["Word"], df["Type"]) if isinstance(t, str)}
+        for word, label, schema in zip(df["Word"], df["Label"], df["Schema"]):
+            emphasis_corpus_to_schemas[word].add(HighlightSchema(label=label, schema=schema))
+
+        # The matches of each instance are found lazily when it is first shown
+        keyword_highlighter = KeywordHighlighter(
+            emphasis_corpus_to_schemas,
+            pattern_types=pattern_types,
+            cache_size=config.get("keyword_highlights_cache_size", 10000),
+        )
 
         logger.debug(
-            "Loaded %d regexes to map to %d labels for dynamic highlighting"
-            % (len(emphasis_corpus_to_schemas), i)
+            "Loaded %d keywords, phrases and regexes to map to %d labels for dynamic highlighting"
+            % (len(emphasis_corpus_to_schemas), len(df[["Label", "Schema"]].drop_duplicates()))
         )
 
     # Load the annotation assignment info if automatic task assignment is on.
@@ -734,6 +980,7 @@ def load_all_data(config):
             # load the task assignment if it has been generated and saved
             with open(task_assignment_path, "r") as r:
                 task_assignment = json.load(r)
+            build_user_assignment_index()
         else:
             # Otherwise generate a new task assignment dict
             task_assignment = {
@@ -775,6 +1022,30 @@ def load_all_data(config):
                 )
 
 
+def add_task_assignment(instance_id, username):
+    """
+    Records that an instance has been assigned to a user.
+    """
+    if instance_id not in task_assignment["assigned"]:
+        task_assignment["assigned"][instance_id] = []
+    task_assignment["assigned"][instance_id].append(username)
+    user_to_assigned_instance_ids[username].add(instance_id)
+
+
+def build_user_assignment_index():
+    """
+    Rebuilds user_to_assigned_instance_ids from task_assignment["assigned"],
+    e.g., after the task assignment is loaded from disk.
+    """
+    user_to_assigned_instance_ids.clear()
+    for inst_id, users in task_assignment["assigned"].items():
+        # pages such as the surveyflow ones are not assigned to specific users
+        if type(users) != list:
+            continue
+        for u in users:
+            user_to_assigned_instance_ids[u].add(inst_id)
+
+
 def convert_labels(annotation, schema_type):
     if schema_type == "likert":
         return int(list(annotation.keys())[0][6:])
@@ -786,7 +1057,9 @@ def convert_labels(annotation, schema_type):
         return float(annotation['text_box'])
     if schema_type == 'textbox':
         return annotation['text_box']
-    print("Unrecognized schema_type %s" % schema_type)
+    logger.warning(
+        "Unrecognized schema_type %s", schema_type, extra=event_extra("agreement", schema_type=schema_type)
+    )
     return None
 
 
@@ -794,26 +1067,35 @@ def get_agreement_score(user_list, schema_name, return_type="overall_average"):
     """
     Get the final agreement score for selected users and schemas.
     """
-    global user_to_annotation_state
+    import numpy as np
 
-    if user_list == "all":
-        user_list = user_to_annotation_state.keys()
+    global user_to_annotation_state
 
     name2alpha = {}
     if schema_name == "all":
         for i in range(len(config["annotation_schemes"])):
             schema = config["annotation_schemes"][i]
-            alpha = cal_agreement(user_list, schema["name"])
+            # The tracker has the live agreement across all users, so only
+            # recompute from scratch for a subset of users
+            if user_list == "all" and agreement_tracker is not None:
+                alpha = agreement_tracker.alpha(schema["name"])
+            else:
+                alpha = cal_agreement(
+                    user_to_annotation_state.keys() if user_list == "all" else user_list,
+                    schema["name"],
+                )
             name2alpha[schema["name"]] = alpha
 
     alpha_list = []
     if return_type == "overall_average":
         for name in name2alpha:
             alpha = name2alpha[name]
+            # Skip labels where alpha is undefined (e.g. no overlapping annotations)
             if isinstance(alpha, dict):
-                average_alpha = sum([it[1] for it in list(alpha.items())]) / len(alpha)
-                alpha_list.append(average_alpha)
-            elif isinstance(alpha, (np.floating, float)):
+                defined = [it[1] for it in list(alpha.items()) if not np.isnan(it[1])]
+                if len(defined) > 0:
+                    alpha_list.append(sum(defined) / len(defined))
+            elif isinstance(alpha, (np.floating, float)) and not np.isnan(alpha):
                 alpha_list.append(alpha)
             else:
                 continue
@@ -828,6 +1110,10 @@ def cal_agreement(user_list, schema_name, schema_type=None, selected_keys=None):
     """
     Calculate the krippendorff's alpha for selected users and schema.
     """
+    import numpy as np
+    from scipy import sparse
+    from server_utils.krippendorff import alpha_from_pairs, multilabel_alpha
+
     global user_to_annotation_state
 
     # get the schema_type/annotation_type from the config file
@@ -842,13 +1128,20 @@ def cal_agreement(user_list, schema_name, schema_type=None, selected_keys=None):
     user_annotation_list = []
     for user in user_list:
         if user not in user_to_annotation_state:
-            print("%s not found in user_to_annotation_state" % user)
+            logger.warning(
+                "%s not found in user_to_annotation_state",
+                user,
+                extra=event_extra("agreement", username=user),
+            )
         user_annotated_ids = user_to_annotation_state[user].instance_id_to_labeling.keys()
-        union_keys = union_keys | user_annotated_ids
+        union_keys.update(user_annotated_ids)
         user_annotation_list.append(user_to_annotation_state[user].instance_id_to_labeling)
 
     if len(user_annotation_list) < 2:
-        print("Cannot calculate agreement score for less than 2 users")
+        logger.info(
+            "Cannot calculate agreement score for less than 2 users",
+            extra=event_extra("agreement", schema=schema_name),
+        )
         return None
 
     # only calculate the agreement for selected keys when selected_keys is specified
@@ -856,25 +1149,30 @@ def cal_agreement(user_list, schema_name, schema_type=None, selected_keys=None):
         selected_keys = list(union_keys)
 
     if len(selected_keys) == 0:
-        print(
-            "Cannot calculate agreement score when annotators work on different sets of instances"
+        logger.info(
+            "Cannot calculate agreement score when annotators work on different sets of instances",
+            extra=event_extra("agreement", schema=schema_name),
         )
         return None
 
+    # Map each selected instance to a unit index and only visit the annotations
+    # users actually made, rather than every (user, instance) cell
+    key_to_unit = {key: i for i, key in enumerate(selected_keys)}
+
     if schema_type in ["radio", "likert"]:
-        distance_metric_dict = {"radio": nominal_metric, "likert": interval_metric}
-        # initialize agreement data matrix
-        l = []
-        for _ in range(len(user_annotation_list)):
-            l.append([np.nan] * len(selected_keys))
-
-        for i, _selected_key in enumerate(selected_keys):
-            for j in range(len(l)):
-                if _selected_key in user_annotation_list[j]:
-                    l[j][i] = convert_labels(
-                        user_annotation_list[j][_selected_key][schema_name], schema_type
-                    )
-        alpha = simpledorff.calculate_krippendorffs_alpha(pd.DataFrame(np.array(l)),metric_fn=distance_metric_dict[schema_type])
+        # The schema can override the default level of measurement (e.g. to
+        # treat a likert scale as ordinal)
+        level_of_measurement = schema.get(
+            "agreement_level", {"radio": "nominal", "likert": "interval"}[schema_type]
+        )
+        units, values = [], []
+        for user_annotations in user_annotation_list:
+            for _selected_key, annotation in user_annotations.items():
+                if _selected_key in key_to_unit and schema_name in annotation:
+                    units.append(key_to_unit[_selected_key])
+                    values.append(convert_labels(annotation[schema_name], schema_type))
+
+        alpha = alpha_from_pairs(units, values, level_of_measurement)
 
         return alpha
 
@@ -886,33 +1184,33 @@ def cal_agreement(user_list, schema_name, schema_type=None, selected_keys=None):
         elif isinstance(schema["labels"][0], str):
             labels = schema["labels"]
         else:
-            print("Unknown label type in schema['labels']")
+            logger.warning(
+                "Unknown label type in schema['labels']", extra=event_extra("agreement", schema=schema_name)
+            )
             return None
-
-        # initialize agreement data matrix for each label
-        l_dict = {}
-        for l in labels:
-            l_dict[l] = []
-            for i in range(len(user_annotation_list)):
-                l_dict[l].append([np.nan] * len(selected_keys))
-
-        # consider binary agreement for each label in the multi-label schema
-        for i, _selected_key in enumerate(selected_keys):
-            for j in range(len(user_annotation_list)):
-                if (_selected_key in user_annotation_list[j]) and (
-                    schema_name in user_annotation_list[j][_selected_key]
-                ):
-                    annotations = convert_labels(
-                        user_annotation_list[j][_selected_key][schema_name], schema_type
-                    )
-                    for l in labels:
-                        l_dict[l][j][i] = 1
-                        if l not in annotations:
-                            l_dict[l][j][i] = 0
+        label_to_index = {l: i for i, l in enumerate(labels)}
+
+        # consider binary agreement for each label in the multi-label schema:
+        # each annotation is a row with a 1 for every selected label
+        units, rows, cols = [], [], []
+        for user_annotations in user_annotation_list:
+            for _selected_key, annotation in user_annotations.items():
+                if _selected_key in key_to_unit and schema_name in annotation:
+                    row = len(units)
+                    units.append(key_to_unit[_selected_key])
+                    for l in convert_labels(annotation[schema_name], schema_type):
+                        if l in label_to_index:
+                            rows.append(row)
+                            cols.append(label_to_index[l])
+
+        label_matrix = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(units), len(labels))
+        )
+        alphas = multilabel_alpha(units, label_matrix)
 
         alpha_dict = {}
         for key in labels:
-            alpha_dict[key] = simpledorff.calculate_krippendorffs_alpha(pd.DataFrame(np.array(l_dict[key])),metric_fn=nominal_metric)
+            alpha_dict[key] = float(alphas[label_to_index[key]])
         return alpha_dict
 
 
@@ -963,12 +1261,30 @@ def get_total_annotations():
     """
     Returns the total number of unique annotations done across all users.
     """
-    total = 0
-    for username in get_users():
-        user_state = lookup_user_state(username)
-        total += user_state.get_real_finished_instance_count()
+    return total_annotation_count
+
+
+def forget_user_annotations(user_state):
+    """
+    Removes a user's annotations from the global annotation count and the
+    agreement tracker, e.g., when the user is dropped or their state is
+    reloaded from disk.
+    """
+    update_total_annotations(-user_state.get_real_finished_instance_count())
+    if agreement_tracker is not None:
+        for inst_id, labels in user_state.instance_id_to_labeling.items():
+            agreement_tracker.update(inst_id, labels, None)
 
-    return total
+
+def update_total_annotations(delta):
+    """
+    Adds delta to the running total of annotations and returns the new total.
+    """
+    global total_annotation_count
+
+    with annotation_count_lock:
+        total_annotation_count += delta
+        return total_annotation_count
 
 
 def update_annotation_state(username, form):
@@ -1014,10 +1330,26 @@ def update_annotation_state(username, form):
             schema_to_label_to_value[annotation_schema][annotation_label] = annotation_value
 
 
-    # Span annotations are a bit funkier since we're getting raw HTML that
-    # we need to post-process on the server side.
+    # The front end posts the offsets and labels of the span annotations, which
+    # are checked against the text the user saw
     span_annotations = []
-    if "span-annotation" in form:
+    if "span-annotations" in form:
+        try:
+            posted_spans = json.loads(form["span-annotations"])
+        except ValueError:
+            logger.warning("Could not parse the span annotations of %s on %s" % (username, instance_id))
+            posted_spans = []
+        if instance_id in instance_id_to_data:
+            span_schemas = set(
+                s["name"] for s in config["annotation_schemes"] if s["annotation_type"] == "highlight"
+            )
+            span_annotations = validate_span_annotations(
+                get_displayed_text(instance_id, username), posted_spans, span_schemas
+            )
+
+    # Templates from before the front end posted offsets send the raw HTML of
+    # the instance, which we need to post-process on the server side.
+    elif "span-annotation" in form:
         span_annotation_html = form["span-annotation"]
         span_text, span_annotations = parse_html_span_annotation(span_annotation_html)
 
@@ -1028,6 +1360,7 @@ def update_annotation_state(username, form):
     # update the behavioral information regarding time only when the annotations are changed
     if did_change:
         user_state.instance_id_to_behavioral_data[instance_id] = behavioral_data_dict
+        user_state.instance_id_to_update_time[instance_id] = time.time()
 
         # todo: we probably need a more elegant way to check the status of user consent
         # when the user agreed to participate, try to assign
@@ -1040,7 +1373,15 @@ def update_annotation_state(username, form):
 
         # when the user is working on prestudy, check the status
         if re.search("prestudy", instance_id):
-            print(check_prestudy_status(username))
+            logger.info(
+                "prestudy status of %s: %s",
+                username,
+                check_prestudy_status(username),
+                extra=event_extra("prestudy", username=username),
+            )
+
+        if annotation_exporter is not None:
+            annotation_exporter.mark_changed(username, instance_id)
 
     return did_change
 
@@ -1106,12 +1447,139 @@ def write_data(username):
     raise RuntimeError("This function is deprecated?")
 
 
+@app.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+    if request_profiler is not None:
+        flask.g.request_sampled = request_profiler.start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start" in flask.g:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        duration = time.perf_counter() - flask.g.request_start
+        request_latency.observe(duration, route, request.method)
+        if response.status_code >= 400:
+            request_errors.inc(route, str(response.status_code))
+        if request_profiler is not None and "request_sampled" in flask.g:
+            request_profiler.stop(
+                flask.g.request_sampled,
+                duration,
+                request.method + route,
+                flask.g.get("username"),
+                flask.g.get("instance_id"),
+            )
+    return response
+
+
+@app.teardown_request
+def stop_request_profiling(exc):
+    # after_request is skipped when a request fails, so make sure its thread
+    # is no longer sampled
+    if request_profiler is not None:
+        request_profiler.sampler.unregister(threading.get_ident())
+
+
+@app.route("/metrics")
+def metrics_page():
+    """
+    Serves the server's metrics in the Prometheus text format.
+    """
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def parse_timestamp(value):
+    """
+    Parses a timestamp given as seconds since the epoch or in ISO 8601 format,
+    and returns it in seconds since the epoch.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    timestamp = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return timestamp.timestamp()
+
+
+@app.route("/api/annotations")
+def export_annotations_page():
+    """
+    Streams the annotations in the user states as JSONL (the default) or
+    CSV/TSV, without writing a file. The request needs the admin_api_key of the
+    config as a bearer token, and can filter the annotations with:
+
+    - user: only these users (can be repeated)
+    - schema: only the labels and spans of these schemas (can be repeated)
+    - since: only the annotations changed since this time, in seconds since
+      the epoch or ISO 8601
+    - from_instance, to_instance: only the instances between these two (both
+      included) in the order of the data files
+    """
+    api_key = config.get("admin_api_key")
+    if not api_key:
+        return flask.Response("The annotations API is not enabled\n", status=404, mimetype="text/plain")
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), ("Bearer " + str(api_key)).encode()):
+        return flask.Response("Invalid API key\n", status=401, mimetype="text/plain")
+
+    fmt = request.args.get("format", "jsonl")
+    if fmt not in ("jsonl", "csv", "tsv"):
+        return flask.Response("Unsupported format: %s\n" % fmt, status=400, mimetype="text/plain")
+
+    users = set(request.args.getlist("user"))
+    schemas = set(request.args.getlist("schema"))
+    since = None
+    if request.args.get("since"):
+        try:
+            since = parse_timestamp(request.args["since"])
+        except ValueError:
+            return flask.Response("Invalid since: %s\n" % request.args["since"], status=400, mimetype="text/plain")
+
+    # the positions of the instances, for filtering a range of them
+    positions = None
+    from_instance = request.args.get("from_instance")
+    to_instance = request.args.get("to_instance")
+    if from_instance is not None or to_instance is not None:
+        positions = {instance_id: i for i, instance_id in enumerate(instance_id_to_data)}
+        for instance_id in (from_instance, to_instance):
+            if instance_id is not None and instance_id not in positions:
+                return flask.Response("Unknown instance: %s\n" % instance_id, status=400, mimetype="text/plain")
+        first = positions[from_instance] if from_instance is not None else 0
+        last = positions[to_instance] if to_instance is not None else len(positions) - 1
+
+    def iter_records():
+        for user_id, user_state in list(user_to_annotation_state.items()):
+            if users and user_id not in users:
+                continue
+            for instance_id, annotations in user_state.get_all_annotations().items():
+                update_time = user_state.instance_id_to_update_time.get(instance_id)
+                if since is not None and (update_time is None or update_time < since):
+                    continue
+                if positions is not None and not first <= positions.get(instance_id, -1) <= last:
+                    continue
+                if schemas:
+                    spans = annotations["spans"] if isinstance(annotations["spans"], list) else []
+                    annotations = {
+                        "labels": {k: v for k, v in annotations["labels"].items() if k in schemas},
+                        "spans": [span for span in spans if span.get("schema") in schemas],
+                    }
+                    if not annotations["labels"] and not annotations["spans"]:
+                        continue
+                record = make_record(user_id, user_state, instance_id, annotations, get_displayed_text)
+                record["update_time"] = update_time
+                yield record
+
+    mimetypes = {"jsonl": "application/x-ndjson", "csv": "text/csv", "tsv": "text/tab-separated-values"}
+    return flask.Response(flask.stream_with_context(stream_records(iter_records, fmt)), mimetype=mimetypes[fmt])
+
+
 @app.route("/")
 def home():
     global user_config
 
     if config["__debug__"]:
-        print("debug user logging in")
+        logger.debug("debug user logging in", extra=event_extra("login", username="debug_user"))
         return annotate_page("debug_user", action="home")
     if "login" in config:
 
@@ -1123,7 +1591,12 @@ def home():
                 if type(url_arguments) == str:
                     url_arguments = [url_arguments]
                 username = '&'.join([request.args.get(it) for it in url_arguments])
-                print("url direct logging in with %s=%s" % ('&'.join(url_arguments),username))
+                logger.info(
+                    "url direct logging in with %s=%s",
+                    '&'.join(url_arguments),
+                    username,
+                    extra=event_extra("login", login_type="url_direct", username=username),
+                )
                 return annotate_page(username, action="home")
             elif config["login"]["type"] == "prolific":
                 #we force the order of the url_arguments for prolific logins, so that we can easily retrieve
@@ -1134,21 +1607,31 @@ def home():
                 # a combination of PROLIFIC_PID and SESSION id
                 url_arguments = ['PROLIFIC_PID']
                 username = '&'.join([request.args.get(it) for it in url_arguments])
-                print("prolific logging in with %s=%s" % ('&'.join(url_arguments),username))
+                logger.info(
+                    "prolific logging in with %s=%s",
+                    '&'.join(url_arguments),
+                    username,
+                    extra=event_extra("login", login_type="prolific", username=username),
+                )
 
                 # check if the provided study id is the same as the study id defined in prolific configuration file, if not,
                 # pause the studies and terminate the program
                 if request.args.get('STUDY_ID') != prolific_study.study_id:
-                    print('ERROR: Study id (%s) does not match the study id in %s (%s), trying to pause the prolific study, \
-                          please check if study id is defined correctly on the server or if the study link if provided correctly \
-                          on prolific'%(request.args.get('STUDY_ID'),
-                         config['prolific']['config_file_path'], prolific_study.study_id))
+                    logger.error(
+                        "Study id (%s) does not match the study id in %s (%s), trying to pause the prolific study, "
+                        "please check if study id is defined correctly on the server or if the study link if provided "
+                        "correctly on prolific",
+                        request.args.get('STUDY_ID'),
+                        config['prolific']['config_file_path'],
+                        prolific_study.study_id,
+                        extra=event_extra("prolific", username=username),
+                    )
                     prolific_study.pause_study(study_id=request.args.get('STUDY_ID'))
                     prolific_study.pause_study(study_id=prolific_study.study_id)
                     quit()
 
                 return annotate_page(username, action="home")
-            print("password logging in")
+            logger.debug("password logging in", extra=event_extra("login", login_type="password"))
             return render_template("home.html", title=config["annotation_task_name"])
 
         except:
@@ -1156,7 +1639,7 @@ def home():
                 "error.html",
                 error_message="Please login to annotate or you are using the wrong link",
             )
-    print("password logging in")
+    logger.debug("password logging in", extra=event_extra("login", login_type="password"))
     return render_template("home.html", title=config["annotation_task_name"])
 
 
@@ -1185,7 +1668,7 @@ def login():
             or user_config.is_valid_password(username, password)
         ):
             # if surveyflow is setup, jump to the page before annotation
-            print("%s login successful" % username)
+            logger.info("%s login successful", username, extra=event_extra("login", username=username))
             return annotate_page(username)
         return render_template(
             "home.html",
@@ -1193,7 +1676,7 @@ def login():
             login_email=username,
             login_error="Invalid username or password",
         )
-    print("unknown action at home page")
+    logger.warning("unknown action at home page: %s", action, extra=event_extra("login"))
     return render_template("home.html", title=config["annotation_task_name"])
 
 
@@ -1213,7 +1696,12 @@ def signup():
     if action == "signup":
         single_user = {"username": username, "email": email, "password": password}
         result = user_config.add_single_user(single_user)
-        print(single_user["username"], result)
+        logger.info(
+            "signup of %s: %s",
+            single_user["username"],
+            result,
+            extra=event_extra("signup", username=single_user["username"], result=result),
+        )
 
         if result == "Success":
             user_config.save_user_config()
@@ -1237,7 +1725,7 @@ def signup():
             login_error=result + ", please try again or log in",
         )
 
-    print("unknown action at home page")
+    logger.warning("unknown action at home page: %s", action, extra=event_extra("login"))
     return render_template(
         "home.html",
         title=config["annotation_task_name"],
@@ -1270,13 +1758,14 @@ def get_prestudy_label(label):
 
 def print_prestudy_result():
     global task_assignment
-    print("----- prestudy test result -----")
-    print("passed annotators: ", task_assignment["prestudy_passed_users"])
-    print("failed annotators: ", task_assignment["prestudy_failed_users"])
-    print(
-        "pass rate: ",
-        len(task_assignment["prestudy_passed_users"])
-        / len(task_assignment["prestudy_passed_users"] + task_assignment["prestudy_failed_users"]),
+    passed = task_assignment["prestudy_passed_users"]
+    failed = task_assignment["prestudy_failed_users"]
+    logger.info(
+        "prestudy test result: passed annotators: %s, failed annotators: %s, pass rate: %s",
+        passed,
+        failed,
+        len(passed) / len(passed + failed),
+        extra=event_extra("prestudy", passed=len(passed), failed=len(failed)),
     )
 
 
@@ -1306,10 +1795,22 @@ def check_prestudy_status(username):
             return "prestudy not complete"
         groundtruth = instance_id_to_data[_id][config["prestudy"]["groundtruth_key"]]
         label = get_prestudy_label(label)
-        print(label, groundtruth)
+        logger.debug(
+            "prestudy answer of %s on %s: %s, ground truth: %s",
+            username,
+            _id,
+            label,
+            groundtruth,
+            extra=event_extra("prestudy", username=username, instance_id=_id),
+        )
         res.append(label == groundtruth)
 
-    print(res, sum(res) / len(res))
+    logger.info(
+        "prestudy score of %s: %s",
+        username,
+        sum(res) / len(res),
+        extra=event_extra("prestudy", username=username),
+    )
     # check if the score is higher than the minimum defined in config
     if (sum(res) / len(res)) < config["prestudy"]["minimum_score"]:
         user_state.set_prestudy_status(False)
@@ -1406,9 +1907,7 @@ def sample_instances(username):
 
     # update task_assignment to keep track of task assignment status globally
     for key in sampled_keys:
-        if key not in task_assignment["assigned"]:
-            task_assignment["assigned"][key] = []
-        task_assignment["assigned"][key].append(username)
+        add_task_assignment(key, username)
         task_assignment["unassigned"][key] -= 1
         if task_assignment["unassigned"][key] == 0:
             del task_assignment["unassigned"][key]
@@ -1421,9 +1920,7 @@ def sample_instances(username):
         )
         # adding test question sampling status to the task assignment
         for key in sampled_testing_ids:
-            if key not in task_assignment["assigned"]:
-                task_assignment["assigned"][key] = []
-            task_assignment["assigned"][key].append(username)
+            add_task_assignment(key, username)
             sampled_keys.insert(random.randint(0, len(sampled_keys) - 1), key)
 
     return sampled_keys
@@ -1437,89 +1934,93 @@ def assign_instances_to_user(username):
     global user_to_annotation_state
     global instance_id_to_data
 
-    user_state = user_to_annotation_state[username]
-
-    # check if the user has already been assigned with instances to annotate
-    # Currently we are just assigning once, but we might chance this later
-    if user_state.get_real_assigned_instance_count() > 0:
-        logging.warning(
-            "Instance already assigned to user %s, assigning process stoppped" % username
-        )
-        return False
-
-    prestudy_status = user_state.get_prestudy_status()
-    consent_status = user_state.get_consent_status()
+    with assignment_lock:
+        user_state = user_to_annotation_state[username]
 
-    if prestudy_status is None:
-        if "prestudy" in config and config["prestudy"]["on"]:
+        # check if the user has already been assigned with instances to annotate
+        # Currently we are just assigning once, but we might chance this later
+        if user_state.get_real_assigned_instance_count() > 0:
             logging.warning(
-                "Trying to assign instances to user when the prestudy test is not completed, assigning process stoppped"
+                "Instance already assigned to user %s, assigning process stoppped" % username
             )
             return False
 
-        if (
-            "surveyflow" not in config
-            or not config["surveyflow"]["on"]
-            or "prestudy" not in config
-            or not config["prestudy"]["on"]
-        ) or consent_status:
+        prestudy_status = user_state.get_prestudy_status()
+        consent_status = user_state.get_consent_status()
+
+        if prestudy_status is None:
+            if "prestudy" in config and config["prestudy"]["on"]:
+                logging.warning(
+                    "Trying to assign instances to user when the prestudy test is not completed, assigning process stoppped"
+                )
+                return False
+
+            if (
+                "surveyflow" not in config
+                or not config["surveyflow"]["on"]
+                or "prestudy" not in config
+                or not config["prestudy"]["on"]
+            ) or consent_status:
+                sampled_keys = sample_instances(username)
+                user_state.real_instance_assigned_count += len(sampled_keys)
+                if "post_annotation_pages" in task_assignment:
+                    sampled_keys = sampled_keys + task_assignment["post_annotation_pages"]
+            else:
+                logging.warning(
+                    "Trying to assign instances to user when the user has yet agreed to participate. assigning process stoppped"
+                )
+                return False
+
+        elif prestudy_status is False:
+            sampled_keys = task_assignment["prestudy_failed_pages"]
+
+        else:
             sampled_keys = sample_instances(username)
             user_state.real_instance_assigned_count += len(sampled_keys)
+            sampled_keys = task_assignment["prestudy_passed_pages"] + sampled_keys
             if "post_annotation_pages" in task_assignment:
                 sampled_keys = sampled_keys + task_assignment["post_annotation_pages"]
-        else:
-            logging.warning(
-                "Trying to assign instances to user when the user has yet agreed to participate. assigning process stoppped"
-            )
-            return False
 
-    elif prestudy_status is False:
-        sampled_keys = task_assignment["prestudy_failed_pages"]
-
-    else:
-        sampled_keys = sample_instances(username)
-        user_state.real_instance_assigned_count += len(sampled_keys)
-        sampled_keys = task_assignment["prestudy_passed_pages"] + sampled_keys
-        if "post_annotation_pages" in task_assignment:
-            sampled_keys = sampled_keys + task_assignment["post_annotation_pages"]
+        assigned_user_data = {key: instance_id_to_data[key] for key in sampled_keys}
+        user_state.add_new_assigned_data(assigned_user_data)
 
-    assigned_user_data = {key: instance_id_to_data[key] for key in sampled_keys}
-    user_state.add_new_assigned_data(assigned_user_data)
-
-    print(
-        "assinged %d instances to %s, total pages: %s, total users: %s, unassigned labels: %s, finished users: %s"
-        % (
+        logger.info(
+            "assigned %d instances to %s, total pages: %s, total users: %s, unassigned labels: %s, finished users: %s",
             user_state.get_real_assigned_instance_count(),
             username,
             user_state.get_assigned_instance_count(),
             get_total_user_count(),
             get_unassigned_count(),
-            get_finished_user_count()
+            get_finished_user_count(),
+            extra=event_extra("assignment", username=username),
         )
-    )
 
-    # save the assigned user data dict
-    user_dir = os.path.join(config["output_annotation_dir"], username)
-    assigned_user_data_path = os.path.join(user_dir, "assigned_user_data.json")
+        # save the assigned user data dict
+        user_dir = os.path.join(config["output_annotation_dir"], username)
+        assigned_user_data_path = os.path.join(user_dir, "assigned_user_data.json")
 
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir)
-        logger.debug('Created state directory for user "%s"' % (username))
+        if not os.path.exists(user_dir):
+            os.makedirs(user_dir)
+            logger.debug('Created state directory for user "%s"' % (username))
 
-    with open(assigned_user_data_path, "w") as w:
-        json.dump(user_state.get_assigned_data(), w)
+        with open(assigned_user_data_path, "w") as w:
+            json.dump(user_state.get_assigned_data(), w)
 
-    # save task assignment status
-    task_assignment_path = os.path.join(
-        config["output_annotation_dir"], config["automatic_assignment"]["output_filename"]
-    )
-    with open(task_assignment_path, "w") as w:
-        json.dump(task_assignment, w)
+        # save task assignment status
+        task_assignment_path = os.path.join(
+            config["output_annotation_dir"], config["automatic_assignment"]["output_filename"]
+        )
+        with open(task_assignment_path, "w") as w:
+            json.dump(task_assignment, w)
 
-    user_state.instance_assigned = True
+        user_state.instance_assigned = True
 
-    # return the assigned user data dict
-    return assigned_user_data
+        # Users who only saw the survey pages until now get the latest active
+        # learning ordering as soon as they have instances to annotate
+        apply_active_learning_ordering(username)
+
+        # return the assigned user data dict
+        return assigned_user_data
 
 
 
@@ -1529,35 +2030,41 @@ def remove_instances_from_users(user_set):
     Release the assigned instances
     """
     global user_to_annotation_state
-    global archived_users
     global instance_id_to_data
     global task_assignment
 
     if len(user_set) == 0:
-        print('No users need to be dropped at this moment')
+        logger.info('No users need to be dropped at this moment', extra=event_extra("drop_users"))
         return None
 
-    #remove user from the global user_to_annotation_state
-    for u in user_set:
-        if u in user_to_annotation_state:
-            archived_users = user_to_annotation_state[u]
-            del user_to_annotation_state[u]
-
-    #remove assigned instances
-    for inst_id in task_assignment['assigned']:
-        new_li = []
-        if type(task_assignment['assigned'][inst_id]) != list:
-            continue
-        for u in task_assignment['assigned'][inst_id]:
-            if u in user_set:
-                if inst_id not in task_assignment['unassigned']:
-                    task_assignment['unassigned'][inst_id] = 0
-                task_assignment['unassigned'][inst_id] += 1
-            else:
-                new_li.append(u)
-        # if len(new_li) != len(task_assignment['assigned'][inst_id]):
-        #    print(task_assignment['assigned'][inst_id], new_li)
-        task_assignment['assigned'][inst_id] = new_li
+    with assignment_lock:
+        user_set = set(user_set)
+
+        #remove user from the global user_to_annotation_state and keep their state in the archive
+        for u in user_set:
+            if u in user_to_annotation_state:
+                archived_users[u] = user_to_annotation_state[u]
+                forget_user_annotations(archived_users[u])
+                del user_to_annotation_state[u]
+
+        #remove assigned instances, only the instances assigned to the dropped users
+        #need to be checked
+        instance_ids_to_check = set()
+        for u in user_set:
+            instance_ids_to_check |= user_to_assigned_instance_ids.pop(u, set())
+
+        for inst_id in instance_ids_to_check:
+            new_li = []
+            for u in task_assignment['assigned'][inst_id]:
+                if u in user_set:
+                    if inst_id not in task_assignment['unassigned']:
+                        task_assignment['unassigned'][inst_id] = 0
+                    task_assignment['unassigned'][inst_id] += 1
+                else:
+                    new_li.append(u)
+            # if len(new_li) != len(task_assignment['assigned'][inst_id]):
+            #    print(task_assignment['assigned'][inst_id], new_li)
+            task_assignment['assigned'][inst_id] = new_li
 
     # Figure out where this user's data would be stored on disk
     output_annotation_dir = config["output_annotation_dir"]
@@ -1569,8 +2076,12 @@ def remove_instances_from_users(user_set):
     for u in user_set:
         if os.path.exists(os.path.join(output_annotation_dir, u)):
             shutil.move(os.path.join(output_annotation_dir, u), os.path.join(bad_user_dir, u))
-    print('bad users moved to %s' % bad_user_dir)
-    print('removed %s users from the current annotation queue' % len(user_set))
+    logger.info(
+        'removed %s users from the current annotation queue, bad users moved to %s',
+        len(user_set),
+        bad_user_dir,
+        extra=event_extra("drop_users", users=sorted(user_set)),
+    )
 
 
 
@@ -1606,9 +2117,7 @@ def generate_full_user_dataflow(username):
 
     # update task_assignment to keep track of task assignment status globally
     for key in sampled_keys:
-        if key not in task_assignment["assigned"]:
-            task_assignment["assigned"][key] = []
-        task_assignment["assigned"][key].append(username)
+        add_task_assignment(key, username)
         task_assignment["unassigned"][key] -= 1
         if task_assignment["unassigned"][key] == 0:
             del task_assignment["unassigned"][key]
@@ -1621,9 +2130,7 @@ def generate_full_user_dataflow(username):
         )
         # adding test question sampling status to the task assignment
         for key in sampled_testing_ids:
-            if key not in task_assignment["assigned"]:
-                task_assignment["assigned"][key] = []
-            task_assignment["assigned"][key].append(username)
+            add_task_assignment(key, username)
             sampled_keys.insert(random.randint(0, len(sampled_keys) - 1), key)
 
     # save task assignment status
@@ -1698,31 +2205,25 @@ def get_total_user_count():
 
     return len(user_to_annotation_state)
 
-def update_prolific_study_status():
+def release_dropped_prolific_users():
     """
-    Update the prolific study status
-    This is the regular status update of prolific study object
+    Releases the instances of the prolific users who have returned, timed out
+    or been rejected since the last sync. This is called by the
+    ProlificWorkloadController after every sync of the study status.
     """
 
     global prolific_study
     global user_to_annotation_state
 
-    print('update_prolific_study is called')
-    prolific_study.update_submission_status()
-    users_to_drop = prolific_study.get_dropped_users()
-    users_to_drop = [it for it in users_to_drop if it in user_to_annotation_state] # only drop the users who are currently in the data
-    remove_instances_from_users(users_to_drop)
+    users_to_drop = []
+    for event, participant_id, submission in prolific_study.pop_status_events():
+        if event == "dropped" and participant_id in user_to_annotation_state: # only drop the users who are currently in the data
+            users_to_drop.append(participant_id)
+        elif event == "completed":
+            logger.debug("Prolific user %s completed the study" % participant_id)
+    if len(users_to_drop) > 0:
+        remove_instances_from_users(users_to_drop)
 
-    #automatically check if there are too many users working on the task and if so, pause it
-    #
-    if prolific_study.get_concurrent_sessions_count() > prolific_study.max_concurrent_sessions:
-        print('Concurrent sessions (%s) exceed the predefined threshold (%s), trying to pause the prolific study'%
-              (prolific_study.get_concurrent_sessions_count(), prolific_study.max_concurrent_sessions))
-        prolific_study.pause_study()
-
-        #use a separate thread to periodically check if the amount of active users are below a threshold
-        th = threading.Thread(target=prolific_study.workload_checker)
-        th.start()
 
 def lookup_user_state(username):
     """
@@ -1731,7 +2232,15 @@ def lookup_user_state(username):
     """
     global user_to_annotation_state
 
-    if username not in user_to_annotation_state:
+    user_state = user_to_annotation_state.get(username)
+    if user_state is not None:
+        return user_state
+
+    with assignment_lock:
+        # another request may have created the state while this one waited
+        if username in user_to_annotation_state:
+            return user_to_annotation_state[username]
+
         logger.debug('Previously unknown user "%s"; creating new annotation state' % (username))
 
         if "automatic_assignment" in config and config["automatic_assignment"]["on"]:
@@ -1756,12 +2265,32 @@ def lookup_user_state(username):
             user_state = UserAnnotationState(instance_id_to_data)
             user_state.real_instance_assigned_count = user_state.get_assigned_instance_count()
             user_to_annotation_state[username] = user_state
-    else:
-        user_state = user_to_annotation_state[username]
+
+        # New users follow the latest active learning ordering right away
+        apply_active_learning_ordering(username)
 
     return user_state
 
 
+def save_user_annotation_order(username):
+    """
+    Writes the order in which the user will see their instances to disk.
+    """
+    user_dir = os.path.join(config["output_annotation_dir"], username)
+    user_state = lookup_user_state(username)
+
+    if not os.path.exists(user_dir):
+        os.makedirs(user_dir)
+        logger.debug('Created state directory for user "%s"' % (username))
+
+    annotation_order_fname = os.path.join(user_dir, "annotation_order.txt")
+    with open(annotation_order_fname, "wt") as outf:
+        for inst in user_state.instance_id_ordering:
+            # JIAXIN: output id has to be str
+            outf.write(str(inst) + "\n")
+
+
+@stage_latency.time("save_user_state")
 def save_user_state(username, save_order=False):
     global user_to_annotation_state
     global instance_id_to_data
@@ -1780,10 +2309,7 @@ def save_user_state(username, save_order=False):
 
     annotation_order_fname = os.path.join(user_dir, "annotation_order.txt")
     if not os.path.exists(annotation_order_fname) or save_order:
-        with open(annotation_order_fname, "wt") as outf:
-            for inst in user_state.instance_id_ordering:
-                # JIAXIN: output id has to be str
-                outf.write(str(inst) + "\n")
+        save_user_annotation_order(username)
 
     annotated_instances_fname = os.path.join(user_dir, "annotated_instances.jsonl")
 
@@ -1795,108 +2321,23 @@ def save_user_state(username, save_order=False):
 
             output = {
                 "id": inst_id,
-                "displayed_text": instance_id_to_data[inst_id]["displayed_text"],
+                "displayed_text": get_displayed_text(inst_id, username),
                 "label_annotations": data["labels"],
                 "span_annotations": data["spans"],
                 "behavioral_data": bd_dict,
             }
+            if inst_id in user_state.instance_id_to_update_time:
+                output["update_time"] = user_state.instance_id_to_update_time[inst_id]
             json.dump(output, outf)
             outf.write("\n")
 
 
+@stage_latency.time("export")
 def save_all_annotations():
-    global user_to_annotation_state
-    global instance_id_to_data
-
-    # Figure out where this user's data would be stored on disk
-    output_annotation_dir = config["output_annotation_dir"]
-    fmt = config["output_annotation_format"]
-
-    if fmt not in ["csv", "tsv", "json", "jsonl"]:
-        raise Exception("Unsupported output format: " + fmt)
-
-    if not os.path.exists(output_annotation_dir):
-        os.makedirs(output_annotation_dir)
-        logger.debug("Created state directory for annotations: %s" % (output_annotation_dir))
-
-    annotated_instances_fname = os.path.join(output_annotation_dir, "annotated_instances." + fmt)
-
-    # We write jsonl format regardless
-    if fmt in ["json", "jsonl"]:
-        with open(annotated_instances_fname, "wt") as outf:
-            for user_id, user_state in user_to_annotation_state.items():
-                for inst_id, data in user_state.get_all_annotations().items():
-
-                    bd_dict = user_state.instance_id_to_behavioral_data.get(inst_id, {})
-
-                    output = {
-                        "user_id": user_id,  # "user_id
-                        "instance_id": inst_id,
-                        "displayed_text": instance_id_to_data[inst_id]["displayed_text"],
-                        "label_annotations": data["labels"],
-                        "span_annotations": data["spans"],
-                        "behavioral_data": bd_dict,
-                    }
-                    json.dump(output, outf)
-                    outf.write("\n")
-
-    # Convert to Pandas and then dump
-    elif fmt in ["csv", "tsv"]:
-        df = defaultdict(list)
-
-        # Loop 1, figure out which schemas/labels have values so we know which
-        # things will need to be columns in each row
-        schema_to_labels = defaultdict(set)
-        span_labels = set()
-
-        for user_state in user_to_annotation_state.values():
-            for annotations in user_state.get_all_annotations().values():
-                # Columns for each label-based annotation
-                for schema, label_vals in annotations["labels"].items():
-                    for label in label_vals.keys():
-                        schema_to_labels[schema].add(label)
-
-                # Columns for each span type too
-                for span in annotations["spans"]:
-                    span_labels.add(span["annotation"])
-
-                # TODO: figure out what's in the behavioral dict and how to format it
-
-        # Loop 2, report everything that's been annotated
-        for user_id, user_state in user_to_annotation_state.items():
-            for inst_id, annotations in user_state.get_all_annotations().items():
-
-                df["user"].append(user_id)
-                df["instance_id"].append(inst_id)
-                df["displayed_text"].append(instance_id_to_data[inst_id]["displayed_text"])
-
-                label_annotations = annotations["labels"]
-                span_annotations = annotations["spans"]
-
-                for schema, labels in schema_to_labels.items():
-                    if schema in label_annotations:
-                        label_vals = label_annotations[schema]
-                        for label in labels:
-                            val = label_vals[label] if label in label_vals else None
-                            # For some sanity, combine the schema and label it a single column
-                            df[schema + ":::" + label].append(val)
-                    # If the user did label this schema at all, fill it with None values
-                    else:
-                        for label in labels:
-                            df[schema + ":::" + label].append(None)
-
-                # We bunch spans by their label to make it slightly easier to
-                # process, but it's still kind of messy compared with the JSON
-                # format.
-                for span_label in span_labels:
-                    anns = [sa for sa in span_annotations if sa["annotation"] == span_label]
-                    df["span_annotation:::" + span_label].append(anns)
-
-                # TODO: figure out what's in the behavioral dict and how to format it
-
-        df = pd.DataFrame(df)
-        sep = "," if fmt == "csv" else "\t"
-        df.to_csv(annotated_instances_fname, index=False, sep=sep)
+    """
+    Exports the annotations of all users to annotated_instances.<format>.
+    """
+    annotation_exporter.export()
 
     # Save the annotation assignment info if automatic task assignment is on.
     # Jiaxin: we are simply saving this as a json file at this moment
@@ -1976,6 +2417,11 @@ def load_user_state(username):
             if iid not in annotation_order:
                 annotation_order.append(iid)
 
+        # Reloading replaces any state we already had for this user, so take
+        # its annotations out of the running totals first
+        if username in user_to_annotation_state:
+            forget_user_annotations(user_to_annotation_state[username])
+
         user_state = UserAnnotationState(assigned_user_data)
         user_state.update(annotation_order, annotated_instances)
 
@@ -1994,14 +2440,19 @@ def load_user_state(username):
 
         logger.debug('Previously unknown user "%s"; creating new annotation state' % (username))
 
-        # whenever a user creation happens, update the prolific study first so that we can potentially release some spots
-        if config.get('prolific'):
-            update_prolific_study_status()
+        # a new user may change the workload, so ask the background
+        # controller to sync the prolific study status soon. It also releases
+        # the spots of dropped users
+        if prolific_workload_controller is not None:
+            prolific_workload_controller.notify()
 
         # create new user state with the look up function
         if instances_all_assigned():
             if config.get('prolific'):
-                print('All instance have been assigned, trying to pause the prolific study')
+                logger.info(
+                    'All instance have been assigned, trying to pause the prolific study',
+                    extra=event_extra("prolific"),
+                )
                 prolific_study.pause_study()
             return "all instances have been assigned"
 
@@ -2033,55 +2484,16 @@ def previous_response(user, file_path):
             f.write(line)
 
 
-def get_displayed_text(text):
-    # automatically unfold the text list when input text is a list (e.g. best-worst-scaling).
-    if "list_as_text" in config and config["list_as_text"]:
-        if isinstance(text, str):
-            try:
-                text = eval(text)
-            except Exception:
-                text = str(text)
-        if isinstance(text, list):
-            if config["list_as_text"]["text_list_prefix_type"] == "alphabet":
-                prefix_list = list(string.ascii_uppercase)
-                text = [prefix_list[i] + ". " + text[i] for i in range(len(text))]
-            elif config["list_as_text"]["text_list_prefix_type"] == "number":
-                text = [str(i) + ". " + text[i] for i in range(len(text))]
-            text = "<br>".join(text)
-
-        # unfolding dict into different sections
-        elif isinstance(text, dict):
-            #randomize the order of the displayed text
-            if "randomization" in config["list_as_text"]:
-                if config["list_as_text"].get("randomization") == "value":
-                    values = list(text.values())
-                    random.shuffle(values)
-                    text = {key: value for key, value in zip(text.keys(), values)}
-                elif config["list_as_text"].get("randomization") == "key":
-                    keys = list(text.keys())
-                    random.shuffle(keys)
-                    text = {key: text[key] for key in keys}
-                else:
-                    print("WARNING: %s currently not supported for list_as_text, please check your .yaml file"%config["list_as_text"].get("randomization"))
-
-            block = []
-            if config["list_as_text"].get("horizontal"):
-                for key in text:
-                    block.append(
-                        '<div id="instance-text" name="instance_text" style="float:left;width:%s;padding:5px;" class="column"> <legend> %s </legend> %s </div>'
-                        % ("%d" % int(100 / len(text)) + "%", key, text[key])
-                    )
-                text = '<div class="row" style="display: table"> %s </div>' % ("".join(block))
-            else:
-                for key in text:
-                    block.append(
-                        '<div id="instance-text" name="instance_text"> <legend> %s </legend> %s <br/> </div>'
-                        % (key, text[key])
-                    )
-                text = "".join(block)
-        else:
-            text = text
-    return text
+def get_displayed_text(instance_id, username=None):
+    """
+    Returns the text displayed for an instance, with any list_as_text
+    randomization applied for the user.
+    """
+    return displayed_text_renderer.get_displayed_text(
+        instance_id,
+        instance_id_to_data[instance_id][config["item_properties"]["text_key"]],
+        username,
+    )
 
 
 @app.route("/annotate", methods=["GET", "POST"])
@@ -2106,6 +2518,9 @@ def annotate_page(username=None, action=None):
                 )
             username = username_from_last_page
 
+    user_last_seen[username] = time.time()
+    flask.g.username = username
+
     # Check if the user is authorized. If not, go to the login page
     # if not user_config.is_valid_username(username):
     #    return render_template("home.html")
@@ -2121,7 +2536,8 @@ def annotate_page(username=None, action=None):
     # is running in a single thread, but it's probably good to check on this at
     # some point if we scale to having lots of concurrent users.
     if "instance_id" in request.form:
-        did_change = update_annotation_state(username, request.form)
+        with stage_latency.time("update_annotation_state"):
+            did_change = update_annotation_state(username, request.form)
 
         if did_change:
 
@@ -2146,7 +2562,11 @@ def annotate_page(username=None, action=None):
                 update_rate = al_config["update_rate"]
                 total_annotations = get_total_annotations()
 
-                if total_annotations % update_rate == 0:
+                # Each multiple of update_rate schedules one round, even if
+                # the total skipped over the exact boundary
+                if active_learning_state is None:
+                    init_active_learning_state()
+                if active_learning_state.claim_update_boundary(total_annotations, update_rate):
                     actively_learn()
 
             save_user_state(username)
@@ -2177,7 +2597,9 @@ def annotate_page(username=None, action=None):
         go_to_id(username, request.form.get("go_to"))
 
     else:
-        print('unrecognized action request: "%s"' % action)
+        logger.info(
+            'unrecognized action request: "%s"', action, extra=event_extra("annotate", username=username)
+        )
 
     instance = get_cur_instance_for_user(username)
 
@@ -2185,12 +2607,12 @@ def annotate_page(username=None, action=None):
     if config["annotation_task_name"] == "Contextual Acceptability":
         context_key = config["item_properties"]["context_key"]
 
-    # directly display the prepared displayed_text
+    # the displayed_text is rendered on first view and randomized per user
     instance_id = instance[id_key]
-    text = instance["displayed_text"]
+    flask.g.instance_id = instance_id
+    text = get_displayed_text(instance_id, username)
     var_elems = {
         "instance": { "text": text },
-        "emphasis": list(emphasis_corpus_to_schemas)
     }
 
     # also save the displayed text in the metadata dict
@@ -2208,19 +2630,25 @@ def annotate_page(username=None, action=None):
     # pre-rendering here. This also means that any changes to the UI code for
     # rendering need to be updated here too.
     #
-    # NOTE2: We have to this here to account for any keyword highlighting before
-    # the instance text gets marked up in the post-processing below
+    # NOTE2: If the admin has specified that certain keywords need to be
+    # highlighted, they are marked up first from their offsets in the displayed
+    # text. The marks are split where the annotated spans start and end, and the
+    # offsets of the spans are shifted past the marks, so that both nest.
     span_annotations = get_span_annotations_for_user_on(username, instance_id)
+    if keyword_highlighter is not None:
+        keyword_spans = keyword_highlighter.get_spans(instance_id, text)
+        if keyword_spans:
+            boundaries = [a[key] for a in span_annotations or [] for key in ("start", "end")]
+            text, shift = render_highlights(text, keyword_spans, boundaries)
+            if span_annotations:
+                span_annotations = [
+                    dict(a, start=shift(a["start"]), end=shift(a["end"])) for a in span_annotations
+                ]
+
     if span_annotations is not None and len(span_annotations) > 0:
         # Mark up the instance text where the annotated spans were
         text = render_span_annotations(text, span_annotations)
 
-    # If the admin has specified that certain keywords need to be highlighted,
-    # post-process the selected instance so that it now also has colored span
-    # overlays for keywords.
-    #
-    # NOTE: this code is probably going to break the span annotation's
-    # understanding of the instance. Need to check this...
     schema_content_to_prefill = []
 
     #prepare label suggestions
@@ -2236,11 +2664,18 @@ def annotate_page(username=None, action=None):
             elif type(suggested_labels) == list:
                 suggested_labels = suggested_labels
             else:
-                print("WARNING: Unsupported suggested label type %s, please check your input data" % type(s))
+                logger.warning(
+                    "Unsupported suggested label type %s, please check your input data",
+                    type(suggested_labels),
+                    extra=event_extra("render", instance_id=instance_id),
+                )
                 continue
 
             if not scheme.get('label_suggestions') in ['highlight', 'prefill']:
-                print('WARNING: the style of suggested labels is not defined, please check your configuration file.')
+                logger.warning(
+                    'the style of suggested labels is not defined, please check your configuration file.',
+                    extra=event_extra("render", instance_id=instance_id),
+                )
                 continue
 
             label_suggestion = scheme['label_suggestions']
@@ -2266,8 +2701,8 @@ def annotate_page(username=None, action=None):
 
     # TODO: Display plots for agreement scores instead of only the overall score
     # in the statistics sidebar
-    # all_statistics['Agreement'] = get_agreement_score('all', 'all', return_type='overall_average')
-    # print(all_statistics)
+    if agreement_tracker is not None:
+        all_statistics['Agreement'] = get_agreement_score('all', 'all', return_type='overall_average')
 
     # Set the html file as surveyflow pages when the instance is a not an
     # annotation page (survey pages, prestudy pass or fail page)
@@ -2305,21 +2740,22 @@ def annotate_page(username=None, action=None):
 
     # Flask will fill in the things we need into the HTML template we've created,
     # replacing {{variable_name}} with the associated text for keyword arguments
-    rendered_html = render_template(
-        html_file,
-        username=username,
-        # This is what instance the user is currently on
-        instance=text,
-        instance_obj=instance,
-        instance_id=lookup_user_state(username).get_instance_cursor(),
-        finished=lookup_user_state(username).get_real_finished_instance_count(),
-        total_count=lookup_user_state(username).get_real_assigned_instance_count(),
-        alert_time_each_instance=config["alert_time_each_instance"],
-        statistics_nav=all_statistics,
-        var_elems=var_elems_html,
-        custom_js=custom_js,
-        **kwargs
-    )
+    with stage_latency.time("render_template"):
+        rendered_html = render_template(
+            html_file,
+            username=username,
+            # This is what instance the user is currently on
+            instance=text,
+            instance_obj=instance,
+            instance_id=lookup_user_state(username).get_instance_cursor(),
+            finished=lookup_user_state(username).get_real_finished_instance_count(),
+            total_count=lookup_user_state(username).get_real_assigned_instance_count(),
+            alert_time_each_instance=config["alert_time_each_instance"],
+            statistics_nav=all_statistics,
+            var_elems=var_elems_html,
+            custom_js=custom_js,
+            **kwargs
+        )
 
     # UGHGHGHGH the template does unusual escaping, which makes it a PAIN to do
     # the replacement later
@@ -2329,6 +2765,9 @@ def annotate_page(username=None, action=None):
 
     # Parse the page so we can programmatically reset the annotation state
     # to what it was before
+    from bs4 import BeautifulSoup
+
+    soup_start = time.perf_counter()
     soup = BeautifulSoup(rendered_html, "html.parser")
 
     # If the user has annotated this before, walk the DOM and fill out what they
@@ -2350,7 +2789,11 @@ def annotate_page(username=None, action=None):
                 if "labels" not in scheme_dict[s['name']]:
                     annotations[s['name']]['text_box'] = s['label']
             else:
-                print('WARNING: label suggestions not supported for annotation_type %s, please submit a github issue to get support'%scheme_dict[s['name']]['annotation_type'])
+                logger.warning(
+                    'label suggestions not supported for annotation_type %s, please submit a github issue to get support',
+                    scheme_dict[s['name']]['annotation_type'],
+                    extra=event_extra("render", instance_id=instance_id),
+                )
     #print(schema_content_to_prefill, annotations)
 
 
@@ -2367,7 +2810,7 @@ def annotate_page(username=None, action=None):
 
                 for input_field in input_fields:
                     if input_field is None:
-                        print("No input for ", name)
+                        logger.warning("No input for %s", name, extra=event_extra("render", instance_id=instance_id))
                         continue
 
                     # If it's a slider, set the value for the slider
@@ -2403,6 +2846,7 @@ def annotate_page(username=None, action=None):
         soup = randomize_options(soup, selected_schemas_for_option_randomization, map_user_id_to_digit(username))
 
     rendered_html = str(soup)
+    stage_latency.observe(time.perf_counter() - soup_start, "beautifulsoup")
 
     return rendered_html
 
@@ -2423,7 +2867,7 @@ def randomize_options(soup, legend_names, seed):
     # Find all fieldsets in the soup
     fieldsets = soup.find_all('fieldset')
     if not fieldsets:
-        print("No fieldsets found.")
+        logger.warning("No fieldsets found.", extra=event_extra("render"))
         return soup
 
     # Initialize a variable to track whether the legend is found
@@ -2440,7 +2884,7 @@ def randomize_options(soup, legend_names, seed):
             # Find the table within the fieldset
             table = fieldset.find('table')
             if not table:
-                print("Table not found within the fieldset.")
+                logger.warning("Table not found within the fieldset.", extra=event_extra("render"))
                 continue
 
             # Get the list of tr elements excluding the first one (title)
@@ -2455,7 +2899,7 @@ def randomize_options(soup, legend_names, seed):
 
     # Check if any legend was found
     if not legend_found:
-        print(f"No matching legends found within any fieldset.")
+        logger.warning("No matching legends found within any fieldset.", extra=event_extra("render"))
 
     return soup
 
@@ -2471,65 +2915,6 @@ def get_color_for_schema_label(schema, label):
     return c
 
 
-def parse_html_span_annotation(html_span_annotation):
-    """
-    Parses the span annotations produced in raw HTML by Potato's front end
-    and extracts out the precise spans and labels annotated by users.
-
-    :returns: a tuple of (1) the annotated string without annotation HTML
-              and a list of annotations
-    """
-    s = html_span_annotation.strip()
-    init_tag_regex = re.compile(r"(<span.+?>)")
-    end_tag_regex = re.compile(r"(</span>)")
-    anno_regex = re.compile(r'<div class="span_label"(.*)name="(.+?)"(.+)?>(.+)</div>')
-    schema_regex = re.compile(r'data-schema="([^"]+?)"')
-    no_html_s = ""
-    start = 0
-
-    annotations = []
-
-    while True:
-        m = init_tag_regex.search(s, start)
-        if not m:
-            break
-
-        # find the end tag
-        m2 = end_tag_regex.search(s, m.end())
-
-        middle = s[m.end() : m2.start()]
-
-        # Get the annotation label from the middle text
-        m3 = anno_regex.search(middle)
-
-        middle_text = middle[: m3.start()]
-        annotation = m3.group(2)
-        annotation_title = m3.group(4)
-
-        m4 = schema_regex.search(middle)
-        schema = m4.group(1)
-
-        no_html_s += s[start : m.start()]
-
-        ann = {
-            "start": len(no_html_s),
-            "end": len(no_html_s) + len(middle_text),
-            "span": middle_text,
-            "annotation": annotation,
-            "schema": schema,
-            "annotation_title": annotation_title
-        }
-
-        annotations.append(ann)
-
-        no_html_s += middle_text
-        start = m2.end(0)
-
-    # Add whatever trailing text exists
-    no_html_s += s[start:]
-
-    return no_html_s, annotations
-
 def parse_story_pair_from_file(filepath):
     with open(filepath, "r") as f:
         lines = f.readlines()
@@ -2558,9 +2943,15 @@ def get_class(kls):
     return m
 
 
+@stage_latency.time("active_learning")
 def actively_learn():
+    import joblib
+    from sklearn.pipeline import Pipeline
+    from tqdm import tqdm
+
     global user_to_annotation_state
     global instance_id_to_data
+    global active_learning_state
 
     if "active_learning_config" not in config:
         logger.warning(
@@ -2574,6 +2965,9 @@ def actively_learn():
     if "enable_active_learning" in al_config and not al_config["enable_active_learning"]:
         return
 
+    if active_learning_state is None:
+        active_learning_state = ActiveLearningState()
+
     if "classifier_name" not in al_config:
         raise Exception('active learning enabled but no classifier is set with "classifier_name"')
 
@@ -2595,6 +2989,8 @@ def actively_learn():
     vectorizer_kwargs = al_config.get("vectorizer_kwargs", {})
     strategy = al_config["resolution_strategy"]
 
+    round_start = time.time()
+
     # Collect all the current labels
     instance_to_labels = defaultdict(list)
     for uas in user_to_annotation_state.values():
@@ -2664,6 +3060,8 @@ def actively_learn():
         logger.info("done training classifier for %s" % scheme)
         scheme_to_classifier[scheme] = clf
 
+    training_seconds = time.time() - round_start
+
     # Get the remaining unlabeled instances and start predicting
     unlabeled_ids = [iid for iid in instance_id_to_data if iid not in instance_to_label]
     random.shuffle(unlabeled_ids)
@@ -2682,12 +3080,14 @@ def actively_learn():
         unlabeled_ids = unlabeled_ids[:max_insts]
 
     # For each scheme, use its classifier to label the data
+    inference_start = time.time()
     scheme_to_predictions = {}
     unlabeled_texts = [instance_id_to_data[iid][text_key] for iid in unlabeled_ids]
     for scheme, clf in scheme_to_classifier.items():
         logger.info("Inferring labels for %s" % scheme)
         preds = clf.predict_proba(unlabeled_texts)
         scheme_to_predictions[scheme] = preds
+    inference_seconds = time.time() - inference_start
 
     # Figure out which of the instances to prioritize, keeping the specified
     # ratio of random-vs-AL-selected instances.
@@ -2723,14 +3123,125 @@ def actively_learn():
     # reorder with active learning
     new_id_order.extend(remaining_ids)
 
+    round_metrics = {
+        "timestamp": round_start,
+        "annotated_instances": len(instance_to_label),
+        "trained_schemes": sorted(scheme_to_classifier.keys()),
+        "training_seconds": training_seconds,
+        "inference_seconds": inference_seconds,
+    }
+    active_learning_state.publish_round(new_id_order, id_to_selection_type, round_metrics)
+
     # Update each user's ordering, preserving the order for any item that has
     # any annotation so that it stays in the front of the users' queues even if
     # they haven't gotten to it yet (but others have)
-    already_annotated = list(instance_to_labels.keys())
-    for annotation_state in user_to_annotation_state.values():
-        annotation_state.reorder_remaining_instances(new_id_order, already_annotated)
+    already_annotated = set(instance_to_labels.keys())
+    reordered_users = 0
+    for username in get_users():
+        if apply_active_learning_ordering(username, already_annotated):
+            reordered_users += 1
+
+    round_metrics["reordered_users"] = reordered_users
+    round_metrics["total_seconds"] = time.time() - round_start
+
+    # Persist the models alongside the round history so a restarted server
+    # picks up where this round left off
+    state_path, model_path = get_active_learning_paths()
+    joblib.dump(scheme_to_classifier, model_path)
+    active_learning_state.save(state_path)
+
+    logger.info(
+        "Finished active learning round %d (reordered instances for %d users in %.2f seconds)"
+        % (active_learning_state.cur_round, reordered_users, round_metrics["total_seconds"])
+    )
+
+
+def get_active_learning_paths():
+    """
+    Returns the paths where the active learning state and models are saved.
+    """
+    output_annotation_dir = config["output_annotation_dir"]
+    return (
+        os.path.join(output_annotation_dir, "active_learning_state.json"),
+        os.path.join(output_annotation_dir, "active_learning_models.joblib"),
+    )
+
+
+def get_annotated_instance_ids():
+    """
+    Returns the set of instance ids that at least one user has labeled.
+    """
+    annotated = set()
+    for user_state in user_to_annotation_state.values():
+        annotated.update(user_state.instance_id_to_labeling.keys())
+    return annotated
+
+
+def apply_active_learning_ordering(username, already_annotated=None):
+    """
+    Re-orders the user's remaining instances according to the most recently
+    published active learning ordering, unless the user's queue already
+    reflects it.
+
+    :return: True if the user's ordering was changed
+    """
+    if active_learning_state is None or not active_learning_state.published_ordering:
+        return False
+
+    if active_learning_state.is_user_current(username):
+        return False
+
+    if already_annotated is None:
+        already_annotated = get_annotated_instance_ids()
+
+    user_state = lookup_user_state(username)
+    # Users that were only assigned survey pages so far are not marked current,
+    # so they are re-ordered once their instances are assigned
+    if user_state.get_real_assigned_instance_count() == 0:
+        return False
+
+    user_state.reorder_remaining_instances(
+        active_learning_state.published_ordering, already_annotated
+    )
+    save_user_annotation_order(username)
+    active_learning_state.mark_user_current(username)
+    return True
+
+
+def init_active_learning_state():
+    """
+    Sets up the active learning state, resuming from the last saved round if
+    there is one so users don't wait for the next update_rate boundary to get
+    their instances re-ordered.
+    """
+    global active_learning_state
+
+    al_config = config.get("active_learning_config", {})
+    if not al_config.get("enable_active_learning"):
+        return
 
-    logger.info("Finished reording instances")
+    state_path, _ = get_active_learning_paths()
+    if not os.path.exists(state_path):
+        active_learning_state = ActiveLearningState()
+        return
+
+    active_learning_state = ActiveLearningState.load(state_path)
+    logger.info(
+        "Resuming active learning from round %d saved at %s"
+        % (active_learning_state.cur_round, state_path)
+    )
+
+    already_annotated = get_annotated_instance_ids()
+    reordered_users = [
+        username
+        for username in get_users()
+        if apply_active_learning_ordering(username, already_annotated)
+    ]
+    if reordered_users:
+        active_learning_state.save(state_path)
+    logger.info(
+        "Applied the published active learning ordering to %d users" % len(reordered_users)
+    )
 
 
 def resolve(annotations, strategy):
@@ -2743,6 +3254,8 @@ def run_create_task_cli():
     """
     Run create_task_cli().
     """
+    from create_task_cli import create_task_cli, yes_or_no
+
     if yes_or_no("Launch task creation process?"):
         if yes_or_no("Launch on command line?"):
             create_task_cli()
@@ -2751,16 +3264,30 @@ def run_create_task_cli():
             raise Exception("Gui-based design not supported yet.")
 
 
-def run_server(args):
+def init_server(args, prepare_config=None):
     """
-    Run Flask server.
+    Loads the config, data and user states the server needs, without starting
+    it.
+
+    :prepare_config: an optional function that is called with the loaded config
+      before the server is set up, e.g. to point it at other data
     """
     global user_config
     global user_to_annotation_state
     global prolific_study
-
-
-    init_config(args)
+    global prolific_workload_controller
+    global agreement_tracker
+    global request_profiler
+    global annotation_exporter
+    global log_listener
+
+    with startup_timer.phase("load config"):
+        init_config(args)
+        if prepare_config is not None:
+            prepare_config(config)
+    log_listener = setup_logging(config)
+    if (config.get("logging") or {}).get("level"):
+        logger.setLevel(str(config["logging"]["level"]).upper())
     if config.get("verbose"):
         logger.setLevel(logging.DEBUG)
     if config.get("very_verbose"):
@@ -2770,11 +3297,15 @@ def run_server(args):
 
     #load prolific configurations
     if config.get('prolific') and config['prolific']['config_file_path']:
+        import yaml
+        from server_utils.prolific_apis import ProlificStudy
+
         # load multitask annotation config
         with open(config['prolific']['config_file_path'], "rt") as f:
             prolific_config = yaml.safe_load(f)
             max_concurrent_sessions = prolific_config.get('max_concurrent_sessions') if prolific_config.get('max_concurrent_sessions') else 30
             workload_checker_period = prolific_config.get('workload_checker_period') if prolific_config.get('workload_checker_period') else 300
+            status_sync_period = prolific_config.get('status_sync_period') if prolific_config.get('status_sync_period') else 60
             prolific_study = ProlificStudy(prolific_config['token'], prolific_config['study_id'],
                                            saving_dir = config.get('output_annotation_dir'),
                                            max_concurrent_sessions=max_concurrent_sessions,
@@ -2815,36 +3346,94 @@ def run_server(args):
         else:
             logger.info("%s will be loaded from user-defined file %s" % (key,config[key]))
 
-    #overwrite the site_dir to the default path, this will not be shown to the users
-    #todo: remove all the site_dir key from the configuration files or figure out a way to handle render flask templates from different dirs
-    #todo: having the flask templates in the user-defined project folder would be neccessary in the long run due to potential conflicts of projects with the same name
-    # each project dir should be self-contained, even for the flask template files
-    config["site_dir"] = flask_templates_dir
+    # overwrite the site_dir with a dir of the flask templates that belongs to
+    # this project (named after the task and its config file, so projects with
+    # the same name don't overwrite each other's pages); this will not be shown
+    # to the users
+    #todo: remove all the site_dir key from the configuration files
+    config["site_dir"] = os.path.join(
+        flask_templates_dir,
+        "projects",
+        "%s-%s" % (
+            re.sub(r"[^A-Za-z0-9_.-]+", "-", config["annotation_task_name"]),
+            hashlib.sha1(os.path.realpath(config["__config_file__"]).encode()).hexdigest()[:8],
+        ),
+    )
+    os.makedirs(config["site_dir"], exist_ok=True)
+    # look up the generated pages in the project's dir and the rest of the
+    # templates (home.html, error.html, ...) in the flask templates dir
+    app.jinja_loader = jinja2.ChoiceLoader(
+        [jinja2.FileSystemLoader(config["site_dir"]), jinja2.FileSystemLoader(flask_templates_dir)]
+    )
     # Creates the templates we'll use in flask by mashing annotation
-    # specification on top of the proto-templates
-    generate_site(config)
-    if "surveyflow" in config and config["surveyflow"]["on"]:
-        generate_surveyflow_pages(config)
+    # specification on top of the proto-templates, unless they were already
+    # generated from the same config and templates
+    with startup_timer.phase("generate site"):
+        generate_project_site(config)
 
     # Generate the output directory if it doesn't exist yet
     if not os.path.exists(config["output_annotation_dir"]):
         os.makedirs(config["output_annotation_dir"])
 
     # Loads the training data
-    load_all_data(config)
+    with startup_timer.phase("load data"):
+        load_all_data(config)
+
+    annotation_exporter = AnnotationExporter.from_config(
+        config, lambda: list(user_to_annotation_state.items()), get_displayed_text
+    )
+
+    request_profiler = RequestProfiler.from_config(config)
+    if request_profiler is not None:
+        print("profiling requests into %s" % request_profiler.output_dir)
+
+    # Track agreement incrementally as the users' annotations are loaded and
+    # updated
+    with startup_timer.phase("set up agreement tracking"):
+        from server_utils.agreement_tracker import AgreementTracker
+
+        agreement_tracker = AgreementTracker(config["annotation_schemes"])
 
     # load users with annotations to user_to_annotation_state
-    users_with_annotations = [
-        f
-        for f in os.listdir(config["output_annotation_dir"])
-        if os.path.isdir(os.path.join(config["output_annotation_dir"],f)) and f != 'archived_users'
-    ]
-    for user in users_with_annotations:
-        load_user_state(user)
+    with startup_timer.phase("load user states"):
+        users_with_annotations = [
+            f
+            for f in os.listdir(config["output_annotation_dir"])
+            if os.path.isdir(os.path.join(config["output_annotation_dir"],f)) and f != 'archived_users'
+        ]
+        for user in users_with_annotations:
+            load_user_state(user)
+
+    # Resume active learning from the last published round, if any
+    with startup_timer.phase("load active learning state"):
+        init_active_learning_state()
+
+    # Keep the prolific study status up to date in the background now that the
+    # users are loaded, so that dropped users can be released
+    if prolific_study is not None:
+        from server_utils.prolific_apis import ProlificWorkloadController
+
+        prolific_workload_controller = ProlificWorkloadController(
+            prolific_study, sync_period=status_sync_period, on_update=release_dropped_prolific_users
+        )
+        prolific_workload_controller.start()
 
     # TODO: load previous annotation state
     # load_annotation_state(config)
 
+    if getattr(args, "timing", False):
+        print(startup_timer.report())
+
+
+def run_server(args, prepare_config=None):
+    """
+    Run Flask server.
+
+    :prepare_config: an optional function that is called with the loaded config
+      before the server is set up, e.g. to point it at other data
+    """
+    init_server(args, prepare_config)
+
     flask_logger = logging.getLogger("werkzeug")
     flask_logger.setLevel(logging.ERROR)
 
@@ -2863,12 +3452,25 @@ def main():
     args = arguments()
     if args.mode == 'start':
         run_server(args)
+    elif args.mode == 'bench':
+        from server_utils.load_test import run_load_test
+
+        run_load_test(args, run_server)
     elif args.mode == 'get':
-        get_project_from_hub(args.config_file)
+        with startup_timer.phase("get project"):
+            from server_utils.cli_utlis import get_project_from_hub
+
+            get_project_from_hub(args.config_file)
 
     # currently config_file is still an required arg, so when potato list is used, users must add all after it: potato list all
     elif args.mode == 'list':
-        show_project_hub(args.config_file)
+        with startup_timer.phase("list projects"):
+            from server_utils.cli_utlis import show_project_hub
+
+            show_project_hub(args.config_file)
+
+    if args.timing and args.mode in ('get', 'list'):
+        print(startup_timer.report())
 
 
 if __name__ == "__main__":
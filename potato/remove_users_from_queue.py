@@ -50,10 +50,15 @@ if os.path.exists(args.task_assignment_path):
     with open(args.task_assignment_path, "r") as r:
         task_assignment = json.load(r)
 
-for inst_id in task_assignment['assigned']:
+# index the instances assigned to the removed users so that only their
+# assignments are rewritten
+removed_user_instances = set()
+for inst_id, assigned_users in task_assignment['assigned'].items():
+    if type(assigned_users) == list and not user_set.isdisjoint(assigned_users):
+        removed_user_instances.add(inst_id)
+
+for inst_id in removed_user_instances:
     new_li = []
-    if type(task_assignment['assigned'][inst_id]) != list:
-        continue
     for u in task_assignment['assigned'][inst_id]:
         if u in user_set:
             if inst_id not in task_assignment['unassigned']:
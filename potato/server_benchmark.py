@@ -0,0 +1,372 @@
+"""
+Micro-benchmarks for the server's hot functions.
+
+Builds a synthetic project at one of several scales, sets the server up on it
+(without starting it) and times the functions that every annotator or admin
+request goes through: loading the data, sampling and assigning instances,
+saving and loading user states, exporting all annotations, agreement, active
+learning, span rendering/parsing and rendering the annotation page. The
+results are written to a JSON file so that they can be compared across
+releases.
+
+Usage: python -m potato.server_benchmark --scale small --output benchmark.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import yaml
+
+# (instances, users) of each preset scale
+SCALES = {
+    "small": (1000, 10),
+    "medium": (100000, 1000),
+    "large": (1000000, 10000),
+}
+
+LABELS = ["positive", "negative", "neutral", "mixed"]
+SPAN_LABELS = ["target", "cue"]
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    + "incididunt ut labore et dolore magna aliqua"
+).split()
+
+BENCHMARKS = [
+    "load_all_data",
+    "sample_instances",
+    "assign_instances_to_user",
+    "save_user_state",
+    "load_user_state",
+    "save_all_annotations",
+    "cal_agreement",
+    "actively_learn",
+    "render_span_annotations",
+    "parse_html_span_annotation",
+    "annotate_page",
+]
+
+
+def make_project(project_dir, n_instances, instances_per_user, seed=0):
+    """
+    Writes a synthetic project with a radio and a span schema, automatic
+    assignment and active learning, and returns the path of its config.
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(project_dir, "configs"))
+    os.makedirs(os.path.join(project_dir, "data"))
+
+    with open(os.path.join(project_dir, "data", "instances.jsonl"), "wt") as f:
+        for i in range(n_instances):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+            f.write(json.dumps({"id": "item_%d" % i, "text": text}) + "\n")
+
+    config = {
+        "server_name": "potato benchmark",
+        "annotation_task_name": "Benchmark",
+        "output_annotation_dir": "annotation_output/",
+        "output_annotation_format": "jsonl",
+        "annotation_codebook_url": "",
+        "data_files": ["data/instances.jsonl"],
+        "item_properties": {"id_key": "id", "text_key": "text"},
+        "user_config": {"allow_all_users": True, "users": []},
+        "alert_time_each_instance": 10000000,
+        "automatic_assignment": {
+            "on": True,
+            "output_filename": "task_assignment.json",
+            "sampling_strategy": "random",
+            "labels_per_instance": 3,
+            "instance_per_annotator": instances_per_user,
+            "test_question_per_annotator": 0,
+        },
+        "annotation_schemes": [
+            {
+                "annotation_type": "radio",
+                "name": "sentiment",
+                "description": "What is the sentiment of this text?",
+                "labels": LABELS,
+            },
+            {
+                "annotation_type": "highlight",
+                "name": "evidence",
+                "description": "Highlight the evidence for the sentiment",
+                "labels": SPAN_LABELS,
+            },
+        ],
+        "active_learning_config": {
+            "enable_active_learning": True,
+            "classifier_name": "sklearn.linear_model.LogisticRegression",
+            "vectorizer_name": "sklearn.feature_extraction.text.CountVectorizer",
+            "vectorizer_kwargs": {"max_features": 1000},
+            "resolution_strategy": "random",
+            "random_sample_percent": 50,
+            "active_learning_schema": ["sentiment"],
+            # rounds are only run by the benchmark, not by the annotations it makes
+            "update_rate": 10 ** 12,
+            "max_inferred_predictions": 1000,
+        },
+        "html_layout": "default",
+        "base_html_template": "default",
+        "header_file": "default",
+        "site_dir": "default",
+    }
+    config_path = os.path.join(project_dir, "configs", "benchmark.yaml")
+    with open(config_path, "wt") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+class Timings:
+    """
+    The durations of the calls made to each benchmarked function.
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    def time(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.durations.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for name, durations in self.durations.items():
+            ms = np.array(durations) * 1000
+            summary[name] = {
+                "calls": len(ms),
+                "total_s": float(ms.sum() / 1000),
+                "mean_ms": float(ms.mean()),
+                "median_ms": float(np.median(ms)),
+                "p95_ms": float(np.percentile(ms, 95)),
+                "min_ms": float(ms.min()),
+                "max_ms": float(ms.max()),
+            }
+        return summary
+
+
+def assign_directly(fs, username, n_instances):
+    """
+    Assigns the next n_instances unassigned instances to a user, like
+    assign_instances_to_user() with ordered sampling but without its overhead.
+    """
+    unassigned = fs.task_assignment["unassigned"]
+    keys = []
+    for key in unassigned:
+        if len(keys) == n_instances:
+            break
+        keys.append(key)
+    for key in keys:
+        fs.add_task_assignment(key, username)
+        unassigned[key] -= 1
+        if unassigned[key] == 0:
+            del unassigned[key]
+
+    user_state = fs.user_to_annotation_state[username]
+    user_state.real_instance_assigned_count += len(keys)
+    user_state.add_new_assigned_data({key: fs.instance_id_to_data[key] for key in keys})
+
+
+def annotate_users(fs, usernames, rng):
+    """
+    Gives every instance assigned to the users a random label, and some of them
+    a span, as if the users had annotated them.
+    """
+    for username in usernames:
+        user_state = fs.lookup_user_state(username)
+        for instance_id in list(user_state.get_assigned_data().keys()):
+            text = fs.get_displayed_text(instance_id, username)
+            spans = []
+            if rng.random() < 0.3:
+                start = rng.randint(0, max(0, len(text) - 10))
+                label = rng.choice(SPAN_LABELS)
+                spans.append({
+                    "start": start, "end": start + 10, "span": text[start : start + 10],
+                    "annotation": label, "schema": "evidence", "annotation_title": label,
+                })
+            user_state.set_annotation(
+                instance_id, {"sentiment": {rng.choice(LABELS): "1"}}, spans, {}
+            )
+
+
+def run_benchmarks(n_instances, n_users, instances_per_user=50, sample_users=100, repeat=3,
+                   only=None, seed=0):
+    """
+    Sets up a synthetic project and times each benchmarked function on it.
+    Functions called once per user are timed on the first sample_users users,
+    the others are run repeat times.
+    """
+    from potato import flask_server as fs
+    from potato.span_benchmark import make_document
+    from potato.server_utils.schemas import span
+
+    rng = random.Random(seed)
+    random.seed(seed)
+    only = set(only or BENCHMARKS)
+    timings = Timings()
+
+    cwd = os.getcwd()
+    project_dir = tempfile.mkdtemp(prefix="potato_benchmark_")
+    threads_before = set(threading.enumerate())
+    try:
+        config_path = make_project(os.path.join(project_dir, "project"), n_instances, instances_per_user, seed)
+        args = argparse.Namespace(
+            config_file=config_path, verbose=False, very_verbose=False, debug=False, customjs=False,
+            customjs_hostname=None, port=None, ssl_cert=None, ssl_key=None,
+        )
+        fs.init_server(args)
+        config = fs.config
+
+        if "load_all_data" in only:
+            for _ in range(repeat):
+                timings.time("load_all_data", fs.load_all_data, config)
+
+        # New users get their instances through sample_instances() when they
+        # are assigned, so sample for some extra users on their own first
+        usernames = ["user_%d" % i for i in range(n_users)]
+        if "sample_instances" in only:
+            for i in range(min(sample_users, n_users)):
+                timings.time("sample_instances", fs.sample_instances, "sampled_user_%d" % i)
+
+        # Assigning is timed on the sampled users, the others get their
+        # instances directly so that large scales can be set up quickly
+        sampled = usernames[: min(sample_users, n_users)]
+        for username in usernames:
+            fs.user_to_annotation_state[username] = fs.UserAnnotationState(
+                fs.generate_initial_user_dataflow(username)
+            )
+            if username not in sampled:
+                assign_directly(fs, username, instances_per_user)
+            elif "assign_instances_to_user" in only:
+                timings.time("assign_instances_to_user", fs.assign_instances_to_user, username)
+            else:
+                fs.assign_instances_to_user(username)
+        annotate_users(fs, usernames, rng)
+
+        for username in sampled:
+            if "save_user_state" in only:
+                timings.time("save_user_state", fs.save_user_state, username, save_order=True)
+            else:
+                fs.save_user_state(username, save_order=True)
+        if "load_user_state" in only:
+            for username in sampled:
+                timings.time("load_user_state", fs.load_user_state, username)
+
+        for _ in range(repeat):
+            if "save_all_annotations" in only:
+                timings.time("save_all_annotations", fs.save_all_annotations)
+            if "cal_agreement" in only and n_users >= 2:
+                timings.time("cal_agreement", fs.cal_agreement, usernames, "sentiment")
+
+        if "actively_learn" in only:
+            for _ in range(repeat):
+                timings.time("actively_learn", fs.actively_learn)
+
+        if "render_span_annotations" in only or "parse_html_span_annotation" in only:
+            text, annotations = make_document(100000, 1000, seed)
+            for _ in range(repeat):
+                html = timings.time("render_span_annotations", span.render_span_annotations, text, annotations)
+                timings.time("parse_html_span_annotation", span.parse_html_span_annotation, html)
+
+        if "annotate_page" in only:
+            for username in sampled:
+                user_state = fs.lookup_user_state(username)
+                form = {
+                    "email": username,
+                    "instance_id": str(user_state.get_instance_cursor()),
+                    "src": "next_instance",
+                    "sentiment:::" + rng.choice(LABELS): "1",
+                }
+                with fs.app.test_request_context("/annotate", method="POST", data=form):
+                    timings.time("annotate_page", fs.annotate_page)
+    finally:
+        # annotate_page saves the annotations in background threads, which
+        # have to finish before their output dir is removed
+        for thread in threading.enumerate():
+            if thread not in threads_before and not thread.daemon:
+                thread.join()
+        os.chdir(cwd)
+        shutil.rmtree(project_dir, ignore_errors=True)
+        # the annotation pages the server generated for the synthetic project
+        if "site_dir" in fs.config:
+            shutil.rmtree(fs.config["site_dir"], ignore_errors=True)
+
+    return {name: stats for name, stats in timings.summary().items() if name in only}
+
+
+def get_version():
+    try:
+        from importlib.metadata import version
+
+        return version("potato-annotation")
+    except Exception:
+        return None
+
+
+def main(args):
+    n_instances, n_users = SCALES[args.scale]
+    n_instances = args.instances or n_instances
+    n_users = args.users or n_users
+    print("benchmarking with %d instances and %d users" % (n_instances, n_users))
+
+    results = run_benchmarks(
+        n_instances,
+        n_users,
+        instances_per_user=args.instances_per_user,
+        sample_users=args.sample_users,
+        repeat=args.repeat,
+        only=args.only.split(",") if args.only else None,
+        seed=args.seed,
+    )
+
+    print("%-28s %7s %11s %11s %11s" % ("function", "calls", "median ms", "p95 ms", "total s"))
+    for name in BENCHMARKS:
+        if name in results:
+            stats = results[name]
+            print("%-28s %7d %11.2f %11.2f %11.2f" % (
+                name, stats["calls"], stats["median_ms"], stats["p95_ms"], stats["total_s"]))
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "potato_version": get_version(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": {
+            "name": args.scale,
+            "instances": n_instances,
+            "users": n_users,
+            "instances_per_user": args.instances_per_user,
+        },
+        "results": results,
+    }
+    with open(args.output, "wt") as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the server's hot functions")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small",
+                        help="preset number of instances and users")
+    parser.add_argument("--instances", type=int, default=None, help="override the number of instances")
+    parser.add_argument("--users", type=int, default=None, help="override the number of users")
+    parser.add_argument("--instances-per-user", type=int, default=50,
+                        help="instances assigned to each user")
+    parser.add_argument("--sample-users", type=int, default=100,
+                        help="number of users to time the per-user functions on")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the functions that are not per user")
+    parser.add_argument("--only", type=str, default=None,
+                        help="comma-separated functions to benchmark, from: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="the JSON file to write the results to")
+    main(parser.parse_args())
@@ -0,0 +1,199 @@
+"""
+Incremental tracking of inter-annotator agreement.
+
+Krippendorff's alpha only depends on the coincidence matrix of each schema, and
+an instance's contribution to that matrix only depends on the values assigned
+to that instance. When a user changes a label we therefore remove the
+instance's old contribution, update its value counts and add the new
+contribution back, which costs O(labels^2) regardless of how many users or
+instances there are. Alpha can then be served from the coincidence matrix at
+any time without recomputing from scratch.
+"""
+
+import threading
+from collections import Counter
+
+import numpy as np
+
+from potato.server_utils.krippendorff import (
+    alpha_from_coincidence,
+    binary_alpha,
+    distance_matrix,
+)
+
+
+def _label_names(schema):
+    return [l if isinstance(l, str) else l["name"] for l in schema.get("labels", [])]
+
+
+class CategoricalAgreement:
+    """
+    Coincidence counts for a schema where each annotation is a single value
+    (radio buttons or likert scales).
+    """
+
+    def __init__(self, schema):
+        self.annotation_type = schema["annotation_type"]
+        self.level_of_measurement = schema.get(
+            "agreement_level", "interval" if self.annotation_type == "likert" else "nominal"
+        )
+        self.categories = []
+        self.category_to_code = {}
+        self.coincidence = np.zeros((0, 0))
+        self.unit_counts = {}
+
+    def get_value(self, label_to_value):
+        """
+        Returns the value of an annotation for this schema, or None if there
+        isn't one.
+        """
+        if not label_to_value:
+            return None
+        label = next(iter(label_to_value))
+        if self.annotation_type == "likert":
+            return int(label[6:])
+        return label
+
+    def _code(self, value):
+        if value not in self.category_to_code:
+            self.category_to_code[value] = len(self.categories)
+            self.categories.append(value)
+            grown = np.zeros((len(self.categories), len(self.categories)))
+            grown[:-1, :-1] = self.coincidence
+            self.coincidence = grown
+        return self.category_to_code[value]
+
+    def _add_contribution(self, counts, sign):
+        m = sum(counts.values())
+        if m < 2:
+            return
+        for c, n_c in counts.items():
+            for k, n_k in counts.items():
+                pairs = n_c * n_k - (n_c if c == k else 0)
+                self.coincidence[c, k] += sign * pairs / (m - 1)
+
+    def replace(self, instance_id, old_value, new_value):
+        counts = self.unit_counts.setdefault(instance_id, Counter())
+        self._add_contribution(counts, -1)
+        if old_value is not None:
+            counts[self._code(old_value)] -= 1
+        if new_value is not None:
+            counts[self._code(new_value)] += 1
+        counts += Counter()  # drop the zero counts
+        self._add_contribution(counts, 1)
+
+        if counts:
+            self.unit_counts[instance_id] = counts
+        else:
+            del self.unit_counts[instance_id]
+
+    def alpha(self):
+        if len(self.categories) == 0:
+            return float("nan")
+
+        # The ordinal and interval metrics need the categories in sorted order
+        order = sorted(range(len(self.categories)), key=lambda i: self.categories[i])
+        o = self.coincidence[np.ix_(order, order)]
+        categories = [self.categories[i] for i in order]
+        return alpha_from_coincidence(o, distance_matrix(categories, o, self.level_of_measurement))
+
+
+class MultiselectAgreement:
+    """
+    Coincidence counts for a multiselect schema, where every label is treated
+    as its own binary (selected or not) annotation.
+    """
+
+    def __init__(self, schema):
+        self.labels = _label_names(schema)
+        self.label_to_index = {l: i for i, l in enumerate(self.labels)}
+        self.o_00 = np.zeros(len(self.labels))
+        self.o_01 = np.zeros(len(self.labels))
+        self.o_11 = np.zeros(len(self.labels))
+
+        # instance id -> (number of annotations, times each label was selected)
+        self.unit_counts = {}
+
+    def get_value(self, label_to_value):
+        if not label_to_value:
+            return None
+        return frozenset(l for l in label_to_value if l in self.label_to_index)
+
+    def _add_contribution(self, m, n_1, sign):
+        if m < 2:
+            return
+        n_0 = m - n_1
+        self.o_00 += sign * n_0 * (n_0 - 1) / (m - 1)
+        self.o_01 += sign * n_0 * n_1 / (m - 1)
+        self.o_11 += sign * n_1 * (n_1 - 1) / (m - 1)
+
+    def replace(self, instance_id, old_value, new_value):
+        m, n_1 = self.unit_counts.get(instance_id, (0, np.zeros(len(self.labels))))
+        self._add_contribution(m, n_1, -1)
+
+        n_1 = n_1.copy()
+        if old_value is not None:
+            m -= 1
+            for l in old_value:
+                n_1[self.label_to_index[l]] -= 1
+        if new_value is not None:
+            m += 1
+            for l in new_value:
+                n_1[self.label_to_index[l]] += 1
+        self._add_contribution(m, n_1, 1)
+
+        if m > 0:
+            self.unit_counts[instance_id] = (m, n_1)
+        else:
+            self.unit_counts.pop(instance_id, None)
+
+    def alpha(self):
+        alphas = binary_alpha(self.o_00, self.o_01, self.o_11)
+        return {label: float(alphas[i]) for i, label in enumerate(self.labels)}
+
+
+class AgreementTracker:
+    """
+    Keeps the agreement state of every radio, likert and multiselect schema up
+    to date as annotations are set or removed.
+    """
+
+    schema_classes = {
+        "radio": CategoricalAgreement,
+        "likert": CategoricalAgreement,
+        "multiselect": MultiselectAgreement,
+    }
+
+    def __init__(self, annotation_schemes):
+        self.lock = threading.Lock()
+        self.schemas = {}
+        for schema in annotation_schemes:
+            schema_class = self.schema_classes.get(schema["annotation_type"])
+            if schema_class is not None:
+                self.schemas[schema["name"]] = schema_class(schema)
+
+    def update(self, instance_id, old_labels, new_labels):
+        """
+        Updates the counts after one user's labels for an instance changed from
+        old_labels to new_labels (both schema -> label -> value dicts, and
+        either may be empty).
+        """
+        old_labels = old_labels or {}
+        new_labels = new_labels or {}
+        with self.lock:
+            for name, schema_agreement in self.schemas.items():
+                old_value = schema_agreement.get_value(old_labels.get(name))
+                new_value = schema_agreement.get_value(new_labels.get(name))
+                if old_value != new_value:
+                    schema_agreement.replace(instance_id, old_value, new_value)
+
+    def alpha(self, schema_name):
+        """
+        Returns the current alpha of a schema: a float for radio and likert
+        schemas, a dict of label -> alpha for multiselect schemas, and None for
+        schemas that are not tracked.
+        """
+        if schema_name not in self.schemas:
+            return None
+        with self.lock:
+            return self.schemas[schema_name].alpha()
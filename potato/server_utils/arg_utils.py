@@ -14,8 +14,8 @@ def arguments():
 
     parser.add_argument(
         "mode",
-        choices=['start', 'get', 'list'],
-        help="set the mode when potato is used, currently supporting: start, get, list",
+        choices=['start', 'get', 'list', 'bench'],
+        help="set the mode when potato is used, currently supporting: start, get, list, bench",
         default="start",
     )
 
@@ -63,6 +63,13 @@ def arguments():
         default=None,
     )
 
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Report how long importing and each phase of starting up take",
+        default=False,
+    )
+
     parser.add_argument(
         "--ssl-cert",
         action="store",
@@ -81,4 +88,85 @@ def arguments():
         default=None
     )
 
+    profiling = parser.add_argument_group("profiling", "options for profiling slow requests")
+    profiling.add_argument(
+        "--profile-slow-ms",
+        type=float,
+        dest="profile_slow_ms",
+        help="write the stacks of requests slower than this many milliseconds to the profiling directory",
+        default=None,
+    )
+    profiling.add_argument(
+        "--profile-sample-rate",
+        type=float,
+        dest="profile_sample_rate",
+        help="fraction of requests to profile regardless of how long they take",
+        default=None,
+    )
+    profiling.add_argument(
+        "--profile-dir",
+        type=str,
+        dest="profile_dir",
+        help="directory to write the request profiles to",
+        default=None,
+    )
+
+    bench = parser.add_argument_group("bench", "options for load testing with potato bench")
+    bench.add_argument(
+        "--users",
+        type=int,
+        dest="bench_users",
+        help="number of concurrent virtual annotators",
+        default=100,
+    )
+    bench.add_argument(
+        "--duration",
+        type=float,
+        dest="bench_duration",
+        help="seconds to run the virtual annotators for after they have all started",
+        default=60,
+    )
+    bench.add_argument(
+        "--ramp-up",
+        type=float,
+        dest="bench_ramp_up",
+        help="seconds over which the virtual annotators are started",
+        default=10,
+    )
+    bench.add_argument(
+        "--think-time",
+        type=float,
+        dest="bench_think_time",
+        help="mean seconds each virtual annotator waits between actions",
+        default=2.0,
+    )
+    bench.add_argument(
+        "--instances",
+        type=int,
+        dest="bench_instances",
+        help="number of instances in the synthetic dataset",
+        default=1000,
+    )
+    bench.add_argument(
+        "--mix",
+        type=str,
+        dest="bench_mix",
+        help="relative frequency of the next, prev, go_to and span actions",
+        default="next=0.6,prev=0.1,go_to=0.1,span=0.2",
+    )
+    bench.add_argument(
+        "--bench-processes",
+        type=int,
+        dest="bench_processes",
+        help="number of client processes to run the virtual annotators in (default: the number of CPUs)",
+        default=None,
+    )
+    bench.add_argument(
+        "--bench-output",
+        type=str,
+        dest="bench_output",
+        help="write the latency report to this JSON file",
+        default=None,
+    )
+
     return parser.parse_args()
@@ -2,7 +2,6 @@
 Config module.
 """
 
-import yaml
 import os
 
 config = {}
@@ -64,6 +63,8 @@ def init_config(args):
         print("configuration file not found under %s, please make sure .yaml file exists in the given directory, or please directly give the path of the .yaml file" % config_folder)
         quit()
 
+    import yaml
+
     print("starting server from %s" % config_file)
     with open(config_file, "r") as file_p:
         config.update(yaml.safe_load(file_p))
@@ -79,6 +80,19 @@ def init_config(args):
         }
     )
 
+    # the profiling options on the command line override the config
+    profiling_args = {
+        "slow_threshold_ms": getattr(args, "profile_slow_ms", None),
+        "sample_rate": getattr(args, "profile_sample_rate", None),
+        "output_dir": getattr(args, "profile_dir", None),
+    }
+    profiling_args = {k: v for k, v in profiling_args.items() if v is not None}
+    if "output_dir" in profiling_args:
+        # relative to where potato was started, not the project dir
+        profiling_args["output_dir"] = os.path.abspath(profiling_args["output_dir"])
+    if profiling_args:
+        config["request_profiling"] = {**(config.get("request_profiling") or {}), **profiling_args}
+
     # update the current working dir for the server
     os.chdir(project_dir)
     print("the current working directory is: %s"%project_dir)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Rendering of the text displayed for each instance.
+
+With list_as_text on, an instance's text can be a list or dict (possibly
+stringified in a CSV) that is unfolded into HTML blocks. The blocks of each
+instance are built the first time it is shown and cached, and the optional
+randomization is applied per user by permuting the cached blocks with a
+permutation seeded by the user and instance, so each user sees their own
+order, and always the same one, without the HTML being rebuilt.
+"""
+
+import ast
+import random
+import string
+
+RANDOMIZATIONS = ("value", "key")
+
+
+class DictBlocks:
+    """
+    The cached HTML of a dict instance: the opening of each key's block (with
+    its legend), the values and the text that closes each block.
+    """
+
+    def __init__(self, heads, values, tail, prefix, suffix):
+        self.heads = heads
+        self.values = values
+        self.tail = tail
+        self.prefix = prefix
+        self.suffix = suffix
+        self.blocks = [head + value + tail for head, value in zip(heads, values)]
+        self.text = prefix + "".join(self.blocks) + suffix
+
+    def render(self, permutation, randomization):
+        if randomization == "key":
+            blocks = [self.blocks[i] for i in permutation]
+        else:
+            blocks = [head + self.values[i] + self.tail for head, i in zip(self.heads, permutation)]
+        return self.prefix + "".join(blocks) + self.suffix
+
+
+class DisplayedTextRenderer:
+    """
+    Renders and caches the displayed text of instances according to the
+    list_as_text config.
+    """
+
+    def __init__(self, list_as_text=None):
+        # list_as_text may just be set to True
+        self.enabled = bool(list_as_text)
+        self.options = list_as_text if isinstance(list_as_text, dict) else {}
+        self.randomization = None
+        if "randomization" in self.options:
+            self.randomization = self.options["randomization"]
+            if self.randomization not in RANDOMIZATIONS:
+                print(
+                    "WARNING: %s currently not supported for list_as_text, please check your .yaml file"
+                    % self.randomization
+                )
+                self.randomization = None
+
+        # instance id -> the displayed text (a str) or the DictBlocks to permute
+        self.instance_id_to_blocks = {}
+
+    def parse(self, text):
+        """
+        Returns the list or dict in a stringified text, or the text as it is if
+        it is not one.
+        """
+        if isinstance(text, str):
+            try:
+                return ast.literal_eval(text)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                return text
+        return text
+
+    def build(self, text):
+        """
+        Unfolds the text of an instance into its HTML, or into DictBlocks for
+        dicts.
+        """
+        if not self.enabled:
+            return text
+
+        text = self.parse(text)
+        if isinstance(text, list):
+            # automatically unfold the text list when input text is a list (e.g. best-worst-scaling).
+            text = [str(t) for t in text]
+            if self.options.get("text_list_prefix_type") == "alphabet":
+                prefix_list = list(string.ascii_uppercase)
+                text = [prefix_list[i] + ". " + text[i] for i in range(len(text))]
+            elif self.options.get("text_list_prefix_type") == "number":
+                text = [str(i) + ". " + text[i] for i in range(len(text))]
+            return "<br>".join(text)
+
+        if isinstance(text, dict) and len(text) > 0:
+            # unfolding dict into different sections
+            values = [str(v) for v in text.values()]
+            if self.options.get("horizontal"):
+                width = "%d" % int(100 / len(text)) + "%"
+                heads = [
+                    '<div id="instance-text" name="instance_text" style="float:left;width:%s;padding:5px;" class="column"> <legend> %s </legend> '
+                    % (width, key)
+                    for key in text
+                ]
+                return DictBlocks(heads, values, " </div>", '<div class="row" style="display: table"> ', " </div>")
+
+            heads = ['<div id="instance-text" name="instance_text"> <legend> %s </legend> ' % key for key in text]
+            return DictBlocks(heads, values, " <br/> </div>", "", "")
+
+        return text
+
+    def get_displayed_text(self, instance_id, text, username=None):
+        """
+        Returns the displayed text of an instance, randomized for the user if
+        randomization is on and a user is given.
+        """
+        if instance_id not in self.instance_id_to_blocks:
+            self.instance_id_to_blocks[instance_id] = self.build(text)
+        blocks = self.instance_id_to_blocks[instance_id]
+
+        if not isinstance(blocks, DictBlocks):
+            return blocks
+        if self.randomization is None or username is None or len(blocks.values) < 2:
+            return blocks.text
+
+        permutation = list(range(len(blocks.values)))
+        random.Random("%s:%s" % (username, instance_id)).shuffle(permutation)
+        return blocks.render(permutation, self.randomization)
@@ -0,0 +1,575 @@
+"""
+Export of all the users' annotations to annotated_instances.<format>.
+
+Rows are written as the users' annotations are iterated, so exporting only
+holds one user's annotations (and, for the columnar formats, one batch of
+rows) in memory no matter how large the study is. A full export is written to a temporary file
+that replaces the previous export at the end, so readers never see a partial
+file.
+
+In incremental mode, the annotations that changed since the last export are
+appended instead, and the export is fully rewritten every
+full_rewrite_interval seconds to drop the rows that were superseded. Until
+then a user's instance can have several rows, of which the last is the
+current one.
+
+The parquet and arrow exports are typed for analysis: each schema and label
+gets a column typed by its annotation type (integer for likert scales, float
+for numbers, string for text boxes and choices, widened if a value doesn't
+fit) or, for labels that are not in the config, by its values. The spans are a
+list of structs and the behavioral data is a map. The arrow export is in the
+Arrow IPC file format, which can be memory-mapped and read without copying
+(pyarrow.ipc.open_file(pyarrow.memory_map(path))). Both are written as a
+directory of parts, so incremental exports add a part and full exports
+replace all of them.
+"""
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+
+EXPORT_FORMATS = ("json", "jsonl", "csv", "tsv", "parquet", "arrow")
+
+# The formats that are written by pyarrow, as directories of parts
+COLUMNAR_FORMATS = ("parquet", "arrow")
+
+# Rows per parquet row group or arrow record batch, which bounds the memory of
+# the columnar exports
+ARROW_BATCH_SIZE = 10000
+
+# The types of the label columns in the columnar exports, from the narrowest
+LABEL_TYPES = ("int", "float", "string")
+
+SPAN_FIELDS = (
+    ("start", "int"),
+    ("end", "int"),
+    ("span", "string"),
+    ("annotation", "string"),
+    ("schema", "string"),
+    ("annotation_title", "string"),
+)
+
+
+def label_type(value):
+    """
+    Returns the narrowest of LABEL_TYPES that holds a label value (as the
+    values posted by the forms are strings, "3" is an int).
+    """
+    if isinstance(value, bool):
+        return "string"
+    try:
+        int(value)
+        return "int"
+    except (TypeError, ValueError):
+        pass
+    try:
+        float(value)
+        return "float"
+    except (TypeError, ValueError):
+        return "string"
+
+
+def get_label_types(annotation_schemes):
+    """
+    Returns the type of the values of each schema ("schema" -> type) or label
+    (("schema", "label") -> type), from their annotation types.
+    """
+    label_types = {}
+    for scheme in annotation_schemes:
+        annotation_type = scheme["annotation_type"]
+        if annotation_type == "likert":
+            label_types[scheme["name"]] = "int"
+        elif annotation_type == "number":
+            label_types[scheme["name"]] = "float"
+        elif annotation_type == "slider":
+            # the slider posts its value as slider:::<schema name>
+            bounds = [scheme.get(key, 0) for key in ("min_value", "max_value", "step")]
+            value_type = "int" if all(float(bound).is_integer() for bound in bounds) else "float"
+            label_types[("slider", scheme["name"])] = value_type
+        elif annotation_type not in ("highlight", "pure_display"):
+            label_types[scheme["name"]] = "string"
+    return label_types
+
+
+def column_type(schema, label, value, label_types=None):
+    """
+    Returns the type of a label's column: its declared type in label_types,
+    widened if the value doesn't fit it, or the type of the value.
+    """
+    inferred = label_type(value)
+    declared = None
+    if label_types:
+        declared = label_types.get((schema, label), label_types.get(schema))
+    if declared is None:
+        return inferred
+    return max(declared, inferred, key=LABEL_TYPES.index)
+
+
+def convert_value(value, value_type):
+    if value is None:
+        return None
+    if value_type == "int":
+        return int(value)
+    if value_type == "float":
+        return float(value)
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def temporary_path(path):
+    # parquet readers skip the files starting with "_" in a dataset directory
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "_" + name + ".tmp")
+
+
+class JsonlWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, record):
+        json.dump(record, self.f)
+        self.f.write("\n")
+
+    def close(self):
+        self.f.close()
+
+
+class DelimitedWriter:
+    """
+    Writes a CSV/TSV row per record, with a column per schema and label and
+    one per span label (holding the spans with that label).
+    """
+
+    def __init__(self, f, sep, schema_to_labels, span_labels, header=True):
+        self.f = f
+        self.writer = csv.writer(self.f, delimiter=sep)
+        self.schema_to_labels = schema_to_labels
+        self.span_labels = span_labels
+        if header:
+            self.writer.writerow(
+                ["user", "instance_id", "displayed_text"]
+                + [schema + ":::" + label for schema, labels in schema_to_labels.items() for label in labels]
+                + ["span_annotation:::" + span_label for span_label in span_labels]
+            )
+
+    def write(self, record):
+        row = [record["user_id"], record["instance_id"], record["displayed_text"]]
+        label_annotations = record["label_annotations"]
+        for schema, labels in self.schema_to_labels.items():
+            label_vals = label_annotations.get(schema, {})
+            for label in labels:
+                val = label_vals.get(label)
+                row.append("" if val is None else val)
+
+        # We bunch spans by their label to make it slightly easier to
+        # process, but it's still kind of messy compared with the JSON
+        # format.
+        for span_label in self.span_labels:
+            row.append([sa for sa in record["span_annotations"] if sa["annotation"] == span_label])
+        self.writer.writerow(row)
+
+    def close(self):
+        self.f.close()
+
+
+class ArrowWriter:
+    """
+    Writes the records to a parquet or Arrow IPC file in batches, with a typed
+    column per schema and label.
+
+    :schema_to_labels: schema -> label -> the type of its column
+    """
+
+    def __init__(self, path, fmt, schema_to_labels):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.label_columns = [
+            (schema + ":::" + label, schema, label, value_type)
+            for schema, labels in schema_to_labels.items()
+            for label, value_type in labels.items()
+        ]
+        arrow_types = {"int": pa.int64(), "float": pa.float64(), "string": pa.string()}
+        span_type = pa.struct([(name, arrow_types[value_type]) for name, value_type in SPAN_FIELDS])
+        self.schema = pa.schema(
+            [("user_id", pa.string()), ("instance_id", pa.string()), ("displayed_text", pa.string())]
+            + [(column, arrow_types[value_type]) for column, _, _, value_type in self.label_columns]
+            + [("span_annotations", pa.list_(span_type)), ("behavioral_data", pa.map_(pa.string(), pa.string()))]
+        )
+        if fmt == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+        self.batch = []
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= ARROW_BATCH_SIZE:
+            self.flush()
+
+    def convert_label(self, value, value_type):
+        # a value that was changed after the column types were collected may not
+        # fit its column, it is left out rather than failing the whole export
+        try:
+            return convert_value(value, value_type)
+        except (TypeError, ValueError):
+            return None
+
+    def convert_spans(self, spans):
+        # spans can be stored as an empty dict
+        return [
+            {name: convert_value(span.get(name), value_type) for name, value_type in SPAN_FIELDS}
+            for span in (spans if isinstance(spans, list) else [])
+        ]
+
+    def flush(self):
+        if not self.batch:
+            return
+        columns = {
+            # the ids are kept as they are in the data files, which can be numbers
+            "user_id": [convert_value(record["user_id"], "string") for record in self.batch],
+            "instance_id": [convert_value(record["instance_id"], "string") for record in self.batch],
+            "displayed_text": [convert_value(record["displayed_text"], "string") for record in self.batch],
+        }
+        for column, schema, label, value_type in self.label_columns:
+            columns[column] = [
+                self.convert_label(record["label_annotations"].get(schema, {}).get(label), value_type)
+                for record in self.batch
+            ]
+        columns["span_annotations"] = [self.convert_spans(record["span_annotations"]) for record in self.batch]
+        columns["behavioral_data"] = [
+            [(key, convert_value(value, "string")) for key, value in record["behavioral_data"].items()]
+            for record in self.batch
+        ]
+        self.writer.write_table(self.pa.table(columns, schema=self.schema))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def make_record(user_id, user_state, instance_id, annotations, get_displayed_text):
+    """
+    Returns the exported record of a user's annotations on an instance.
+    """
+    return {
+        "user_id": user_id,
+        "instance_id": instance_id,
+        "displayed_text": get_displayed_text(instance_id, user_id),
+        "label_annotations": annotations["labels"],
+        "span_annotations": annotations["spans"],
+        "behavioral_data": user_state.instance_id_to_behavioral_data.get(instance_id, {}),
+    }
+
+
+def column_updates(record, schema_to_labels, span_labels, typed=False, label_types=None):
+    """
+    Yields the ("label", schema, label, type) columns a record needs that are
+    missing from schema_to_labels or have to be widened to a new type, and the
+    ("span", None, label, None) columns missing from span_labels.
+
+    :label_types: the declared types of the typed columns, from get_label_types()
+    """
+    for schema, label_vals in record["label_annotations"].items():
+        labels = schema_to_labels.get(schema, {})
+        for label, value in label_vals.items():
+            value_type = column_type(schema, label, value, label_types) if typed else None
+            if label not in labels or (
+                typed and LABEL_TYPES.index(value_type) > LABEL_TYPES.index(labels[label])
+            ):
+                yield "label", schema, label, value_type
+    if typed:
+        # the spans are all in one column
+        return
+    for span in record["span_annotations"]:
+        if span["annotation"] not in span_labels:
+            yield "span", None, span["annotation"], None
+
+
+def add_columns(records, schema_to_labels, span_labels, typed=False, label_types=None):
+    """
+    Adds the columns the records need to schema_to_labels (schema -> label ->
+    the type of its values, if typed) and span_labels, and returns whether any
+    were added or had to be widened to a new type.
+    """
+    added = False
+    for record in records:
+        updates = list(column_updates(record, schema_to_labels, span_labels, typed, label_types))
+        for kind, schema, label, value_type in updates:
+            if kind == "label":
+                schema_to_labels.setdefault(schema, {})[label] = value_type
+            else:
+                span_labels[label] = None
+            added = True
+    return added
+
+
+def stream_records(iter_records, fmt, chunk_size=65536):
+    """
+    Yields the records as chunks of JSONL, CSV or TSV text, for streaming them
+    in a response without writing a file.
+
+    :iter_records: a function that returns an iterator over the records. For
+      CSV/TSV it is called twice, first to find the columns
+    """
+    buffer = io.StringIO()
+    if fmt in ("csv", "tsv"):
+        schema_to_labels, span_labels = {}, {}
+        add_columns(iter_records(), schema_to_labels, span_labels)
+        writer = DelimitedWriter(buffer, "," if fmt == "csv" else "\t", schema_to_labels, span_labels)
+    else:
+        writer = JsonlWriter(buffer)
+
+    for record in iter_records():
+        writer.write(record)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class AnnotationExporter:
+    """
+    Exports the annotations of all users, fully or incrementally.
+
+    :user_states: a function that returns the (user id, user state) pairs to
+      export
+    :get_displayed_text: a function that returns the text a user saw for an
+      instance
+    """
+
+    def __init__(self, output_dir, fmt, user_states, get_displayed_text, incremental=False,
+                 full_rewrite_interval=600, label_types=None):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("Unsupported output format: " + fmt)
+        if fmt in COLUMNAR_FORMATS:
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError("The %s output format requires pyarrow, install it with: pip install pyarrow" % fmt)
+
+        self.fmt = fmt
+        self.path = os.path.join(output_dir, "annotated_instances." + fmt)
+        self.user_states = user_states
+        self.get_displayed_text = get_displayed_text
+        self.incremental = incremental
+        self.full_rewrite_interval = full_rewrite_interval
+        # the declared types of the columnar exports' columns
+        self.label_types = label_types or {}
+
+        self.lock = threading.Lock()
+        # the (user id, instance id) pairs changed since the last export
+        self.changed = set()
+        # whether an export is running, and whether another was asked for meanwhile
+        self.running = False
+        self.pending = False
+
+        self.last_full_export = None
+        self.parts = 0
+        # the columns of the CSV/TSV and columnar exports: schema -> label ->
+        # the type of its values, and the span labels
+        self.schema_to_labels = {}
+        self.span_labels = {}
+
+    @classmethod
+    def from_config(cls, config, user_states, get_displayed_text):
+        options = config.get("annotation_export") or {}
+        return cls(
+            config["output_annotation_dir"],
+            config["output_annotation_format"],
+            user_states,
+            get_displayed_text,
+            incremental=options.get("incremental", False),
+            full_rewrite_interval=options.get("full_rewrite_interval", 600),
+            label_types=get_label_types(config.get("annotation_schemes", [])),
+        )
+
+    def mark_changed(self, user_id, instance_id):
+        with self.lock:
+            self.changed.add((user_id, instance_id))
+
+    def get_queue_depth(self):
+        """
+        Returns the number of exports running or waiting to run (at most 2,
+        since the exports asked for while one runs are coalesced).
+        """
+        with self.lock:
+            return int(self.running) + int(self.pending)
+
+    def get_pending_change_count(self):
+        with self.lock:
+            return len(self.changed)
+
+    def export(self):
+        """
+        Exports the annotations. If an export is already running, it runs once
+        more when it is done instead, so concurrent calls never write the same
+        file and bursts of changes are written together.
+        """
+        with self.lock:
+            if self.running:
+                self.pending = True
+                return
+            self.running = True
+
+        try:
+            while True:
+                with self.lock:
+                    changed, self.changed = self.changed, set()
+                    self.pending = False
+                try:
+                    self.export_once(changed)
+                except BaseException:
+                    # keep the changes for the next export, or incremental
+                    # exports would miss them until the next full rewrite
+                    with self.lock:
+                        self.changed |= changed
+                    raise
+                with self.lock:
+                    if not self.pending:
+                        self.running = False
+                        return
+        except BaseException:
+            with self.lock:
+                self.running = False
+            raise
+
+    def export_once(self, changed):
+        full = (
+            not self.incremental
+            or self.last_full_export is None
+            or time.time() - self.last_full_export >= self.full_rewrite_interval
+        )
+        if not full:
+            records = list(self.iter_changed_records(changed))
+            # a new column (or a wider type) changes the header or schema of
+            # the export, so rewrite everything
+            if self.fmt not in ("json", "jsonl") and self.add_columns(records):
+                full = True
+            else:
+                self.append(records)
+        if full:
+            self.rewrite()
+
+    def iter_records(self):
+        for user_id, user_state in self.user_states():
+            for instance_id, annotations in user_state.get_all_annotations().items():
+                yield self.make_record(user_id, user_state, instance_id, annotations)
+
+    def iter_changed_records(self, changed):
+        user_states = dict(self.user_states())
+        for user_id, instance_id in sorted(changed):
+            if user_id not in user_states:
+                continue
+            user_state = user_states[user_id]
+            # an instance whose annotations were all removed still gets a row
+            annotations = {
+                "labels": user_state.instance_id_to_labeling.get(instance_id, {}),
+                "spans": user_state.instance_id_to_span_annotations.get(instance_id, []),
+            }
+            yield self.make_record(user_id, user_state, instance_id, annotations)
+
+    def make_record(self, user_id, user_state, instance_id, annotations):
+        return make_record(user_id, user_state, instance_id, annotations, self.get_displayed_text)
+
+    def add_columns(self, records):
+        """
+        Adds the columns the records need, and returns whether any were added
+        or had to be widened to a new type.
+        """
+        return add_columns(
+            records,
+            self.schema_to_labels,
+            self.span_labels,
+            typed=self.fmt in COLUMNAR_FORMATS,
+            label_types=self.label_types,
+        )
+
+    def open_writer(self, path, mode):
+        if self.fmt in ("csv", "tsv"):
+            sep = "," if self.fmt == "csv" else "\t"
+            return DelimitedWriter(
+                open(path, mode, newline=""), sep, self.schema_to_labels, self.span_labels, header=mode == "wt"
+            )
+        if self.fmt in COLUMNAR_FORMATS:
+            return ArrowWriter(path, self.fmt, self.schema_to_labels)
+        # We write jsonl format regardless
+        return JsonlWriter(open(path, mode))
+
+    def part_name(self, i):
+        return "part-%05d.%s" % (i, self.fmt)
+
+    def rewrite(self):
+        started = time.time()
+        if self.fmt not in ("json", "jsonl"):
+            # the columns have to be known before the first row is written
+            self.schema_to_labels = {}
+            self.span_labels = {}
+            for user_id, user_state in self.user_states():
+                self.add_columns(
+                    {"label_annotations": annotations["labels"], "span_annotations": annotations["spans"]}
+                    for annotations in user_state.get_all_annotations().values()
+                )
+
+        if self.fmt in COLUMNAR_FORMATS:
+            os.makedirs(self.path, exist_ok=True)
+            target = os.path.join(self.path, self.part_name(0))
+        else:
+            target = self.path
+        tmp_path = temporary_path(target)
+
+        # records changed after their columns were collected may need columns
+        # the header doesn't have, their values are left out and they are
+        # exported once more, with the new columns
+        typed = self.fmt in COLUMNAR_FORMATS
+        late = set()
+        writer = self.open_writer(tmp_path, "wt")
+        try:
+            for record in self.iter_records():
+                if self.fmt not in ("json", "jsonl") and any(
+                    column_updates(record, self.schema_to_labels, self.span_labels, typed, self.label_types)
+                ):
+                    late.add((record["user_id"], record["instance_id"]))
+                writer.write(record)
+        finally:
+            writer.close()
+        os.replace(tmp_path, target)
+        if late:
+            with self.lock:
+                self.changed |= late
+                self.pending = True
+
+        if self.fmt in COLUMNAR_FORMATS:
+            # drop the parts of earlier incremental exports
+            for name in os.listdir(self.path):
+                if name.startswith("part-") and name != self.part_name(0):
+                    os.remove(os.path.join(self.path, name))
+            self.parts = 1
+        self.last_full_export = started
+
+    def append(self, records):
+        if not records:
+            return
+        if self.fmt in COLUMNAR_FORMATS:
+            path = os.path.join(self.path, self.part_name(self.parts))
+            tmp_path = temporary_path(path)
+            writer = self.open_writer(tmp_path, "wt")
+            for record in records:
+                writer.write(record)
+            writer.close()
+            os.replace(tmp_path, path)
+            self.parts += 1
+            return
+
+        writer = self.open_writer(self.path, "at")
+        try:
+            for record in records:
+                writer.write(record)
+        finally:
+            writer.close()
@@ -6,7 +6,11 @@ import os
 import logging
 import json
 import re
+import glob
+import hashlib
 from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 #add local module
 from pathlib import Path
@@ -27,10 +31,19 @@ from potato.server_utils.schemas import (
     generate_select_layout,
     generate_slider_layout,
 )
+from potato.server_utils.schemas.select import PREDEFINED_LABEL_FILES
+from potato.server_utils.schemas.span import get_span_colors, set_span_color
 
 logger = logging.getLogger(__name__)
 
 
+# The file in a project's site dir that records which config and template files
+# its pages were generated from
+SITE_CACHE_FILE = "site_cache.json"
+
+# The config keys that generate_site() and generate_surveyflow_pages() set
+SITE_OUTPUT_KEYS = ("site_file", "surveyflow_site_file", "non_annotation_pages")
+
 # TODO: Move this to config.yaml files
 # Items which will be displayed in the popup statistics sidebar
 STATS_KEYS = {
@@ -447,7 +460,7 @@ def generate_surveyflow_pages(config):
     else:
         # If we don't have a custom layout, accumulate all the tasks into a
         # single HTML element
-        for i, page in enumerate(surveyflow_pages):
+        def generate_page(i, page):
             schema_layouts = ""
             # for annotation_scheme in annotation_schemes:
             for line in surveyflow_pages[page]:
@@ -507,16 +520,23 @@ def generate_surveyflow_pages(config):
 
             output_html_fname = os.path.join(config["site_dir"], site_name)
 
-            # Cache this path as a shortcut to figure out which page to render
-            if "surveyflow_site_file" not in config:
-                config["surveyflow_site_file"] = {}
-            config["surveyflow_site_file"][page] = site_name
-
             # Write the file
             with open(output_html_fname, "wt") as outf:
                 outf.write(cur_html_template)
 
             logger.debug("writing annotation html to %s%s.html" % (output_html_fname, page))
+            return site_name
+
+        # The pages are independent, so they are rendered and written
+        # concurrently
+        with ThreadPoolExecutor() as executor:
+            site_names = list(executor.map(generate_page, range(len(surveyflow_pages)), surveyflow_pages))
+
+        # Cache these paths as a shortcut to figure out which page to render
+        if "surveyflow_site_file" not in config:
+            config["surveyflow_site_file"] = {}
+        for page, site_name in zip(surveyflow_pages, site_names):
+            config["surveyflow_site_file"][page] = site_name
 
     config["non_annotation_pages"] = []
     for key in surveyflow["order"]:
@@ -536,3 +556,137 @@ def generate_surveyflow_pages(config):
 
         config["%s_pages" % key] = page_list
         config["non_annotation_pages"] += [it['id'] for it in config["%s_pages" % key]]
+
+
+def get_site_output_keys(config):
+    """
+    Returns the config keys that generating the site sets, which are restored
+    from the cache when the site is not regenerated.
+    """
+    keys = list(SITE_OUTPUT_KEYS)
+    if config.get("surveyflow"):
+        keys += ["%s_pages" % key for key in config["surveyflow"].get("order", [])]
+    return keys
+
+
+def find_template_file(config, path):
+    """
+    Returns where a template file is, either at the given path or relative to
+    the config file, or None if it is in neither place.
+    """
+    if os.path.exists(path):
+        return path
+    abs_path = os.path.dirname(os.path.realpath(config["__config_file__"])) + "/" + path
+    return abs_path if os.path.exists(abs_path) else None
+
+
+def get_schema_files(annotation_scheme):
+    """
+    Returns the files that generating an annotation scheme reads: the tooltip
+    files of the scheme and its labels, and the file its labels are listed in.
+    """
+    files = []
+    if annotation_scheme.get("tooltip_file"):
+        files.append(annotation_scheme["tooltip_file"])
+    labels = annotation_scheme.get("labels")
+    if isinstance(labels, str):
+        files.append(labels)
+    elif isinstance(labels, list):
+        files += [
+            label["tooltip_file"] for label in labels if isinstance(label, Mapping) and "tooltip_file" in label
+        ]
+    if annotation_scheme.get("use_predefined_labels") in PREDEFINED_LABEL_FILES:
+        files.append(PREDEFINED_LABEL_FILES[annotation_scheme["use_predefined_labels"]])
+    return files
+
+
+def get_site_cache_key(config):
+    """
+    Returns a hash of everything the generated pages depend on: the config,
+    the template, header and layout files, the surveyflow files, the tooltip
+    and label files of the annotation schemes and the code that generates the
+    schemas.
+    """
+    output_keys = set(get_site_output_keys(config))
+    site_config = {k: v for k, v in config.items() if k not in output_keys}
+    key = hashlib.sha256(json.dumps(site_config, sort_keys=True, default=str).encode())
+
+    files = [
+        config.get(k) for k in ["base_html_template", "header_file", "html_layout", "surveyflow_html_layout"]
+    ]
+    annotation_schemes = list(config.get("annotation_schemes", []))
+    if config.get("surveyflow") and config["surveyflow"].get("on"):
+        for k in config["surveyflow"]["order"]:
+            surveyflow_files = [f if type(f) == str else f["file"] for f in config["surveyflow"][k]]
+            files += surveyflow_files
+            # the annotation schemes of the surveyflow pages are in their files
+            for f in surveyflow_files:
+                path = find_template_file(config, f)
+                if path is not None and f.split(".")[-1] == "jsonl":
+                    with open(path, "rt") as fp:
+                        annotation_schemes += [json.loads(line) for line in fp if line.strip()]
+    for annotation_scheme in annotation_schemes:
+        files += get_schema_files(annotation_scheme)
+    schemas_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+    files += [os.path.abspath(__file__)] + sorted(glob.glob(os.path.join(schemas_dir, "*.py")))
+
+    for f in files:
+        path = find_template_file(config, f) if f else None
+        key.update(str(f).encode())
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as fp:
+                key.update(hashlib.sha256(fp.read()).digest())
+    return key.hexdigest()
+
+
+def generate_project_site(config):
+    """
+    Generates the annotation site, and the surveyflow pages if surveyflow is
+    on, in config["site_dir"]. If the pages there were generated from the same
+    config and files, they are reused instead. Returns whether the pages were
+    generated.
+    """
+    site_dir = config["site_dir"]
+    cache_file = os.path.join(site_dir, SITE_CACHE_FILE)
+    cache_key = get_site_cache_key(config)
+
+    try:
+        with open(cache_file, "rt") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = None
+
+    if (
+        cache is not None
+        and cache["key"] == cache_key
+        and all(os.path.exists(os.path.join(site_dir, name)) for name in cache["files"])
+    ):
+        logger.info("Using the annotation site generated before at %s" % site_dir)
+        config.update(cache["config"])
+        # the span labels are given their colors while their schemas are generated
+        for label, color in cache["span_colors"].items():
+            set_span_color(label, color)
+        return False
+
+    generate_site(config)
+    if config.get("surveyflow") and config["surveyflow"].get("on"):
+        generate_surveyflow_pages(config)
+
+    files = [config["site_file"]] + list(config.get("surveyflow_site_file", {}).values())
+
+    # Remove the pages that are no longer part of the site
+    if cache is not None:
+        for name in set(cache["files"]) - set(files):
+            if os.path.exists(os.path.join(site_dir, name)):
+                os.remove(os.path.join(site_dir, name))
+
+    cache = {
+        "key": cache_key,
+        "files": files,
+        "config": {k: config[k] for k in get_site_output_keys(config) if k in config},
+        "span_colors": get_span_colors(),
+    }
+    with open(cache_file + ".tmp", "wt") as f:
+        json.dump(cache, f)
+    os.replace(cache_file + ".tmp", cache_file)
+    return True
@@ -0,0 +1,316 @@
+"""
+Keyword highlighting with an Aho-Corasick automaton.
+
+The automaton is built once from the literal keywords and phrases of the
+lexicon, so finding all of them in an instance takes a single pass over its
+text regardless of how many there are. Regex patterns are compiled once into a
+single combined pattern. The matches of each instance are computed the first
+time the instance is shown and kept in a bounded LRU cache (keyed by the text
+as well, since randomized instances are displayed differently to each user),
+and the server marks them up in the instance text from their offsets, so pages
+do not need to ship the lexicon at all.
+"""
+
+import html
+import logging
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Markup in the displayed text (e.g. from span annotations) that should not be
+# matched against
+TAG_REGEX = re.compile(r"<[^>]*>")
+
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+PATTERN_TYPES = ("word", "phrase", "regex")
+
+# The markup of a highlighted keyword, styled by static/styles/emphasis.css
+MARK_OPEN_TAG = '<mark class="emphasis" data-schema="{schema}" data-label="{label}">'
+MARK_CLOSE_TAG = "</mark>"
+
+
+def normalize_phrase(phrase):
+    """
+    Collapses the whitespace between the tokens of a phrase, which is how the
+    automaton sees the text as well.
+    """
+    return " ".join(phrase.split())
+
+
+def infer_pattern_type(pattern):
+    """
+    Guesses the type of a pattern from a keyword file without a Type column:
+    anything with regex metacharacters is a regex, and anything else is a word
+    or a phrase depending on whether it has several tokens.
+    """
+    if any(c in REGEX_METACHARACTERS for c in pattern):
+        return "regex"
+    return "phrase" if len(pattern.split()) > 1 else "word"
+
+
+def pattern_to_regex(pattern):
+    """
+    Returns the regex for a regex pattern. A trailing * on an otherwise literal
+    word (e.g. "good*") matches any word starting with it.
+    """
+    if pattern.endswith("*") and not any(c in REGEX_METACHARACTERS for c in pattern[:-1]):
+        return r"\b" + re.escape(pattern[:-1]) + r"\w*"
+    return pattern
+
+
+class AhoCorasick:
+    """
+    A case-insensitive Aho-Corasick automaton over a set of keywords. Runs of
+    whitespace in the text match a single space in the keywords, so phrases
+    match regardless of how their tokens are separated.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = []
+        self.keyword_lengths = []
+        self.goto = [{}]
+        self.fail = [0]
+        # the ids of the keywords that end at each state
+        self.outputs = [[]]
+
+        for keyword in keywords:
+            self.add(keyword)
+        self.build()
+
+    def add(self, keyword):
+        state = 0
+        normalized = normalize_phrase(keyword)
+        for char in normalized:
+            char = char.lower()
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.outputs[state].append(len(self.keywords))
+        self.keywords.append(keyword)
+        self.keyword_lengths.append(len(normalized))
+
+    def build(self):
+        """
+        Computes the failure links with a breadth-first traversal of the trie.
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def iter_matches(self, text):
+        """
+        Yields (start, end, keyword) for every occurrence of every keyword in
+        text, including overlapping ones.
+        """
+        state = 0
+        # the offset in text of every character fed to the automaton
+        positions = []
+        in_space = False
+        for i, char in enumerate(text):
+            if char.isspace():
+                if in_space:
+                    continue
+                char = " "
+                in_space = True
+            else:
+                # lowercase each character on its own so that offsets stay aligned
+                char = char.lower()
+                in_space = False
+            positions.append(i)
+
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for keyword_id in self.outputs[state]:
+                yield positions[-self.keyword_lengths[keyword_id]], i + 1, self.keywords[keyword_id]
+
+
+class KeywordHighlighter:
+    """
+    Finds the words, phrases and regexes of a highlighting lexicon in the
+    instances and caches the matches of the most recently shown instances.
+    """
+
+    def __init__(self, keyword_to_schemas, pattern_types=None, cache_size=10000):
+        """
+        :keyword_to_schemas: a dict from each pattern to the schemas/labels it
+          highlights
+        :pattern_types: an optional dict from pattern to "word", "phrase" or
+          "regex"; patterns not in it have their type inferred
+        :cache_size: the number of instances whose matches are cached
+        """
+        self.keyword_to_schemas = keyword_to_schemas
+        pattern_types = pattern_types or {}
+
+        literals, regexes = [], []
+        for pattern in keyword_to_schemas:
+            pattern_type = pattern_types.get(pattern) or infer_pattern_type(pattern)
+            if pattern_type == "regex":
+                regex = pattern_to_regex(pattern)
+                try:
+                    re.compile(regex)
+                except re.error as e:
+                    logger.warning('Invalid highlight regex "%s" (%s), matching it literally' % (pattern, e))
+                    literals.append(pattern)
+                    continue
+                regexes.append((pattern, regex))
+            else:
+                literals.append(pattern)
+
+        self.automaton = AhoCorasick(literals)
+
+        # All the regexes are matched in one pass, the named group that matched
+        # tells which pattern it was
+        self.regex_patterns = [pattern for pattern, _ in regexes]
+        self.combined_regex = None
+        if regexes:
+            self.combined_regex = re.compile(
+                "|".join("(?P<p%d>%s)" % (i, regex) for i, (_, regex) in enumerate(regexes)),
+                re.IGNORECASE,
+            )
+
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        # (instance id, hash of the displayed text) -> spans
+        self.text_to_spans = OrderedDict()
+
+    def find_spans(self, text):
+        """
+        Returns the (start, end, pattern) spans of the lexicon in text. Words and
+        phrases only match whole words, nothing matches inside HTML tags, and
+        overlapping matches are resolved by keeping the leftmost, then longest,
+        one.
+        """
+        tags = [m.span() for m in TAG_REGEX.finditer(text)]
+        tag_starts = [start for start, _ in tags]
+
+        def in_tag(position):
+            i = bisect_right(tag_starts, position) - 1
+            return i >= 0 and position < tags[i][1]
+
+        def is_whole_words(start, end):
+            if start > 0 and text[start - 1].isalnum():
+                return False
+            return end == len(text) or not text[end].isalnum()
+
+        matches = [m for m in self.automaton.iter_matches(text) if is_whole_words(m[0], m[1])]
+        if self.combined_regex is not None:
+            for m in self.combined_regex.finditer(text):
+                if m.end() > m.start():
+                    matches.append((m.start(), m.end(), self.regex_patterns[int(m.lastgroup[1:])]))
+
+        spans = []
+        last_end = 0
+        for start, end, pattern in sorted(matches, key=lambda m: (m[0], -m[1])):
+            if start >= last_end and not in_tag(start):
+                spans.append((start, end, pattern))
+                last_end = end
+        return spans
+
+    def get_spans(self, instance_id, text):
+        """
+        Returns the (start, end, schema, label) spans of an instance's displayed
+        text, with one span for each schema/label a matched pattern highlights,
+        computing them if they are not cached.
+        """
+        key = (instance_id, hash(text))
+        with self.cache_lock:
+            if key in self.text_to_spans:
+                self.text_to_spans.move_to_end(key)
+                return self.text_to_spans[key]
+
+        spans = []
+        for start, end, pattern in self.find_spans(text):
+            highlights = sorted(self.keyword_to_schemas[pattern], key=lambda h: (str(h.schema), str(h.label)))
+            spans.extend((start, end, h.schema, h.label) for h in highlights)
+        with self.cache_lock:
+            self.text_to_spans[key] = spans
+            while len(self.text_to_spans) > self.cache_size:
+                self.text_to_spans.popitem(last=False)
+        return spans
+
+
+def render_highlights(text, spans, boundaries=()):
+    """
+    Returns a modified version of the text with a <mark> around each keyword
+    span, along with a function that maps offsets in the text to offsets in the
+    marked up text.
+
+    :text: the displayed text of an instance
+    :spans: the (start, end, schema, label) spans from get_spans()
+    :boundaries: offsets where other markup will be inserted later (e.g. the
+      span annotations), marks are split there so that they nest inside it
+    """
+    # a keyword highlighting several labels gets a single mark listing all of them
+    ranges = OrderedDict()
+    for start, end, schema, label in spans:
+        highlights = ranges.setdefault((start, end), ([], []))
+        for values, value in zip(highlights, (str(schema), str(label))):
+            if value not in values:
+                values.append(value)
+
+    boundaries = sorted(set(boundaries))
+    # A regex can match across the markup of the text, and the marks then only
+    # cover the text around the tags it contains
+    tags = [m.span() for m in TAG_REGEX.finditer(text)]
+    tag_starts = [start for start, _ in tags]
+
+    # (position, 0 for closing and 1 for opening tags, tag) so that at any
+    # position a mark is closed before the next one is opened
+    insertions = []
+    for (start, end), (schemas, labels) in ranges.items():
+        open_tag = MARK_OPEN_TAG.format(
+            schema=html.escape(", ".join(schemas)), label=html.escape(", ".join(labels))
+        )
+        pieces = []
+        for tag_start, tag_end in tags[max(bisect_right(tag_starts, start) - 1, 0) :]:
+            if tag_start >= end:
+                break
+            if tag_end <= start:
+                continue
+            pieces.append((start, min(tag_start, end)))
+            start = tag_end
+        pieces.append((start, end))
+
+        for piece_start, piece_end in pieces:
+            if piece_start >= piece_end:
+                continue
+            cuts = boundaries[bisect_right(boundaries, piece_start) : bisect_left(boundaries, piece_end)]
+            for fragment_start, fragment_end in zip([piece_start] + cuts, cuts + [piece_end]):
+                insertions.append((fragment_start, 1, open_tag))
+                insertions.append((fragment_end, 0, MARK_CLOSE_TAG))
+    insertions.sort(key=lambda insertion: insertion[:2])
+
+    parts = []
+    cursor = 0
+    # the total length of the tags inserted up to each insertion
+    shifts = [0]
+    for position, _, tag in insertions:
+        parts.append(text[cursor:position])
+        parts.append(tag)
+        cursor = position
+        shifts.append(shifts[-1] + len(tag))
+    parts.append(text[cursor:])
+
+    keys = [insertion[:2] for insertion in insertions]
+
+    def shift(offset):
+        # markup inserted at an offset goes outside the marks closing there and
+        # the marks opening there
+        return offset + shifts[bisect_right(keys, (offset, 0))]
+
+    return "".join(parts), shift
@@ -0,0 +1,223 @@
+"""
+Vectorized Krippendorff's alpha.
+
+Alpha is computed from the coincidence matrix of the pairable values, which is
+built with sparse matrix products over (unit, value) pairs rather than by
+looping over every annotator and unit. This keeps the cost proportional to the
+number of annotations made, not to annotators x units, and lets several binary
+labels (e.g. the options of a multiselect schema) be scored in one pass.
+
+scipy is imported by the functions that build sparse matrices, so that the
+agreement tracker, which only needs the coincidence-based functions, can be
+imported without it.
+"""
+
+import numpy as np
+
+LEVELS_OF_MEASUREMENT = ("nominal", "interval", "ordinal")
+
+
+def encode(values):
+    """
+    Maps arbitrary (hashable, sortable) values to integer codes.
+
+    :return: a tuple of (1) the array of codes and (2) the sorted array of
+      distinct values, so that values[i] == categories[codes[i]]
+    """
+    categories, codes = np.unique(np.asarray(values), return_inverse=True)
+    return codes.ravel(), categories
+
+
+def value_counts_by_unit(units, codes, n_units, n_categories):
+    """
+    Returns a sparse (n_units x n_categories) matrix with the number of times
+    each value was assigned to each unit.
+    """
+    from scipy import sparse
+
+    counts = sparse.coo_matrix(
+        (np.ones(len(units)), (units, codes)), shape=(n_units, n_categories)
+    )
+    # Converting to CSR sums any duplicate (unit, value) entries
+    return counts.tocsr()
+
+
+def pairable_weights(values_per_unit):
+    """
+    Returns the 1 / (m_u - 1) weight of each unit, where m_u is the number of
+    values assigned to the unit. Units with fewer than two values are not
+    pairable and get a weight of 0.
+    """
+    values_per_unit = np.asarray(values_per_unit, dtype=float).ravel()
+    weights = np.zeros_like(values_per_unit)
+    pairable = values_per_unit >= 2
+    weights[pairable] = 1.0 / (values_per_unit[pairable] - 1)
+    return weights
+
+
+def coincidence_matrix(counts):
+    """
+    Builds the coincidence matrix from a (units x categories) count matrix.
+
+    o_ck = sum_u (n_uc * n_uk - [c == k] * n_uc) / (m_u - 1)
+    """
+    from scipy import sparse
+
+    counts = sparse.csr_matrix(counts, dtype=float)
+    weights = pairable_weights(counts.sum(axis=1))
+    weighted = sparse.diags(weights) @ counts
+
+    o = (counts.T @ weighted).toarray()
+    o -= np.diag(np.asarray(weighted.sum(axis=0)).ravel())
+    return o
+
+
+def distance_matrix(categories, coincidence, level_of_measurement="nominal"):
+    """
+    Returns the squared difference between every pair of categories for the
+    given level of measurement.
+    """
+    n_categories = len(categories)
+
+    if level_of_measurement == "nominal":
+        return 1.0 - np.eye(n_categories)
+
+    if level_of_measurement == "interval":
+        values = np.asarray(categories, dtype=float)
+        return np.subtract.outer(values, values) ** 2
+
+    if level_of_measurement == "ordinal":
+        # Categories are sorted, so the distance between c and k depends on
+        # how many pairable values fall between them
+        n_c = coincidence.sum(axis=1)
+        cumulative = np.cumsum(n_c)
+        lower = np.minimum.outer(np.arange(n_categories), np.arange(n_categories))
+        upper = np.maximum.outer(np.arange(n_categories), np.arange(n_categories))
+        between = cumulative[upper] - cumulative[lower] + n_c[lower]
+        return (between - np.add.outer(n_c, n_c) / 2) ** 2
+
+    raise ValueError("Unknown level of measurement: %s" % level_of_measurement)
+
+
+def alpha_from_coincidence(o, distance):
+    """
+    Computes alpha from a coincidence matrix and a distance matrix. Returns
+    NaN when alpha is undefined (no pairable values or no variation at all).
+    """
+    n_c = o.sum(axis=1)
+    n = n_c.sum()
+    if n <= 1:
+        return float("nan")
+
+    observed = (o * distance).sum()
+    expected = (np.outer(n_c, n_c) * distance).sum()
+    if expected == 0:
+        return float("nan")
+
+    return float(1 - (n - 1) * observed / expected)
+
+
+def alpha_from_counts(counts, categories, level_of_measurement="nominal"):
+    """
+    Computes alpha from a (units x categories) count matrix. Resampling or
+    dropping annotations only changes the counts, so this is the entry point
+    for repeated computations over the same data.
+    """
+    o = coincidence_matrix(counts)
+    return alpha_from_coincidence(o, distance_matrix(categories, o, level_of_measurement))
+
+
+def alpha_from_pairs(units, values, level_of_measurement="nominal"):
+    """
+    Computes alpha from parallel sequences of unit identifiers and the values
+    assigned to them (one entry per annotation). Missing annotations are simply
+    absent, so the input can come straight from a sparse annotator x unit
+    matrix.
+    """
+    if len(units) == 0:
+        return float("nan")
+
+    unit_codes, unit_ids = encode(units)
+    value_codes, categories = encode(values)
+
+    counts = value_counts_by_unit(unit_codes, value_codes, len(unit_ids), len(categories))
+    return alpha_from_counts(counts, categories, level_of_measurement)
+
+
+def krippendorff_alpha(reliability_data, level_of_measurement="nominal"):
+    """
+    Computes alpha for an (annotators x units) reliability matrix.
+
+    :reliability_data: either a dense array-like where missing values are NaN,
+      or a scipy sparse matrix where only the stored entries are annotations
+    """
+    from scipy import sparse
+
+    if sparse.issparse(reliability_data):
+        coo = reliability_data.tocoo()
+        return alpha_from_pairs(coo.col, coo.data, level_of_measurement)
+
+    data = np.asarray(reliability_data, dtype=float)
+    annotated = ~np.isnan(data)
+    _, units = np.nonzero(annotated)
+    return alpha_from_pairs(units, data[annotated], level_of_measurement)
+
+
+def binary_coincidences(units, label_matrix, n_units=None):
+    """
+    Computes the 2x2 coincidence matrices of many binary labels at once.
+
+    :units: the unit index of each annotation (one row of label_matrix each)
+    :label_matrix: an (annotations x labels) 0/1 matrix, dense or sparse
+    :return: a tuple of arrays (o_00, o_01, o_11), one entry per label
+    """
+    from scipy import sparse
+
+    units = np.asarray(units)
+    if n_units is None:
+        n_units = int(units.max()) + 1 if len(units) > 0 else 0
+
+    # Sum the annotations of each unit with an (units x annotations) indicator
+    indicator = sparse.csr_matrix(
+        (np.ones(len(units)), (units, np.arange(len(units)))), shape=(n_units, len(units))
+    )
+    label_matrix = sparse.csr_matrix(label_matrix, dtype=float)
+
+    values_per_unit = np.asarray(indicator.sum(axis=1)).ravel()
+    n_1 = (indicator @ label_matrix).toarray()
+    n_0 = values_per_unit[:, None] - n_1
+
+    weights = pairable_weights(values_per_unit)
+    o_00 = weights @ (n_0 * (n_0 - 1))
+    o_01 = weights @ (n_0 * n_1)
+    o_11 = weights @ (n_1 * (n_1 - 1))
+    return o_00, o_01, o_11
+
+
+def binary_alpha(o_00, o_01, o_11):
+    """
+    Computes nominal alpha for each label from its 2x2 coincidences. Labels
+    where alpha is undefined get NaN.
+    """
+    n_0 = np.asarray(o_00 + o_01, dtype=float)
+    n_1 = np.asarray(o_11 + o_01, dtype=float)
+    n = n_0 + n_1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = 1 - (n - 1) * o_01 / (n_0 * n_1)
+    alpha = np.where((n > 1) & (n_0 * n_1 > 0), alpha, np.nan)
+    return alpha
+
+
+def multilabel_alpha(units, label_matrix):
+    """
+    Computes nominal alpha independently for every binary label (column) of
+    label_matrix in a single batched pass.
+
+    :return: an array with one alpha per label
+    """
+    if len(units) == 0:
+        return np.full(label_matrix.shape[1], np.nan)
+
+    unit_codes, unit_ids = encode(units)
+    return binary_alpha(*binary_coincidences(unit_codes, label_matrix, len(unit_ids)))
@@ -0,0 +1,421 @@
+"""
+Load testing for Potato deployments.
+
+`potato bench <config>` starts the server for a project against a synthetic
+dataset (so no real annotations are touched) and drives virtual annotators
+through the same requests the annotation page makes: opening the home page,
+logging in, and moving through instances with next/prev/go_to while labeling
+them and submitting span annotations. The server runs in its own process, and
+the virtual annotators are spread over several client processes (as one thread
+each) so that generating the load does not compete with the server for the
+GIL. Each virtual annotator waits a random (exponentially distributed) think
+time between actions. At the end the latency percentiles, throughput and errors
+of each route are reported, so regressions in page rendering, assignment and
+saving show up before a study launches.
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import requests
+
+from potato.server_utils.schemas.span import get_visible_text
+
+ACTIONS = ("next", "prev", "go_to", "span")
+
+# The annotation page keeps the user's cursor in a hidden input
+INSTANCE_ID_REGEX = re.compile(r'id="instance_id" value="(\d+)"')
+
+# The template's container of the instance text
+INSTANCE_TEXT_REGEX = re.compile(r'id="instance-text"[^>]*>')
+
+# Every synthetic instance contains this word, which the virtual annotators
+# mark as a span
+SPAN_WORD = "Synthetic"
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    + "incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+def parse_mix(mix):
+    """
+    Parses an action mix like "next=0.6,prev=0.1,go_to=0.1,span=0.2" into a
+    dict of action -> weight.
+    """
+    weights = {}
+    for item in mix.split(","):
+        action, _, weight = item.partition("=")
+        action = action.strip()
+        if action not in ACTIONS:
+            raise ValueError("Unknown action %s in the action mix, choose from %s" % (action, ", ".join(ACTIONS)))
+        weights[action] = float(weight)
+    return weights
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+
+def write_synthetic_data(config, path, n_instances, seed=0):
+    """
+    Writes a JSONL file of n_instances random instances with the id and text
+    keys (and context key, if any) the config expects.
+    """
+    rng = random.Random(seed)
+    item_properties = config["item_properties"]
+
+    def sentence(n_words=30):
+        return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+    with open(path, "wt") as f:
+        for i in range(n_instances):
+            text = "%s instance %d: %s." % (SPAN_WORD, i, sentence())
+            if config.get("list_as_text"):
+                text = {"A": text, "B": sentence()}
+            item = {item_properties["id_key"]: "bench_%d" % i, item_properties["text_key"]: text}
+            if "context_key" in item_properties:
+                item[item_properties["context_key"]] = sentence()
+            f.write(json.dumps(item) + "\n")
+
+
+def prepare_bench_config(config, work_dir, n_instances):
+    """
+    Points a loaded project config at a synthetic dataset and a scratch output
+    directory, and lets virtual annotators log in directly by username. The
+    annotation schemes are written to the work dir for the client processes.
+    """
+    data_file = os.path.join(work_dir, "synthetic.jsonl")
+    write_synthetic_data(config, data_file, n_instances)
+    config["data_files"] = [data_file]
+    config["output_annotation_dir"] = os.path.join(work_dir, "annotation_output")
+    config["login"] = {"type": "url_direct", "url_argument": "username"}
+    config["prolific"] = None
+    config.setdefault("user_config", {})["allow_all_users"] = True
+    with open(os.path.join(work_dir, "annotation_schemes.json"), "wt") as f:
+        json.dump(config["annotation_schemes"], f)
+
+
+def find_span_start(page):
+    """
+    Returns the offset of SPAN_WORD in the visible text of the instance shown
+    on an annotation page, which is where the front end counts span offsets
+    from, or None if it is not there.
+    """
+    m = INSTANCE_TEXT_REGEX.search(page)
+    if m is None:
+        return None
+    start = get_visible_text(page[m.end():])[0].find(SPAN_WORD)
+    return start if start >= 0 else None
+
+
+def make_label_form(annotation_schemes, rng):
+    """
+    Returns the form fields for a random answer to every labeling schema.
+    """
+    form = {}
+    for schema in annotation_schemes:
+        annotation_type = schema["annotation_type"]
+        if annotation_type == "likert":
+            form["%s:::scale_%d" % (schema["name"], rng.randint(1, schema.get("size", 5)))] = "1"
+        elif annotation_type in ("radio", "multiselect", "select") and schema.get("labels"):
+            label = rng.choice(schema["labels"])
+            label = label if isinstance(label, str) else label["name"]
+            form["%s:::%s" % (schema["name"], label)] = "1"
+        elif annotation_type in ("text", "number"):
+            form["%s:::text_box" % schema["name"]] = "1"
+    return form
+
+
+class LatencyRecorder:
+    """
+    Collects the latency and errors of the requests made to each route.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+    def merge(self, latencies, errors):
+        """
+        Adds the latencies and errors recorded by another process.
+        """
+        with self.lock:
+            for route, values in latencies.items():
+                self.latencies[route].extend(values)
+            for route, count in errors.items():
+                self.errors[route] += count
+
+    def report(self, elapsed):
+        """
+        Returns the per-route request counts, errors, throughput and latency
+        percentiles (in milliseconds).
+        """
+        report = {}
+        with self.lock:
+            for route in sorted(self.latencies):
+                latencies = np.array(self.latencies[route]) * 1000
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                report[route] = {
+                    "requests": len(latencies),
+                    "errors": self.errors[route],
+                    "throughput": len(latencies) / elapsed,
+                    "mean_ms": float(latencies.mean()),
+                    "p50_ms": float(p50),
+                    "p95_ms": float(p95),
+                    "p99_ms": float(p99),
+                }
+        return report
+
+
+class VirtualAnnotator(threading.Thread):
+    """
+    A simulated annotator who logs in and then moves through and annotates
+    instances until the deadline.
+    """
+
+    def __init__(self, base_url, username, recorder, annotation_schemes, mix, think_time, start_at,
+                 deadline, timeout=30, seed=None):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.username = username
+        self.recorder = recorder
+        self.annotation_schemes = annotation_schemes
+        self.span_schemas = [s for s in annotation_schemes if s["annotation_type"] == "highlight"]
+        self.actions = [a for a in mix if mix[a] > 0 and (a != "span" or self.span_schemas)]
+        self.weights = [mix[a] for a in self.actions]
+        self.think_time = think_time
+        self.start_at = start_at
+        self.deadline = deadline
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.cursor = 0
+        self.max_cursor = 0
+        self.span_start = None
+
+    def request(self, route, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(route, time.perf_counter() - start, ok)
+
+        # Follow the cursor the page shows, like the annotation page would
+        if ok:
+            m = INSTANCE_ID_REGEX.search(response.text)
+            if m:
+                self.cursor = int(m.group(1))
+                self.max_cursor = max(self.max_cursor, self.cursor)
+                self.span_start = find_span_start(response.text)
+        return ok
+
+    def annotate(self, action):
+        form = {"email": self.username, "instance_id": str(self.cursor)}
+        if action == "next":
+            form["src"] = "next_instance"
+            form.update(make_label_form(self.annotation_schemes, self.rng))
+        elif action == "prev":
+            form["src"] = "prev_instance"
+        elif action == "go_to":
+            form["src"] = "go_to"
+            form["go_to"] = str(self.rng.randint(0, self.max_cursor))
+        elif action == "span":
+            schema = self.rng.choice(self.span_schemas)
+            label = self.rng.choice(schema["labels"])
+            label = label if isinstance(label, str) else label["name"]
+            form["src"] = "next_instance"
+            # the word is not where the page was parsed from if e.g. it was
+            # already marked up, the instance is then just moved past
+            if self.span_start is not None:
+                form["span-annotations"] = json.dumps([{
+                    "start": self.span_start,
+                    "end": self.span_start + len(SPAN_WORD),
+                    "span": SPAN_WORD,
+                    "annotation": label,
+                    "schema": schema["name"],
+                    "annotation_title": label,
+                }])
+        return self.request("annotate:" + action, "POST", "/annotate", data=form)
+
+    def run(self):
+        time.sleep(max(0, self.start_at - time.time()))
+        self.request("GET /", "GET", "/", params={"username": self.username})
+        self.request("POST /login", "POST", "/login", data={"action": "login", "email": self.username})
+
+        while True:
+            wait = self.rng.expovariate(1 / self.think_time) if self.think_time > 0 else 0
+            if time.time() + wait >= self.deadline:
+                break
+            time.sleep(wait)
+            self.annotate(self.rng.choices(self.actions, self.weights)[0])
+
+
+def wait_until_ready(base_url, server, timeout=120):
+    start = time.time()
+    while time.time() - start < timeout:
+        if not server.is_alive():
+            return False
+        try:
+            requests.get(base_url + "/login", timeout=5)
+            return True
+        except requests.RequestException:
+            time.sleep(0.5)
+    return False
+
+
+def serve_bench_project(run_server, args, work_dir, n_instances):
+    """
+    Runs the server for the project against the synthetic dataset, in the
+    server process. The pages the server generated for it are removed when the
+    process is terminated.
+    """
+    loaded = {}
+
+    def prepare_config(config):
+        prepare_bench_config(config, work_dir, n_instances)
+        loaded["config"] = config
+
+    # terminate() sends SIGTERM, exit through the finally below instead
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        run_server(args, prepare_config=prepare_config)
+    finally:
+        if "site_dir" in loaded.get("config", {}):
+            shutil.rmtree(loaded["config"]["site_dir"], ignore_errors=True)
+
+
+def run_annotators(base_url, user_ids, n_users, annotation_schemes, mix, think_time, start, ramp_up, deadline):
+    """
+    Runs the virtual annotators with the given ids as threads of a client
+    process, and returns the latencies and errors they recorded.
+    """
+    recorder = LatencyRecorder()
+    annotators = [
+        VirtualAnnotator(
+            base_url,
+            "bench_user_%d" % i,
+            recorder,
+            annotation_schemes,
+            mix,
+            think_time,
+            start_at=start + ramp_up * i / max(1, n_users),
+            deadline=deadline,
+            seed=i,
+        )
+        for i in user_ids
+    ]
+    for annotator in annotators:
+        annotator.start()
+    for annotator in annotators:
+        annotator.join()
+    return dict(recorder.latencies), dict(recorder.errors)
+
+
+def print_report(report, elapsed, n_users):
+    print("\n%d virtual annotators for %.1fs" % (n_users, elapsed))
+    print(
+        "%-20s %9s %7s %9s %9s %9s %9s"
+        % ("route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+    )
+    for route, stats in report.items():
+        print(
+            "%-20s %9d %7d %9.1f %9.1f %9.1f %9.1f"
+            % (route, stats["requests"], stats["errors"], stats["throughput"],
+               stats["p50_ms"], stats["p95_ms"], stats["p99_ms"])
+        )
+
+
+def run_load_test(args, run_server):
+    """
+    Runs the server for the project in its own process and drives
+    args.bench_users virtual annotators against it from args.bench_processes
+    client processes.
+
+    :run_server: the server's entry point, called with args and a hook that
+      prepares the loaded config
+    """
+    mix = parse_mix(args.bench_mix)
+    work_dir = tempfile.mkdtemp(prefix="potato_bench_")
+    args.port = args.port or find_free_port()
+    base_url = "http://localhost:%d" % args.port
+
+    # spawn, so the processes don't inherit the state (and threads) of this one
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(
+        target=serve_bench_project, args=(run_server, args, work_dir, args.bench_instances), daemon=True
+    )
+    server.start()
+    try:
+        if not wait_until_ready(base_url, server):
+            print("ERROR: the server did not start, see the output above")
+            return None
+
+        # the config the server loaded, for the virtual annotators to answer its schemas
+        with open(os.path.join(work_dir, "annotation_schemes.json"), "rt") as f:
+            annotation_schemes = json.load(f)
+
+        n_processes = max(1, min(args.bench_processes or os.cpu_count() or 1, args.bench_users))
+        recorder = LatencyRecorder()
+        start = time.time()
+        deadline = start + args.bench_ramp_up + args.bench_duration
+        print(
+            "starting %d virtual annotators in %d processes against %s"
+            % (args.bench_users, n_processes, base_url)
+        )
+        with ProcessPoolExecutor(n_processes, mp_context=context) as executor:
+            futures = [
+                executor.submit(
+                    run_annotators,
+                    base_url,
+                    range(i, args.bench_users, n_processes),
+                    args.bench_users,
+                    annotation_schemes,
+                    mix,
+                    args.bench_think_time,
+                    start,
+                    args.bench_ramp_up,
+                    deadline,
+                )
+                for i in range(n_processes)
+            ]
+            for future in futures:
+                recorder.merge(*future.result())
+        elapsed = time.time() - start
+
+        report = recorder.report(elapsed)
+        print_report(report, elapsed, args.bench_users)
+        if args.bench_output:
+            with open(args.bench_output, "wt") as f:
+                json.dump({"users": args.bench_users, "elapsed": elapsed, "routes": report}, f, indent=2)
+            print("report written to %s" % args.bench_output)
+        return report
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
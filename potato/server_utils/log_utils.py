@@ -0,0 +1,125 @@
+"""
+Structured logging for the server.
+
+Log records are formatted as JSON lines (or plain text) and written by a
+QueueListener thread, so a request only pays for putting the record on a
+queue and never waits on stdout or a log file. Records can carry an event type
+(e.g. login, assignment, prestudy) and any other fields in `extra`, and the
+level and sampling rate of each event type can be set in the logging section
+of the config:
+
+    logging:
+      level: INFO
+      format: json
+      file: logs/server.log
+      events:
+        login: {level: WARNING}
+        annotate: {sample_rate: 0.1}
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+# The attributes every LogRecord has, to tell the extra fields apart
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def event_extra(event, **fields):
+    """
+    Returns the `extra` of a log call for an event and its fields, e.g.
+    logger.info("%s logged in", username, extra=event_extra("login", username=username)).
+    """
+    return dict(fields, event=event)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a JSON object with its time, level, logger, event,
+    message and extra fields.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + ".%03d" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class EventFilter(logging.Filter):
+    """
+    Drops the records of each event type below its configured level, and keeps
+    a random sample of the rest if a sample rate is configured.
+
+    :events: event type -> {"level": ..., "sample_rate": ...}
+    """
+
+    def __init__(self, events=None):
+        super().__init__()
+        self.levels = {}
+        self.sample_rates = {}
+        # a generator of its own, so sampling doesn't consume the seeded module
+        # generator the server assigns instances with
+        self.random = random.Random()
+        for event, options in (events or {}).items():
+            options = options or {}
+            if "level" in options:
+                self.levels[event] = logging.getLevelName(str(options["level"]).upper())
+            if "sample_rate" in options:
+                self.sample_rates[event] = float(options["sample_rate"])
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        if event is None:
+            return True
+        if record.levelno < self.levels.get(event, logging.NOTSET):
+            return False
+        sample_rate = self.sample_rates.get(event)
+        return sample_rate is None or self.random.random() < sample_rate
+
+
+def setup_logging(config):
+    """
+    Routes all the logging through a queue to a listener thread that writes the
+    records to stdout (or the configured file), and returns the listener.
+    """
+    options = config.get("logging") or {}
+
+    if options.get("file"):
+        target = logging.FileHandler(options["file"])
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    if options.get("format", "json") == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    handler.addFilter(EventFilter(options.get("events")))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    # the server's info messages (e.g. Prolific study status changes) are
+    # logged unless a level is configured, instead of the root's WARNING default
+    root.setLevel(str(options.get("level") or "INFO").upper())
+
+    listener = logging.handlers.QueueListener(handler.queue, target)
+    listener.start()
+    # flush the queue when the server exits
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,193 @@
+"""
+Prometheus-style metrics for the server.
+
+The metrics are kept in memory and rendered in the Prometheus text exposition
+format by the /metrics endpoint. Updating a histogram or counter on the hot
+path only takes a lock and a couple of additions; gauges are computed by
+callbacks when the metrics are scraped, so they cost nothing in between.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+
+
+def _format_value(value):
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class _Timer:
+    """
+    Times a block (as a context manager) or every call of a function (as a
+    decorator) into a histogram.
+    """
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            with _Timer(self.histogram, self.labelvalues):
+                return fn(*args, **kwargs)
+
+        return timed
+
+
+class Histogram:
+    """
+    A histogram of observed values (e.g. latencies), per combination of label
+    values.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # label values -> [counts per bucket (the last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, value, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def collect(self):
+        with self.lock:
+            series = {k: (list(counts), total) for k, (counts, total) in self.series.items()}
+
+        lines = []
+        for labelvalues, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    self.name,
+                    _format_labels(self.labelnames, labelvalues, ("le", _format_value(bound))),
+                    cumulative,
+                ))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append("%s_sum%s %s" % (self.name, labels, _format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+class Counter:
+    """
+    A monotonically increasing count, per combination of label values.
+    """
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            values = dict(self.values)
+        return [
+            "%s%s %s" % (self.name, _format_labels(self.labelnames, labelvalues), _format_value(value))
+            for labelvalues, value in sorted(values.items())
+        ]
+
+
+class Gauge:
+    """
+    A value that is computed by a callback whenever the metrics are scraped.
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def collect(self):
+        # a failing callback should not take down the whole endpoint
+        try:
+            value = self.callback()
+        except Exception:
+            value = float("nan")
+        return ["%s %s" % (self.name, _format_value(value))]
+
+
+class MetricsRegistry:
+    """
+    The metrics exposed by the server.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def render(self):
+        """
+        Returns all the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type_name))
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,180 @@
+"""
+Opt-in profiling of slow requests.
+
+When profiling is on, a sampling profiler records the call stack of the
+threads serving requests every few milliseconds. Requests that turn out to be
+slower than a threshold, and a random sample of the others, are written to the
+profiling directory as collapsed stacks (one "frame;frame;frame count" line
+per distinct stack), which flamegraph.pl, speedscope and most flame graph
+viewers read directly. The file names carry the time, duration, route, user
+and instance, and only the most recent files are kept.
+
+Sampling from a separate thread only costs a walk over each profiled thread's
+stack per sample, so unlike a tracing profiler it can be left on for every
+request in production.
+"""
+
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def collapse_stack(frame, labels):
+    """
+    Returns the stack of a frame in the collapsed format, outermost call first.
+
+    :labels: a cache of code object -> frame label
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        label = labels.get(code)
+        if label is None:
+            label = labels[code] = "%s (%s:%d)" % (
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+            )
+        stack.append(label)
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stacks of the registered threads every interval seconds. The
+    thread sleeps while no thread is registered.
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.lock = threading.Lock()
+        # thread id -> Counter of collapsed stack -> samples
+        self.threads = {}
+        self.wakeup = threading.Event()
+        self.labels = {}
+
+    def register(self, thread_id):
+        with self.lock:
+            self.threads[thread_id] = Counter()
+        self.wakeup.set()
+
+    def unregister(self, thread_id):
+        with self.lock:
+            stacks = self.threads.pop(thread_id, Counter())
+            if not self.threads:
+                self.wakeup.clear()
+        return stacks
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, stacks in self.threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[collapse_stack(frame, self.labels)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class RequestProfiler:
+    """
+    Profiles requests and writes the stacks of the slow and sampled ones to
+    output_dir, keeping at most max_files of them.
+
+    :sample_rate: the fraction of requests to write regardless of how long they
+      take
+    :slow_threshold: write any request that takes at least this many seconds,
+      or None to only write the sampled ones
+    """
+
+    def __init__(self, output_dir, sample_rate=0.0, slow_threshold=None, max_files=100, interval=0.005):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+        self.write_lock = threading.Lock()
+        # a generator of its own, so sampling doesn't consume the seeded module
+        # generator the server assigns instances with
+        self.random = random.Random()
+        os.makedirs(output_dir, exist_ok=True)
+        self.sampler = StackSampler(interval)
+        self.sampler.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns a profiler for the request_profiling section of the config, or
+        None if profiling is off.
+        """
+        profiling = config.get("request_profiling") or {}
+        sample_rate = float(profiling.get("sample_rate", 0.0))
+        slow_threshold_ms = profiling.get("slow_threshold_ms")
+        if sample_rate <= 0 and slow_threshold_ms is None:
+            return None
+
+        return cls(
+            profiling.get("output_dir", os.path.join(config["output_annotation_dir"], "profiles")),
+            sample_rate=sample_rate,
+            slow_threshold=None if slow_threshold_ms is None else float(slow_threshold_ms) / 1000,
+            max_files=int(profiling.get("max_files", 100)),
+            interval=float(profiling.get("interval_ms", 5)) / 1000,
+        )
+
+    def start(self):
+        """
+        Starts profiling the request served by the current thread. Returns
+        whether the request was picked for sampling, to pass to stop().
+        """
+        sampled = self.sample_rate > 0 and self.random.random() < self.sample_rate
+        if sampled or self.slow_threshold is not None:
+            self.sampler.register(threading.get_ident())
+        return sampled
+
+    def stop(self, sampled, duration, route, username=None, instance_id=None):
+        """
+        Stops profiling the request served by the current thread and writes its
+        stacks if it was sampled or slow. Returns the path written, if any.
+        """
+        stacks = self.sampler.unregister(threading.get_ident())
+        slow = self.slow_threshold is not None and duration >= self.slow_threshold
+        if not (sampled or slow) or not stacks:
+            return None
+
+        name = "%s_%dms_%s_%s_%s.collapsed" % (
+            time.strftime("%Y%m%d-%H%M%S"),
+            duration * 1000,
+            route,
+            username or "-",
+            instance_id or "-",
+        )
+        path = os.path.join(self.output_dir, UNSAFE_FILENAME_CHARS.sub("_", name)[:200])
+        with self.write_lock:
+            with open(path, "wt") as f:
+                for stack, count in stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+            self.prune()
+        return path
+
+    def prune(self):
+        """
+        Deletes the oldest profiles beyond max_files.
+        """
+        paths = [
+            os.path.join(self.output_dir, f) for f in os.listdir(self.output_dir) if f.endswith(".collapsed")
+        ]
+        if len(paths) <= self.max_files:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[: len(paths) - self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
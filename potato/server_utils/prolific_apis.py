@@ -2,101 +2,171 @@
 Utility functions for handling prolific apis
 
 """
+import logging
 import os.path
 import pandas as pd
 import requests
-from collections import OrderedDict, defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict, defaultdict, deque
 import time
 import json
+import threading
+
+from potato.server_utils.log_utils import event_extra
+
+logger = logging.getLogger(__name__)
+
+PROLIFIC_API_URL = 'https://api.prolific.com/api/v1/'
+
+# Submission statuses that can still change without any action from the researcher
+OPEN_SUBMISSION_STATUSES = {'ACTIVE', 'RESERVED'}
+
+# Submissions entering these statuses emit a 'dropped' or 'completed' event
+DROPPED_SUBMISSION_STATUSES = {'RETURNED', 'TIMED-OUT', 'REJECTED'}
+COMPLETED_SUBMISSION_STATUSES = {'AWAITING REVIEW', 'APPROVED'}
+
+# Retries idempotent requests on any status in status_forcelist, and the others
+# (e.g., study transition POSTs) only when rate limited, as a 429 means the
+# request was not processed while a server error may have been applied
+class RateLimitRetry(Retry):
+    def is_retry(self, method, status_code, has_retry_after = False):
+        if status_code == 429 and self.status_forcelist and 429 in self.status_forcelist:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
 
 # The base wrapper of prolific apis
 class ProlificBase(object):
-    def __init__(self, token):
+    def __init__(self, token, base_url = PROLIFIC_API_URL, timeout = (5, 30), max_retries = 5,
+                 backoff_factor = 0.5, pool_maxsize = 10):
         self.headers = {
             'Authorization': f'Token {token}',
         }
+        self.base_url = base_url
+        self.timeout = timeout
 
-    # list all the studies
-    def list_all_studies(self):
-        url = 'https://api.prolific.com/api/v1/studies/'
-        response = requests.get(url, headers=self.headers)
+        # All calls share one session so that connections are kept alive, and
+        # rate limits (429) and server errors are retried with exponential backoff,
+        # honoring the Retry-After header. Server errors are only retried for
+        # idempotent methods, a POST (e.g., a study transition) may have been
+        # applied even if it failed
+        retry = RateLimitRetry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # send a request to the api and return the json data, or None if it failed
+    def _request(self, method, url, **kwargs):
+        if not url.startswith('http'):
+            url = self.base_url + url
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            logger.error("%s %s failed - %s", method, url, e, extra=event_extra("prolific", url=url))
+            return None
         if response.status_code == 200:
-            data = response.json()  # If the response contains JSON data
-            studies = pd.DataFrame.from_records(data['results'])
-            print('You currently have %s studies'%len(data['results']))
-            print(studies[['id','name','study_type','internal_name','status']].to_records())
-            return studies
+            return response.json()  # If the response contains JSON data
         else:
-            print(f"Error: {response.status_code} - {response.text}")
+            logger.error(
+                "%s %s returned %s - %s", method, url, response.status_code, response.text,
+                extra=event_extra("prolific", url=url, status=response.status_code),
+            )
             return None
 
+    # iterate over the results of every page of a paginated api endpoint, a
+    # failed request yields None and stops the iteration
+    def _iter_pages(self, url, params = None):
+        while url:
+            data = self._request('GET', url, params=params)
+            if data is None:
+                yield None
+                return
+            yield data.get('results', [])
+
+            # the url of the next page already contains the query parameters
+            params = None
+            next_link = data.get('_links', {}).get('next') or data.get('next')
+            url = next_link.get('href') if isinstance(next_link, dict) else next_link
+
+    # get the results of every page of a paginated api endpoint, or None if any
+    # request failed
+    def _get_all_pages(self, url, params = None):
+        results = []
+        for page in self._iter_pages(url, params):
+            if page is None:
+                return None
+            results.extend(page)
+        return results
+
+    # list all the studies
+    def list_all_studies(self):
+        results = self._get_all_pages('studies/')
+        if results is None:
+            return None
+        studies = pd.DataFrame.from_records(results)
+        print('You currently have %s studies'%len(results))
+        if len(results) > 0:
+            print(studies[['id','name','study_type','internal_name','status']].to_records())
+        return studies
+
     # get the information of a prolific study using the study id
     def get_study_by_id(self, study_id):
         if study_id == None:
             study_id = self.study_id
-        url = f'https://api.prolific.com/api/v1/studies/{study_id}/'
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            data = response.json()  # If the response contains JSON data
-            return data
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return None
+        return self._request('GET', f'studies/{study_id}/')
 
-    #get all submissions, might be super slow when you have a long list of submissions
+    #get all submissions, might be slow when you have a long list of submissions
     def get_submissions(self):
-        url = 'https://api.prolific.com/api/v1/submissions/'
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            data = response.json()  # If the response contains JSON data
-            print('You currently have %s submissions'%len(data['results']))
-            return data['results']
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return None
+        results = self._get_all_pages('submissions/')
+        if results is not None:
+            print('You currently have %s submissions'%len(results))
+        return results
 
-    # get the list of submissions from a study
-    def get_submissions_from_study(self, study_id = None):
+    # get the list of submissions from a study. If since is given (a started_at
+    # timestamp), pages are requested newest first and fetching stops at the
+    # first page with no submission started after it
+    def get_submissions_from_study(self, study_id = None, since = None):
         if study_id == None:
             study_id = self.study_id
-        api_endpoint = 'https://api.prolific.com/api/v1/submissions?study={}'
-        url = api_endpoint.format(study_id)
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            data = response.json()['results']
-            print('Successfully fetched %s submissions from study %s' % (len(data), study_id))
-            return data
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return None
-        #print(len(data))
-        #print(data.keys())
+        params = {'study': study_id}
+        if since is not None:
+            params['ordering'] = '-started_at'
+
+        data = []
+        for page in self._iter_pages('submissions/', params):
+            if page is None:
+                return None
+            data.extend(page)
+            if since is not None and all((v.get('started_at') or '') <= since for v in page):
+                break
+        logger.debug(
+            'Fetched %s submissions from study %s', len(data), study_id, extra=event_extra("prolific", study_id=study_id)
+        )
+        return data
 
 
     # get the status of a specific submission
     def get_submission_from_id(self, submission_id):
-        url = f'https://api.prolific.com/api/v1/submissions/{submission_id}/'
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            data = response.json()  # If the response contains JSON data
-            return data
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return None
+        return self._request('GET', f'submissions/{submission_id}/')
 
     # get the list of recent submissions from a study
     def get_recent_study_submissions(self, study_id):
         if study_id == None:
             study_id = self.study_id
-        url = f'https://api.prolific.com/api/v1/studies/{study_id}/submissions/'
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            data = response.json()  # If the response contains JSON data
-            print('You currently have %s submissions' % len(data['results']))
-            return (data['results'])
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return None
+        results = self._get_all_pages(f'studies/{study_id}/submissions/')
+        if results is not None:
+            print('You currently have %s submissions' % len(results))
+        return results
 
     #get study status
     def get_study_status(self, study_id = None):
@@ -108,43 +178,41 @@ class ProlificBase(object):
         else:
             return None
 
+    # transition a study to a new status, the response is the updated study
+    def _transition_study(self, study_id, action):
+        data = self._request('POST', f'studies/{study_id}/transition/', json={"action": action})
+        if data is not None:
+            logger.info(
+                'Study %s is now %s', study_id, data.get('status'),
+                extra=event_extra("prolific", study_id=study_id, action=action),
+            )
+        return data
+
     #pause study based on the given study id, if id not given, use the study id
     #in the current object
     def pause_study(self, study_id = None):
         if study_id == None:
             study_id = self.study_id
-        api_endpoint = 'https://api.prolific.com/api/v1/studies/{}/transition/'
-        url = api_endpoint.format(study_id)
-        data = {
-                  "action": "PAUSE"
-        }
-        response = requests.post(url, headers=self.headers, json=data)
-        data = response.json()
-        print(study_id, self.get_study_status(study_id))
-        return data
+        return self._transition_study(study_id, "PAUSE")
 
     #start study based on the given study id, if id not given, use the study id
     #in the current object
     def start_study(self, study_id = None):
         if study_id == None:
             study_id = self.study_id
-        api_endpoint = 'https://api.prolific.com/api/v1/studies/{}/transition/'
-        url = api_endpoint.format(study_id)
-        data = {
-                  "action": "START"
-        }
-        response = requests.post(url, headers=self.headers, json=data)
-        data = response.json()
-        print(study_id, self.get_study_status(study_id))
-        return data
+        return self._transition_study(study_id, "START")
 
 
 # The class to manage the status of a prolific study
 class ProlificStudy(ProlificBase):
-    def __init__(self, token, study_id, saving_dir, max_concurrent_sessions = 30, workload_checker_period = 60):
-        ProlificBase.__init__(self, token)
+    def __init__(self, token, study_id, saving_dir, max_concurrent_sessions = 30, workload_checker_period = 60,
+                 full_sync_period = 10, **api_kwargs):
+        ProlificBase.__init__(self, token, **api_kwargs)
         self.study_id = study_id
         self.study_info = self.get_study_by_id(study_id)
+        # submissions.json is a journal: every time the status of a submission
+        # changes, the submission is appended to it, so the latest line of each
+        # submission id is its current state
         self.submission_info_path = os.path.join(saving_dir, 'submissions.json')
         self.sessions = OrderedDict()
         self.user2session = {}
@@ -152,9 +220,21 @@ class ProlificStudy(ProlificBase):
         self.study_status = None
         self.status_path = None
         self.max_concurrent_sessions = max_concurrent_sessions # How many users can work on the study at the same time
-        self.checker_period = workload_checker_period
-        self.workload_checker_remaining_time = workload_checker_period
-        self.workload_checker_on = False
+        self.checker_period = workload_checker_period # How long the study stays paused before checking the workload again
+
+        # Submissions are fetched incrementally, newest first, down to the oldest
+        # submission that is still open (or the last one seen if none is open), so
+        # new submissions and status changes all come from the paginated listing.
+        # Every full_sync_period polls all the submissions are fetched again
+        self.user_status_dict = defaultdict(set)
+        self.last_started_at = None
+        self.full_sync_period = full_sync_period
+        self.polls_since_full_sync = 0
+
+        # (event, participant_id, submission) tuples for submissions that were
+        # dropped or completed since the events were last consumed
+        self.status_events = deque()
+        self.load_submission_journal()
 
     #get the basic study information and return them as a dict
     def get_basic_study_info(self):
@@ -162,52 +242,91 @@ class ProlificStudy(ProlificBase):
                 'reward', 'average_reward_per_hour', 'external_study_url', 'status', 'total_available_places', 'places_taken']
         return {key:self.study_info[key] for key in keys}
 
+    # return the started_at timestamp the next incremental poll has to list the
+    # submissions back to, or None if all the submissions have to be fetched
+    def get_incremental_since(self):
+        if self.last_started_at is None or self.polls_since_full_sync >= self.full_sync_period:
+            return None
+        since = self.last_started_at
+        for v in self.sessions.values():
+            if v.get('status') in OPEN_SUBMISSION_STATUSES:
+                # an open submission without a start time can only be found by
+                # listing everything
+                if not v.get('started_at'):
+                    return None
+                since = min(since, v['started_at'])
+        return since
+
     #update the submission status
     def update_submission_status(self):
-        submission_data = self.get_submissions_from_study()
-        with open(self.submission_info_path, "wt") as f:
-            for v in submission_data:
-                f.writelines(json.dumps(v) + "\n")
-        self.user_status_dict = defaultdict(set)
+        since = self.get_incremental_since()
+        full_sync = since is None
+        submission_data = self.get_submissions_from_study(since=since)
+        if submission_data is None:
+            logger.warning(
+                'Failed to update the submissions of study %s, keeping the previous status', self.study_id,
+                extra=event_extra("prolific", study_id=self.study_id),
+            )
+            return
+        self.polls_since_full_sync = 0 if full_sync else self.polls_since_full_sync + 1
+
+        changed = []
         for v in submission_data:
-            self.sessions[v['id']] = v
-            #self.user2session[v['participant_id']] = v['id']
-            self.user_status_dict[v['status']].add(v['participant_id'])
+            if self.apply_submission(v):
+                changed.append(v)
+            if v.get('started_at') and (self.last_started_at is None or v['started_at'] > self.last_started_at):
+                self.last_started_at = v['started_at']
+
+        if changed:
+            with open(self.submission_info_path, "at") as f:
+                for v in changed:
+                    f.write(json.dumps(v) + "\n")
+
+    # record the latest state of a submission, returning whether its status changed
+    def apply_submission(self, v, emit_events = True):
+        old = self.sessions.get(v['id'])
+        if old is not None and old['status'] == v['status']:
+            return False
+        if old is not None:
+            self.user_status_dict[old['status']].discard(old['participant_id'])
+        self.sessions[v['id']] = v
+        #self.user2session[v['participant_id']] = v['id']
+        self.user_status_dict[v['status']].add(v['participant_id'])
+
+        if emit_events:
+            if v['status'] in DROPPED_SUBMISSION_STATUSES:
+                self.status_events.append(('dropped', v['participant_id'], v))
+            elif v['status'] in COMPLETED_SUBMISSION_STATUSES:
+                self.status_events.append(('completed', v['participant_id'], v))
+        return True
+
+    # rebuild the submission state from the journal written by previous runs,
+    # these submissions were already handled so no events are emitted
+    def load_submission_journal(self):
+        if not os.path.exists(self.submission_info_path):
+            return
+        with open(self.submission_info_path, "rt") as f:
+            for line in f:
+                if line.strip():
+                    self.apply_submission(json.loads(line), emit_events=False)
+
+    # return and clear the (event, participant_id, submission) tuples emitted since
+    # the last call, where event is either 'dropped' or 'completed'
+    def pop_status_events(self):
+        events = []
+        while self.status_events:
+            events.append(self.status_events.popleft())
+        return events
 
     # return a full list of usernames who have returned/timed-out the task or who have been rejected
     def get_dropped_users(self):
-        return list(self.user_status_dict['RETURNED'] | self.user_status_dict['TIMED-OUT'] | self.user_status_dict['REJECTED'])
+        return list(set().union(*[self.user_status_dict[status] for status in DROPPED_SUBMISSION_STATUSES]))
 
     # return the amount of ACTIVE session/users
     def get_concurrent_sessions_count(self):
         return len(self.user_status_dict['ACTIVE'])
 
 
-    # periodically check the amount of active users, if the amount of active users is below 20% of the
-    # max_concurrent_sessions resume the study on prolific
-    def workload_checker(self):
-        if self.workload_checker_on:
-            print('Workload checker already in process, time remaining: %s seconds' % self.workload_checker_remaining_time)
-            return None
-        else:
-            print('Workload checker started, checking every %s seconds'%self.checker_period)
-            while True:
-                self.workload_checker_remaining_time = self.checker_period
-                self.workload_checker_on = True
-                print(f"\rChecking workload in: {self.checker_period} seconds")
-                #time.sleep(self.checker_period)
-                for i in range(self.checker_period, 0, -1):
-                    #print(f"\rChecking workload in: {i}s", end='', flush=True)
-                    self.workload_checker_remaining_time -= 1
-                    time.sleep(1)
-                self.update_submission_status()
-                if self.get_concurrent_sessions_count() < 0.2 * self.max_concurrent_sessions:
-                    self.workload_checker_on = False
-                    print('current workload: ', self.get_concurrent_sessions_count(), ', resuming study %s'%self.study_id)
-                    self.start_study()
-                    return None
-                else:
-                    print('current workload: ', self.get_concurrent_sessions_count(), ', starting another workload checker')
     '''
     
     def update_active_session_status(self):
@@ -229,4 +348,108 @@ class ProlificStudy(ProlificBase):
     def add_new_user(self, user):
         status = self.get_submission_from_id(user['SESSION_ID'])['status']
         self.sessions[user['SESSION_ID']] = {'username':user['PROLIFIC_PID'], 'status':status}
-        self.session_status_dict[status].append(user['SESSION_ID'])
\ No newline at end of file
+        self.session_status_dict[status].append(user['SESSION_ID'])
+
+
+# Keeps the status of a prolific study in sync and pauses the study when too many
+# users are working on it. A single daemon thread runs every sync_period seconds,
+# or earlier when notify() is called (e.g., when a new user logs in), so there is
+# never more than one checker regardless of how often the workload is exceeded.
+#
+# Pausing and resuming use hysteresis: the study is paused once the number of
+# active sessions exceeds max_concurrent_sessions, and only resumed after it has
+# been paused for at least checker_period seconds and the number of active
+# sessions has dropped below resume_ratio * max_concurrent_sessions.
+class ProlificWorkloadController(object):
+    def __init__(self, study, sync_period = 60, resume_ratio = 0.2, min_sync_interval = 5, on_update = None):
+        self.study = study
+        self.sync_period = sync_period
+        self.resume_ratio = resume_ratio
+        self.min_sync_interval = min_sync_interval # Never sync more often than this, even if notified
+        self.on_update = on_update # Called after every sync, e.g., to release the spots of dropped users
+
+        self.paused_for_workload = False
+        self.paused_at = None
+        self.last_sync = None
+        self.last_action = None
+        self.last_error = None
+
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.thread = None
+
+    # start the controller thread, this does nothing if it is already running
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='prolific-workload-controller', daemon=True)
+            self.thread.start()
+
+    # ask the controller to sync as soon as min_sync_interval allows
+    def notify(self):
+        self.wake_event.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.step()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = repr(e)
+                logger.exception(
+                    'Failed to update the status of prolific study %s', self.study.study_id,
+                    extra=event_extra("prolific", study_id=self.study.study_id),
+                )
+            self.wake_event.wait(self.sync_period)
+            self.wake_event.clear()
+            time.sleep(max(0, self.min_sync_interval - (time.time() - self.last_sync)))
+
+    # sync the study status once and pause or resume the study if needed
+    def step(self):
+        self.last_sync = time.time()
+        self.study.update_submission_status()
+        if self.on_update is not None:
+            self.on_update()
+
+        active = self.study.get_concurrent_sessions_count()
+        if not self.paused_for_workload and active > self.study.max_concurrent_sessions:
+            logger.info(
+                'Concurrent sessions (%s) exceed the predefined threshold (%s), pausing the prolific study',
+                active, self.study.max_concurrent_sessions,
+                extra=event_extra("prolific", study_id=self.study.study_id, active_sessions=active),
+            )
+            # if the transition failed the state is kept, so the next sync retries it
+            if self.study.pause_study() is None:
+                return
+            with self.lock:
+                self.paused_for_workload = True
+                self.paused_at = time.time()
+                self.last_action = ('PAUSE', self.paused_at)
+        elif (self.paused_for_workload and time.time() - self.paused_at >= self.study.checker_period
+                and active < self.resume_ratio * self.study.max_concurrent_sessions):
+            logger.info(
+                'Current workload: %s, resuming study %s', active, self.study.study_id,
+                extra=event_extra("prolific", study_id=self.study.study_id, active_sessions=active),
+            )
+            if self.study.start_study() is None:
+                return
+            with self.lock:
+                self.paused_for_workload = False
+                self.paused_at = None
+                self.last_action = ('START', time.time())
+
+    # return the state of the controller for monitoring
+    def get_state(self):
+        with self.lock:
+            return {
+                'running': self.thread is not None and self.thread.is_alive(),
+                'active_sessions': self.study.get_concurrent_sessions_count(),
+                'max_concurrent_sessions': self.study.max_concurrent_sessions,
+                'resume_below': self.resume_ratio * self.study.max_concurrent_sessions,
+                'paused_for_workload': self.paused_for_workload,
+                'paused_at': self.paused_at,
+                'last_sync': self.last_sync,
+                'last_action': self.last_action,
+                'last_error': self.last_error,
+            }
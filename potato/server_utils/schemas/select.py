@@ -5,6 +5,16 @@ Select Layout
 import os
 from pathlib import Path
 
+# get the current program dir (for the case of pypi, it will be the path where potato is installed)
+cur_program_dir = Path(os.path.abspath(__file__)).parent.parent.parent.absolute()
+
+# The files with the options of the predefined label lists
+PREDEFINED_LABEL_FILES = {
+    "country": os.path.join(cur_program_dir, "static/survey_assets/country_dropdown_list.html"),
+    "ethnicity": os.path.join(cur_program_dir, "static/survey_assets/ethnicity_dropdown_list.html"),
+    "religion": os.path.join(cur_program_dir, "static/survey_assets/religion_dropdown_list.html"),
+}
+
 
 def generate_select_layout(annotation_scheme):
 
@@ -31,19 +41,12 @@ def generate_select_layout(annotation_scheme):
         )
     )
 
-    cur_program_dir = Path(os.path.abspath(__file__)).parent.parent.parent.absolute()  # get the current program dir (for the case of pypi, it will be the path where potato is installed)
-    predefined_labels_dict = {
-        "country": os.path.join(cur_program_dir, "static/survey_assets/country_dropdown_list.html"),
-        "ethnicity": os.path.join(cur_program_dir, "static/survey_assets/ethnicity_dropdown_list.html"),
-        "religion": os.path.join(cur_program_dir, "static/survey_assets/religion_dropdown_list.html"),
-    }
-
     # directly use the predefined labels if annotation_scheme["use_predefined_labels"] is defined
     if (
         "use_predefined_labels" in annotation_scheme
-        and annotation_scheme["use_predefined_labels"] in predefined_labels_dict
+        and annotation_scheme["use_predefined_labels"] in PREDEFINED_LABEL_FILES
     ):
-        with open(predefined_labels_dict[annotation_scheme["use_predefined_labels"]]) as r:
+        with open(PREDEFINED_LABEL_FILES[annotation_scheme["use_predefined_labels"]]) as r:
             schematic += r.read()
 
     else:
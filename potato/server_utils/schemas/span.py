@@ -2,7 +2,10 @@
 Span Layout
 """
 
+import html
 import logging
+import re
+from collections import defaultdict
 from collections.abc import Mapping
 from potato.server_utils.config_module import config
 
@@ -49,6 +52,13 @@ def get_span_color(span_label):
     )
 
 
+def get_span_colors():
+    """
+    Returns the colors of all the mapped span labels, by label.
+    """
+    return dict(config.get("ui", {}).get("spans", {}).get("span_colors", {}))
+
+
 def set_span_color(span_label, color):
     """
     Sets the color of a span with this label as a string with an RGB triple in parentheses.
@@ -62,6 +72,35 @@ def set_span_color(span_label, color):
     )[span_label] = color
 
 
+# The opening tag of a span annotation. Spans that cross another span's boundary
+# are split into several fragments, which share a data-span-id so that
+# parse_html_span_annotation() can join them again
+SPAN_OPEN_TAG = (
+    '<span class="span_container" selection_label="{annotation}" '
+    + 'data-schema="{schema}" style="background-color:rgb{bg_color};"{span_id}>'
+)
+SPAN_CLOSE_TAG = (
+    '<div class="span_label" name="{annotation}" data-schema="{schema}" '
+    + 'style="background-color:white;border:2px solid rgb{color};">'
+    + "{annotation_title}</div></span>"
+)
+SPAN_ID_ATTRIBUTE = ' data-span-id="{}"'
+
+# Matches the markup of span annotations in the HTML sent by the front end: the
+# opening tags of spans, their closing tags and the label divs. The alternatives
+# share the leading "<" so that the regex engine can skip ahead to it
+SPAN_TOKEN_REGEX = re.compile(
+    r'<(?:span\b(?P<span_attributes>[^>]*)>'
+    + r'|(?P<span_end>/span>)'
+    + r'|div class="span_label"(?P<label_attributes>[^>]*)>(?P<label>.*?)</div>)',
+    re.DOTALL,
+)
+HTML_ATTRIBUTE_REGEX = re.compile(r'([\w-]+)="([^"]*)"')
+
+# Tags and character references, which the browser does not show as they are
+HTML_MARKUP_REGEX = re.compile(r"<[A-Za-z/!][^>]*>|&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);")
+
+
 def render_span_annotations(text, span_annotations):
     """
     Retuns a modified version of the text with span annotation overlays inserted
@@ -78,38 +117,255 @@ def render_span_annotations(text, span_annotations):
     #
     # This synchrony also means that any changes to the UI code for rendering
     # need to be updated here too.
-
-    # We need to go in reverse order to make the string update in the right
-    # places, so make sure things are ordered in reverse of start
-
-    rev_order_sa = sorted(span_annotations, key=lambda d: d["start"], reverse=True)
-
-    ann_wrapper = (
-        '<span class="span_container" selection_label="{annotation}" '
-        + 'data-schema="{schema}" style="background-color:rgb{bg_color};">'
-        + "{span}"
-        + '<div class="span_label" name="{annotation}" data-schema="{schema}" '
-        + 'style="background-color:white;border:2px solid rgb{color};">'
-        + "{annotation_title}</div></span>"
-    )
-    for a in rev_order_sa:
+    #
+    # The output is built in a single pass over the span boundaries. Nested
+    # spans are rendered inside each other, and a span that crosses the end of
+    # another one is closed and reopened around it.
+    open_tags, close_tags = [], []
+    for a in span_annotations:
         # Spans are colored according to their order in the list and we need to
         # retrofit the color
         color = get_span_color(a["annotation"])
         # The color is an RGB triple like (1,2,3) and we want the background for
         # the text to be somewhat transparent so we switch to RGBA for bg
         bg_color = color.replace(")", ",0.25)")
+        fields = dict(
+            annotation=a["annotation"], schema=a["schema"], color=color, bg_color=bg_color,
+            # The text above the span is its title and we display whatever its set to
+            annotation_title=a["annotation_title"],
+        )
+        open_tags.append(SPAN_OPEN_TAG.format(span_id="", **fields))
+        close_tags.append(SPAN_CLOSE_TAG.format(**fields))
 
-        # The text above the span is its title and we display whatever its set to
-        annotation_title= a["annotation_title"]
+    # Outer spans are opened before the spans they contain
+    opening_order = sorted(
+        range(len(span_annotations)),
+        key=lambda i: (span_annotations[i]["start"], -span_annotations[i]["end"]),
+    )
+    boundaries = sorted(
+        set(a["start"] for a in span_annotations) | set(a["end"] for a in span_annotations)
+    )
 
-        ann = ann_wrapper.format(
-            annotation=a["annotation"], annotation_title=annotation_title, \
-              span=a["span"], color=color, bg_color=bg_color, schema=a["schema"]
-        )
-        text = text[: a["start"]] + ann + text[a["end"] :]
+    parts = []
+    # the open spans as (annotation index, index of its opening tag in parts)
+    stack = []
+    split_tags = {}
+    open_ends = defaultdict(int)
+    cursor = 0
+    next_open = 0
+    for position in boundaries:
+        parts.append(text[cursor:position])
+        cursor = position
+
+        # Close the spans that end here, temporarily closing any span opened
+        # inside them that continues past this position
+        reopen = []
+        while open_ends[position] > 0:
+            i, tag_index = stack.pop()
+            if span_annotations[i]["end"] == position:
+                parts.append(close_tags[i])
+                open_ends[position] -= 1
+            else:
+                if i not in split_tags:
+                    split_tags[i] = open_tags[i][:-1] + SPAN_ID_ATTRIBUTE.format(i) + ">"
+                parts[tag_index] = split_tags[i]
+                parts.append("</span>")
+                reopen.append(i)
+        for i in reversed(reopen):
+            stack.append((i, len(parts)))
+            parts.append(split_tags[i])
+
+        while next_open < len(opening_order) and span_annotations[opening_order[next_open]]["start"] == position:
+            i = opening_order[next_open]
+            next_open += 1
+            parts.append(open_tags[i])
+            if span_annotations[i]["end"] <= position:
+                # an empty span is closed right away
+                parts.append(close_tags[i])
+            else:
+                stack.append((i, len(parts) - 1))
+                open_ends[span_annotations[i]["end"]] += 1
+
+    parts.append(text[cursor:])
+    return "".join(parts)
+
+
+def parse_html_span_annotation(html_span_annotation):
+    """
+    Parses the span annotations produced in raw HTML by Potato's front end
+    and extracts out the precise spans and labels annotated by users.
 
-    return text
+    :returns: a tuple of (1) the annotated string without annotation HTML
+              and a list of annotations
+    """
+    s = html_span_annotation.strip()
+
+    # The text without the annotation markup is built in parts, and length keeps
+    # the offset in it of the current position
+    parts = []
+    length = 0
+    # The open spans, None for spans that are not span annotations
+    stack = []
+    annotations = []
+    # The annotation of each split span, by the data-span-id of its fragments
+    fragments = {}
+
+    position = 0
+    for m in SPAN_TOKEN_REGEX.finditer(s):
+        token_start = m.start()
+        if token_start > position:
+            parts.append(s[position:token_start])
+            length += token_start - position
+        position = m.end()
+        kind = m.lastgroup
+        top = stack[-1] if stack else None
+
+        if kind == "span_attributes":
+            attributes = m.group("span_attributes")
+            if "span_container" not in attributes:
+                top = None
+            else:
+                attributes = dict(HTML_ATTRIBUTE_REGEX.findall(attributes))
+                top = {
+                    "start": length,
+                    "annotation": attributes.get("selection_label"),
+                    "schema": attributes.get("data-schema"),
+                    "annotation_title": None,
+                    "span_id": attributes.get("data-span-id"),
+                }
+            stack.append(top)
+            if top is not None:
+                continue
+
+        elif kind == "label" and top is not None:
+            # The label div of the innermost open span. Spans made by the front
+            # end only have their schema here
+            if top["annotation"] is None or top["schema"] is None:
+                attributes = dict(HTML_ATTRIBUTE_REGEX.findall(m.group("label_attributes")))
+                top["annotation"] = top["annotation"] or attributes.get("name")
+                top["schema"] = top["schema"] or attributes.get("data-schema")
+            top["annotation_title"] = m.group("label")
+            continue
+
+        elif kind == "span_end" and stack:
+            stack.pop()
+            if top is not None:
+                if top["span_id"] in fragments:
+                    ann = fragments[top["span_id"]]
+                    ann["end"] = length
+                    ann["annotation_title"] = top["annotation_title"] or ann["annotation_title"]
+                else:
+                    ann = {
+                        "start": top["start"],
+                        "end": length,
+                        "span": None,
+                        "annotation": top["annotation"],
+                        "schema": top["schema"],
+                        "annotation_title": top["annotation_title"],
+                    }
+                    annotations.append(ann)
+                    if top["span_id"] is not None:
+                        fragments[top["span_id"]] = ann
+                continue
+
+        # Markup that is not part of a span annotation is kept as it is
+        parts.append(m.group(0))
+        length += position - token_start
+
+    # Add whatever trailing text exists
+    parts.append(s[position:])
+    no_html_s = "".join(parts)
+
+    annotations.sort(key=lambda a: a["start"])
+    for ann in annotations:
+        ann["span"] = no_html_s[ann["start"] : ann["end"]]
+
+    return no_html_s, annotations
+
+
+def get_visible_text(text):
+    """
+    Returns the text that the browser shows for some instance HTML (without
+    tags, with character references decoded and without leading whitespace),
+    along with the offsets in the HTML where each visible character starts and
+    ends.
+    """
+    visible = []
+    starts = []
+    ends = []
+    position = 0
+    for m in HTML_MARKUP_REGEX.finditer(text):
+        visible.append(text[position : m.start()])
+        starts.extend(range(position, m.start()))
+        ends.extend(range(position + 1, m.start() + 1))
+        position = m.end()
+        if m.group(0)[0] == "&":
+            chars = html.unescape(m.group(0))
+            visible.append(chars)
+            starts.extend([m.start()] * len(chars))
+            ends.extend([m.end()] * len(chars))
+    visible.append(text[position:])
+    starts.extend(range(position, len(text)))
+    ends.extend(range(position + 1, len(text) + 1))
+
+    visible = "".join(visible)
+    # the front end counts offsets from the first non-whitespace character, since
+    # the template indents the instance text
+    skip = len(visible) - len(visible.lstrip())
+    return visible[skip:], starts[skip:], ends[skip:]
+
+
+def validate_span_annotations(text, posted_spans, span_schemas=None):
+    """
+    Converts the span annotations posted by the front end into the ones stored
+    for the instance, dropping any that are malformed or do not match the text.
+
+    :text: the displayed text of the instance
+    :posted_spans: a list of dicts with the "start" and "end" offsets of each
+      span in the visible text of the instance, its "annotation", "schema" and
+      "annotation_title", and the "span" text the user selected
+    :span_schemas: the names of the span schemas, if given then spans of any
+      other schema are dropped
+    :returns: the span annotations, with their offsets into text
+    """
+    if not posted_spans:
+        return []
+
+    visible, starts, ends = get_visible_text(text)
+    span_annotations = []
+    for posted in posted_spans:
+        try:
+            start, end = int(posted["start"]), int(posted["end"])
+            annotation, schema = posted["annotation"], posted["schema"]
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Dropping malformed span annotation: %s" % (posted,))
+            continue
+
+        if not 0 <= start < end <= len(visible) or not annotation:
+            logger.warning("Dropping out of range span annotation: %s" % (posted,))
+            continue
+        if span_schemas is not None and schema not in span_schemas:
+            logger.warning('Dropping span annotation for unknown schema "%s"' % schema)
+            continue
+        if "span" in posted and visible[start:end] != posted["span"]:
+            logger.warning(
+                'Dropping span annotation whose text "%s" does not match the instance'
+                % posted["span"]
+            )
+            continue
+
+        start, end = starts[start], ends[end - 1]
+        span_annotations.append({
+            "start": start,
+            "end": end,
+            "span": text[start:end],
+            "annotation": annotation,
+            "schema": schema,
+            "annotation_title": posted.get("annotation_title") or annotation,
+        })
+
+    span_annotations.sort(key=lambda a: a["start"])
+    return span_annotations
 
 
 def generate_span_layout(annotation_scheme, horizontal=False):
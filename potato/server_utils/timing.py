@@ -0,0 +1,38 @@
+"""
+Timing of the phases of starting potato, reported with --timing.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """
+    Records how long each phase of importing and starting potato takes.
+    """
+
+    def __init__(self):
+        # (phase, seconds), in the order the phases ran
+        self.phases = []
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self):
+        """
+        Returns a table of the phases and their durations in milliseconds.
+        """
+        width = max([len(name) for name, _ in self.phases] + [len("total")])
+        lines = ["startup timing:"]
+        for name, seconds in self.phases:
+            lines.append("  %-*s %9.1f ms" % (width, name, seconds * 1000))
+        lines.append("  %-*s %9.1f ms" % (width, "total", sum(seconds for _, seconds in self.phases) * 1000))
+        return "\n".join(lines)
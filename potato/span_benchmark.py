@@ -0,0 +1,137 @@
+"""
+Benchmarks rendering and parsing span annotations on long documents.
+
+By default this renders 1,000 spans into a 100KB document and parses the
+resulting HTML back, comparing against the previous implementations, which
+rebuilt the whole string for every span.
+
+Usage: python -m potato.span_benchmark --size 100000 --spans 1000 --repeat 5
+"""
+
+import argparse
+import random
+import re
+import time
+
+from potato.server_utils.schemas import span
+
+
+def legacy_render_span_annotations(text, span_annotations):
+    ann_wrapper = (
+        '<span class="span_container" selection_label="{annotation}" '
+        + 'data-schema="{schema}" style="background-color:rgb{bg_color};">'
+        + "{span}"
+        + '<div class="span_label" name="{annotation}" data-schema="{schema}" '
+        + 'style="background-color:white;border:2px solid rgb{color};">'
+        + "{annotation_title}</div></span>"
+    )
+    for a in sorted(span_annotations, key=lambda d: d["start"], reverse=True):
+        color = span.get_span_color(a["annotation"])
+        ann = ann_wrapper.format(
+            annotation=a["annotation"], annotation_title=a["annotation_title"], span=a["span"],
+            color=color, bg_color=color.replace(")", ",0.25)"), schema=a["schema"],
+        )
+        text = text[: a["start"]] + ann + text[a["end"] :]
+    return text
+
+
+def legacy_parse_html_span_annotation(html_span_annotation):
+    s = html_span_annotation.strip()
+    init_tag_regex = re.compile(r"(<span.+?>)")
+    end_tag_regex = re.compile(r"(</span>)")
+    anno_regex = re.compile(r'<div class="span_label"(.*)name="(.+?)"(.+)?>(.+)</div>')
+    schema_regex = re.compile(r'data-schema="([^"]+?)"')
+    no_html_s = ""
+    start = 0
+    annotations = []
+    while True:
+        m = init_tag_regex.search(s, start)
+        if not m:
+            break
+        m2 = end_tag_regex.search(s, m.end())
+        middle = s[m.end() : m2.start()]
+        m3 = anno_regex.search(middle)
+        middle_text = middle[: m3.start()]
+        m4 = schema_regex.search(middle)
+        no_html_s += s[start : m.start()]
+        annotations.append({
+            "start": len(no_html_s),
+            "end": len(no_html_s) + len(middle_text),
+            "span": middle_text,
+            "annotation": m3.group(2),
+            "schema": m4.group(1),
+            "annotation_title": m3.group(4),
+        })
+        no_html_s += middle_text
+        start = m2.end(0)
+    no_html_s += s[start:]
+    return no_html_s, annotations
+
+
+def make_document(size, n_spans, seed=0):
+    """
+    Returns a random document of about size characters and n_spans
+    non-overlapping span annotations on it.
+    """
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    text = ""
+    while len(text) < size:
+        text += rng.choice(words) + " "
+    text = text[:size].strip()
+
+    labels = ["positive", "negative", "neutral"]
+    for label in labels:
+        span.set_span_color(label, span.SPAN_COLOR_PALETTE[labels.index(label)])
+
+    # spread the spans evenly so that they do not overlap (which the legacy
+    # implementations cannot handle)
+    width = len(text) // n_spans
+    annotations = []
+    for i in range(n_spans):
+        start = i * width + rng.randint(0, width // 4)
+        end = start + rng.randint(1, width // 2)
+        label = rng.choice(labels)
+        annotations.append({
+            "start": start, "end": end, "span": text[start:end],
+            "annotation": label, "schema": "sentiment", "annotation_title": label,
+        })
+    return text, annotations
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+    text, annotations = make_document(args.size, args.spans)
+    print("document: %d characters, %d spans" % (len(text), len(annotations)))
+
+    render_time, html = timeit(lambda: span.render_span_annotations(text, annotations), args.repeat)
+    legacy_render_time, legacy_html = timeit(
+        lambda: legacy_render_span_annotations(text, annotations), args.repeat
+    )
+    assert html == legacy_html
+
+    parse_time, (parsed_text, parsed) = timeit(lambda: span.parse_html_span_annotation(html), args.repeat)
+    legacy_parse_time, (legacy_text, legacy_parsed) = timeit(
+        lambda: legacy_parse_html_span_annotation(html), args.repeat
+    )
+    assert parsed_text == legacy_text == text
+    assert parsed == legacy_parsed
+
+    print("render: %.2f ms (legacy %.2f ms)" % (render_time * 1000, legacy_render_time * 1000))
+    print("parse:  %.2f ms (legacy %.2f ms)" % (parse_time * 1000, legacy_parse_time * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark span annotation rendering and parsing")
+    parser.add_argument("--size", type=int, default=100000, help="document size in characters")
+    parser.add_argument("--spans", type=int, default=1000, help="number of span annotations")
+    parser.add_argument("--repeat", type=int, default=5, help="report the best of this many runs")
+    main(parser.parse_args())